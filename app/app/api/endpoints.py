@@ -1,5 +1,8 @@
-from contextlib import suppress
-from flask import request
+import json
+from functools import partial
+
+import msgpack
+from flask import request, g, current_app, Response, stream_with_context
 from sqlalchemy import and_
 
 from app.api import api
@@ -20,17 +23,26 @@ from app.consts import DEVICE_TYPE_ID_MISSING_ERROR_MSG, DEVICE_TYPE_ID_INCORREC
     UNAUTHORIZED_USER_SCENE_ERROR_MSG, ACTION_ALREADY_PRESENT_ERROR_MSG, INVALID_SCENE_BI_ERROR_MSG, \
     AUTH_USER_ID_MISSING_ERROR_MSG, AUTH_USER_ID_INVALID_ERROR_MSG, AUTH_USER_ALREADY_AUTHORIZED_ERROR_MSG, \
     REVOKE_USER_ID_MISSING_ERROR_MSG, REVOKE_USER_ID_INVALID_ERROR_MSG, REVOKE_USER_NOT_AUTHORIZED_ERROR_MSG, \
-    DEVICE_NAME_BI_INVALID_ERROR_MSG, ADDITIONAL_DATA_MISSING_ERROR_MSG
+    DEVICE_NAME_BI_INVALID_ERROR_MSG, ADDITIONAL_DATA_MISSING_ERROR_MSG, DATA_LIMIT_INVALID_ERROR_MSG, DATA_CURSOR_INVALID_ERROR_MSG, \
+    DATA_LAYOUT_INVALID_ERROR_MSG, DATA_ORDER_BY_INVALID_ERROR_MSG, DATA_DIRECTION_INVALID_ERROR_MSG, DATA_COLUMN_INVALID_ERROR_MSG, \
+    DATA_BUCKETS_INVALID_ERROR_MSG, DATA_EXTREMES_INVALID_ERROR_MSG, DATA_SINCE_INVALID_ERROR_MSG
 from app.models.models import DeviceType, Device, DeviceData, UserDevice, User, Scene, Action
+from app.models.hot_tier import hot_tier
+from app.models.range_cache import range_cache
+from app.models.row_cache import row_cache
 from app.mqtt.utils import Payload
-from app.utils import http_json_response, check_missing_request_argument, is_valid_uuid, format_topic, validate_broker_password, is_number, create_payload
+from app.utils import NDJSON_MIMETYPE, MSGPACK_MIMETYPE, http_json_response, http_msgpack_response, http_json_fragments_response, \
+    http_msgpack_fragments_response, check_missing_request_argument, is_valid_uuid, format_topic, validate_broker_password, is_number, \
+    create_payload, encode_cursor, decode_cursor
+
+OPE_OUTPUT_RANGE = (-214748364800, 214748364700)  # `out_range` of OPE ciphers used by clients
 
 
 @api.route('/user/broker_register', methods=['POST'])
-@require_api_token()
+@require_api_token(load=("mqtt_creds",))
 def register_to_broker():
     password_hash = request.form.get("password", None)
-    user = User.get_using_jwt_token(request.headers.get('Authorization', ""))
+    user = g.user
     arg_check = check_missing_request_argument(
         (password_hash, USER_MISSING_PASSWORD_HASH))
     if arg_check is not True:
@@ -50,7 +62,7 @@ def register_to_broker():
 def create_device_type():
     description = request.form.get("description", None)
     correctness_hash = request.form.get("correctness_hash", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
     arg_check = check_missing_request_argument(
         (description, DEVICE_TYPE_DESC_MISSING_ERROR_MSG),
         (correctness_hash, CORRECTNESS_HASH_MISSING_ERROR_MSG))
@@ -63,14 +75,14 @@ def create_device_type():
 
 
 @api.route('/device/create', methods=['POST'])
-@require_api_token()
+@require_api_token(load=("mqtt_creds", "devices"))
 def create_device():
     device_type_id = request.form.get("type_id", None)
     correctness_hash = request.form.get("correctness_hash", None)
     name = request.form.get("name", None)
     name_bi = request.form.get("name_bi", None)
     password_hash = request.form.get("password", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
     arg_check = check_missing_request_argument(
         (device_type_id, DEVICE_TYPE_ID_MISSING_ERROR_MSG),
         (correctness_hash, CORRECTNESS_HASH_MISSING_ERROR_MSG),
@@ -138,7 +150,7 @@ def create_scene():
 def add_scene_action():
     scene_name_bi = request.form.get("scene_name_bi", None)
     action_name_bi = request.form.get("action_name_bi", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
 
     arg_check = check_missing_request_argument(
         (scene_name_bi, SCENE_NAME_BI_MISSING_ERROR_MSG),
@@ -168,13 +180,13 @@ def add_scene_action():
 
 
 @api.route('/device/set_action', methods=['POST'])
-@require_api_token()
+@require_api_token(load=("mqtt_creds",))
 def set_device_action():
     device_id = request.form.get("device_id", None)
     correctness_hash = request.form.get("correctness_hash", None)
     name = request.form.get("name", None)
     name_bi = request.form.get("name_bi", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
 
     arg_check = check_missing_request_argument(
         (device_id, DEVICE_ID_MISSING_ERROR_MSG),
@@ -202,107 +214,297 @@ def set_device_action():
 @require_api_token()
 def get_device_by_name():
     device_name_bi = request.args.get("name_bi", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
     if device_name_bi is None:
         return http_json_response(False, 400, **{"error": DEVICE_NAME_BI_MISSING_ERROR_MSG})
-    devices = db.session.query(Device).filter(and_(Device.name_bi == device_name_bi, Device.owner == user))
-    result = []
-    for device in devices:
-        d = device.as_dict()
-        for k, v in d.items():
-            if isinstance(v, bytes):
-                d[k] = v.decode()
-        result.append(d)
-    return http_json_response(**{'devices': result})
+    serializer = Device.row_serializer()
+    devices = serializer.query(db.session.query(Device).filter(and_(Device.name_bi == device_name_bi, Device.owner == user)))
+    return http_json_response(**{'devices': [serializer(row) for row in devices]})
 
 
 @api.route('/data/get_by_num_range', methods=['GET'])
 @require_api_token()
 def get_data_by_num_range():
-    lower_bound = request.args.get("lower", "")
-    upper_bound = request.args.get("upper", "")
     device_name_bi = request.args.get("device_name_bi", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
 
     arg_check = check_missing_request_argument((device_name_bi, DEVICE_NAME_BI_MISSING_ERROR_MSG))
     if arg_check is not True:
         return arg_check
 
-    device = Device.get_by_name_bi(device_name_bi)
+    device, error = _get_authorized_device(user, device_name_bi)
+    if error is not None:
+        return error
 
-    if device is None:
-        return http_json_response(False, 400, **{"error": DEVICE_NAME_BI_INVALID_ERROR_MSG})
+    num_data, error = _parse_ope_bounds("lower", "upper")
+    if error is not None:
+        return error
 
-    if not User.can_use_device(user, device.id):
-        return http_json_response(False, 400, **{"error": UNAUTHORIZED_USER_ERROR_MSG})
+    page, error = _parse_page_arguments()
+    if error is not None:
+        return error
+
+    return _cached_response(device, lambda: _device_data_response(DeviceData.in_range(device.id, num_data=num_data), page,
+                                                                  hot=_hot_page(device, num_data=num_data)))
+
+
+@api.route('/data/get_by_time_range', methods=['GET'])
+@require_api_token()
+def get_data_by_time_range():
+    """ Returns data of device with OPE encrypted `added` in (`lower`, `upper`) range, optionally also with `num_data` in (`num_lower`, `num_upper`). """
+    device_name_bi = request.args.get("device_name_bi", None)
+    user = g.user
+
+    arg_check = check_missing_request_argument((device_name_bi, DEVICE_NAME_BI_MISSING_ERROR_MSG))
+    if arg_check is not True:
+        return arg_check
+
+    device, error = _get_authorized_device(user, device_name_bi)
+    if error is not None:
+        return error
+
+    added, error = _parse_ope_bounds("lower", "upper")
+    if error is not None:
+        return error
 
-    if not is_number(lower_bound) and not is_number(upper_bound):
-        return http_json_response(False, 400, **{"error": DATA_RANGE_MISSING_ERROR_MSG})
-
-    with suppress(ValueError):
-        lower_bound = int(lower_bound)
-    with suppress(ValueError):
-        upper_bound = int(upper_bound)
-
-    data = []
-    if isinstance(lower_bound, int) and isinstance(upper_bound, int):
-        if -214748364800 <= lower_bound < upper_bound <= 214748364700:
-            data = db.session.query(DeviceData).join(Device).filter(and_(DeviceData.num_data > lower_bound,
-                                                                    DeviceData.num_data < upper_bound,
-                                                                    Device.name_bi == device_name_bi)).all()
-        else:
-            return http_json_response(False, 400, **{"error": DATA_OUT_OF_OUTPUT_RANGE_ERROR_MSG})
-    elif not isinstance(upper_bound, int) and isinstance(lower_bound, int):
-        if -214748364800 <= lower_bound <= 214748364700:
-            data = db.session.query(DeviceData).join(Device).filter(and_(DeviceData.num_data > lower_bound,
-                                                                         Device.name_bi == device_name_bi)).all()
-        else:
-            return http_json_response(False, 400, **{"error": DATA_OUT_OF_OUTPUT_RANGE_ERROR_MSG})
-
-    elif not isinstance(lower_bound, int) and isinstance(upper_bound, int):
-        if -214748364800 <= upper_bound <= 214748364700:
-            data = db.session.query(DeviceData).join(Device).filter(and_(DeviceData.num_data < upper_bound,
-                                                                         Device.name_bi == device_name_bi)).all()
-        else:
-            return http_json_response(False, 400, **{"error": DATA_OUT_OF_OUTPUT_RANGE_ERROR_MSG})
-
-    result = []
-    for row in data:
-        r = row.as_dict()
-        for k, v in r.items():
-            if isinstance(v, bytes):
-                r[k] = v.decode()
-        result.append(r)
-    return http_json_response(**{'device_data': result})
+    num_data, error = _parse_ope_bounds("num_lower", "num_upper", required=False)
+    if error is not None:
+        return error
+
+    page, error = _parse_page_arguments()
+    if error is not None:
+        return error
+
+    return _cached_response(device, lambda: _device_data_response(DeviceData.in_range(device.id, num_data=num_data, added=added), page,
+                                                                  hot=_hot_page(device, num_data=num_data, added=added)))
 
 
 @api.route('/data/get_device_data', methods=['GET'])
 @require_api_token()
 def get_device_data():
+    """
+    Returns data of device together with `watermark` - ingest sequence number of device read before data were queried.
+    Passing it back as `since` returns only rows ingested after that (removed rows are not reported), so client that
+    already holds the data pays only for new rows. Rows ingested while data were read might be returned again by next sync.
+    """
     device_name_bi = request.args.get("device_name_bi", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    since = request.args.get("since", None)
+    user = g.user
 
     arg_check = check_missing_request_argument((device_name_bi, DEVICE_NAME_BI_MISSING_ERROR_MSG))
     if arg_check is not True:
         return arg_check
 
-    device = Device.get_by_name_bi(device_name_bi)
+    device, error = _get_authorized_device(user, device_name_bi)
+    if error is not None:
+        return error
 
-    if device is None:
-        return http_json_response(False, 400, **{"error": DEVICE_NAME_BI_INVALID_ERROR_MSG})
+    page, error = _parse_page_arguments()
+    if error is not None:
+        return error
 
-    if not User.can_use_device(user, device.id):
-        return http_json_response(False, 400, **{"error": UNAUTHORIZED_USER_ERROR_MSG})
+    query = db.session.query(DeviceData).filter(DeviceData.device_id == device.id)
+    if since is not None:
+        if not is_number(since) or int(since) < 0:
+            return http_json_response(False, 400, **{"error": DATA_SINCE_INVALID_ERROR_MSG})
+        query = query.filter(DeviceData.seq > int(since))  # served by `(device_id, seq)` index
 
-    result = []
-    for row in device.data:
-        r = row.as_dict()
-        for k, v in r.items():
-            if isinstance(v, bytes):
-                r[k] = v.decode()
-        result.append(r)
+    return _device_data_response(query, page, watermark=device.data_seq, hot=_hot_page(device) if since is None else None)
 
-    return http_json_response(**{'device_data': result})
+
+@api.route('/data/aggregate', methods=['GET'])
+@require_api_token()
+def get_data_aggregate():
+    """
+    Returns `count` of device data, `buckets` - counts of rows with OPE encrypted `column` (`num_data` or `added`) in ranges
+    given by comma separated encrypted `buckets` boundaries and `lowest`/`highest` - `extremes` rows with lowest/highest value.
+    """
+    device_name_bi = request.args.get("device_name_bi", None)
+    column = request.args.get("column", "num_data")
+    buckets = request.args.get("buckets", "")
+    extremes = request.args.get("extremes", "1")
+    user = g.user
+
+    arg_check = check_missing_request_argument((device_name_bi, DEVICE_NAME_BI_MISSING_ERROR_MSG))
+    if arg_check is not True:
+        return arg_check
+
+    device, error = _get_authorized_device(user, device_name_bi)
+    if error is not None:
+        return error
+
+    if column not in DeviceData.OPE_COLUMNS:
+        return http_json_response(False, 400, **{"error": DATA_COLUMN_INVALID_ERROR_MSG})
+
+    boundaries = buckets.split(",") if buckets else []
+    if not all(is_number(b) for b in boundaries):
+        return http_json_response(False, 400, **{"error": DATA_BUCKETS_INVALID_ERROR_MSG})
+    boundaries = [int(b) for b in boundaries]
+    start, end = OPE_OUTPUT_RANGE
+    if any(not start <= b <= end for b in boundaries) or any(lower >= upper for lower, upper in zip(boundaries, boundaries[1:])):
+        return http_json_response(False, 400, **{"error": DATA_BUCKETS_INVALID_ERROR_MSG})
+
+    if not is_number(extremes) or not 0 < int(extremes):
+        return http_json_response(False, 400, **{"error": DATA_EXTREMES_INVALID_ERROR_MSG})
+    extremes = min(int(extremes), current_app.config["DATA_PAGE_MAX_LIMIT"])
+
+    serializer = DeviceData.row_serializer()
+    window = hot_tier.window(device, DeviceData.hot_rows) if hot_tier.enabled else None
+    result = hot_tier.aggregate(window, column, boundaries, extremes) if window is not None else None
+    if result is not None:
+        count, bucket_counts, lowest_ids, highest_ids = result
+        rows = {row.id: row for row in serializer.query(db.session.query(DeviceData).filter(DeviceData.id.in_(lowest_ids + highest_ids)))}
+        if not all(id_ in rows for id_ in lowest_ids + highest_ids):  # rows were removed after window was built, answered by DB
+            result = None
+    if result is not None:
+        lowest, highest = [rows[id_] for id_ in lowest_ids], [rows[id_] for id_ in highest_ids]
+    else:
+        count, bucket_counts, lowest, highest = DeviceData.aggregate(device.id, column, boundaries, extremes)
+    return http_json_response(**{"count": count,
+                                 "buckets": bucket_counts,
+                                 "lowest": [serializer(row) for row in lowest],
+                                 "highest": [serializer(row) for row in highest]})
+
+
+def _get_authorized_device(user, device_name_bi):
+    """ Returns `(device, error)` - device with :param device_name_bi if :param user can use it, otherwise error response. """
+    device = Device.get_authorized_by_name_bi(user, device_name_bi)
+    if device is not None:
+        return device, None
+    if Device.get_by_name_bi(device_name_bi) is None:
+        return None, http_json_response(False, 400, **{"error": DEVICE_NAME_BI_INVALID_ERROR_MSG})
+    return None, http_json_response(False, 400, **{"error": UNAUTHORIZED_USER_ERROR_MSG})
+
+
+def _parse_ope_bounds(lower_name, upper_name, required=True):
+    """
+    Returns `((lower, upper), error)` - OPE encrypted bounds parsed from request arguments (missing or non-numeric bound is None)
+    or error response if both are missing (and :param required) or they are out of OPE output range.
+    """
+    lower, upper = (int(value) if is_number(value) else None for value in (request.args.get(lower_name), request.args.get(upper_name)))
+    if lower is None and upper is None:
+        if required:
+            return None, http_json_response(False, 400, **{"error": DATA_RANGE_MISSING_ERROR_MSG})
+        return (None, None), None
+    start, end = OPE_OUTPUT_RANGE
+    if any(bound is not None and not start <= bound <= end for bound in (lower, upper)) \
+            or (lower is not None and upper is not None and lower >= upper):
+        return None, http_json_response(False, 400, **{"error": DATA_OUT_OF_OUTPUT_RANGE_ERROR_MSG})
+    return (lower, upper), None
+
+
+def _parse_page_arguments():
+    """
+    Returns `((limit, after, order_by, descending), error)` - page parsed from request arguments (all optional, rows are ordered
+    by `id` ascending by default) or error response if they are invalid. E.g. `order_by=added&direction=desc&limit=50` returns 50 latest rows.
+    """
+    limit = request.args.get("limit", None)
+    after = request.args.get("after", None)
+    order_by = request.args.get("order_by", "id")
+    direction = request.args.get("direction", "asc")
+    if limit is not None:
+        if not is_number(limit) or not 0 < int(limit):
+            return None, http_json_response(False, 400, **{"error": DATA_LIMIT_INVALID_ERROR_MSG})
+        limit = min(int(limit), current_app.config["DATA_PAGE_MAX_LIMIT"])
+    if order_by not in DeviceData.ORDER_COLUMNS:
+        return None, http_json_response(False, 400, **{"error": DATA_ORDER_BY_INVALID_ERROR_MSG})
+    if direction not in ("asc", "desc"):
+        return None, http_json_response(False, 400, **{"error": DATA_DIRECTION_INVALID_ERROR_MSG})
+    if after is not None:
+        after = decode_cursor(after, order_by)
+        if after is None:
+            return None, http_json_response(False, 400, **{"error": DATA_CURSOR_INVALID_ERROR_MSG})
+    return (limit, after, order_by, direction == "desc"), None
+
+
+def _device_data_response(query, page, watermark=None, hot=None):
+    """
+    Returns rows of :param query in format negotiated using `Accept` header:
+        - `application/json` (default) or `application/msgpack` - whole page, as list of row objects or, with `layout=columns`,
+          as single object of column name -> list of values
+        - `application/x-ndjson` - rows are streamed one JSON object per line while they are read from DB using server-side
+          cursor, so whole result is never held in memory (`layout` is ignored)
+    :param watermark is included in response (`X-Watermark` header of streamed response) if not None. Pages of rows are taken
+    from :param hot(limit, after, order_by, descending) (see `_hot_page`) if it returns them.
+    """
+    limit, after, order_by, descending = page
+    layout = request.args.get("layout", "rows")
+    if layout not in ("rows", "columns"):
+        return http_json_response(False, 400, **{"error": DATA_LAYOUT_INVALID_ERROR_MSG})
+    serializer = DeviceData.row_serializer()
+    mimetype = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE, MSGPACK_MIMETYPE])
+    if mimetype == NDJSON_MIMETYPE:
+        rows = DeviceData.stream(serializer.query(query), limit, after, current_app.config["DATA_STREAM_CHUNK_SIZE"], order_by, descending)
+        headers = {} if watermark is None else {"X-Watermark": str(watermark)}
+        return Response(stream_with_context(json.dumps(serializer(row)) + "\n" for row in rows), mimetype=NDJSON_MIMETYPE, headers=headers)
+
+    result = {}
+    ids = None
+    if layout == "rows" and row_cache.max_size > 0:
+        hot_page = hot(limit, after, order_by, descending) if hot is not None else None
+        if hot_page is not None:
+            ids, last = hot_page
+        elif limit is not None:  # unpaginated rows are read by single query instead, they would only flush `row_cache`
+            keys = [DeviceData.id] if order_by == "id" else [DeviceData.id, getattr(DeviceData, order_by)]
+            data, last = DeviceData.get_page(query.with_entities(*keys), limit, after, order_by, descending)
+            ids = [row.id for row in data]
+    if ids is not None:
+        fragments = _encoded_rows(serializer, ids, mimetype, cache=limit is not None and len(ids) <= row_cache.max_size)
+        response = http_msgpack_fragments_response if mimetype == MSGPACK_MIMETYPE else http_json_fragments_response
+        response = partial(response, 'device_data', fragments)
+    else:
+        data, last = DeviceData.get_page(serializer.query(query), limit, after, order_by, descending)
+        result['device_data'] = serializer.columnar(data) if layout == "columns" else [serializer(row) for row in data]
+        response = http_msgpack_response if mimetype == MSGPACK_MIMETYPE else http_json_response
+    if limit is not None:
+        result['next'] = None if last is None else encode_cursor(last, order_by)
+    if watermark is not None:
+        result['watermark'] = watermark
+    return response(**result)
+
+
+def _hot_page(device, num_data=(None, None), added=(None, None)):
+    """ Returns function answering pages of data of :param device in given ranges from `hot_tier` (returns None if it can't). """
+    def page(limit, after, order_by, descending):
+        window = hot_tier.window(device, DeviceData.hot_rows) if hot_tier.enabled else None
+        return None if window is None else hot_tier.page(window, num_data, added, limit, after, order_by, descending)
+    return page
+
+
+def _cached_response(device, build):
+    """
+    Returns response of :param build (function returning response of data query of :param device) from `range_cache`.
+    Entries are keyed by path, query arguments and negotiated mimetype, and are valid only for `data_version` of :param device
+    loaded before query runs, so data inserted or removed after it can't be served from cache. Streamed responses are not cached.
+    """
+    mimetype = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE, MSGPACK_MIMETYPE])
+    if mimetype == NDJSON_MIMETYPE or range_cache.max_size <= 0:
+        return build()
+    key = (device.id, request.path, tuple(sorted(request.args.items(multi=True))), mimetype)
+    cached = range_cache.get(key, device.data_version)
+    if cached is not None:
+        body, cached_mimetype = cached
+        return Response(body, mimetype=cached_mimetype)
+    response = current_app.make_response(build())
+    if response.status_code == 200:
+        range_cache.add(key, device.data_version, response.get_data(), response.mimetype)
+    return response
+
+
+def _encoded_rows(serializer, ids, mimetype, cache=True):
+    """
+    Returns rows with :param ids encoded as :param mimetype (in the same order), rows missing in `row_cache` are loaded using single query.
+    Without :param cache all rows are loaded and `row_cache` isn't used (e.g. for more rows than it holds).
+    """
+    fragments = row_cache.get_many(mimetype, ids) if cache else {}
+    missing = [id_ for id_ in ids if id_ not in fragments]
+    if missing:
+        encode = (lambda row: msgpack.packb(row, use_bin_type=True)) if mimetype == MSGPACK_MIMETYPE else (lambda row: json.dumps(row).encode())
+        for row in serializer.query(db.session.query(DeviceData).filter(DeviceData.id.in_(missing))):
+            fragments[row.id] = encode(serializer(row))
+            if cache:
+                row_cache.add(mimetype, row.id, fragments[row.id])
+    return [fragments[id_] for id_ in ids if id_ in fragments]  # row might have been removed meanwhile
 
 
 @api.route('/exchange_session_keys', methods=['POST'])
@@ -310,7 +512,7 @@ def get_device_data():
 def exchange_session_keys():
     user_public_key_bytes = request.form.get("public_key", None)
     device_id = request.form.get("device_id", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
 
     arg_check = check_missing_request_argument(
         (user_public_key_bytes, PUBLIC_KEY_MISSING_ERROR_MSG),
@@ -321,11 +523,11 @@ def exchange_session_keys():
     if not User.can_use_device(user, device_id):
         return http_json_response(False, 400, **{"error": UNAUTHORIZED_USER_ERROR_MSG})
 
-    payload_bytes = bytes(Payload(
+    payload = Payload(
         user_public_key=user_public_key_bytes,
         user_id=user.id
-    ))
-    client.publish(f'server/d:{device_id}/', f'"{payload_bytes.decode("utf-8")}"'.encode())
+    ).encode(Device.get_payload_version(device_id))
+    client.publish(f'server/d:{device_id}/', payload)
     return http_json_response()
 
 
@@ -333,7 +535,7 @@ def exchange_session_keys():
 @require_api_token()
 def retrieve_public_key():
     device_id = request.form.get("device_id", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
 
     arg_check = check_missing_request_argument(
         (device_id, DEVICE_ID_MISSING_ERROR_MSG))
@@ -353,17 +555,17 @@ def retrieve_public_key():
         user_device.added = None
         db.session.add(user_device)
         db.session.commit()
-        return http_json_response(**{'device_public_key': public_key})
+        return http_json_response(**{'device_public_key': public_key, 'payload_version': user_device.device.payload_version})
     return http_json_response(False, 400, **{"error": NO_PUBLIC_KEY_ERROR_MSG})
 
 
 @api.route('/device/action', methods=['GET'])
-@require_api_token()
+@require_api_token(load=("mqtt_creds",))
 def trigger_action():
     device_name_bi = request.args.get("device_name_bi", None)
     name_bi = request.args.get("name_bi", None)
     additional_data = request.args.get("additional_data", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
 
     arg_check = check_missing_request_argument(
         (device_name_bi, DEVICE_NAME_BI_MISSING_ERROR_MSG),
@@ -372,8 +574,8 @@ def trigger_action():
     if arg_check is not True:
         return arg_check
 
-    dv = Device.get_by_name_bi(device_name_bi)
-    if dv is None or not User.can_use_device(user, dv.id):
+    dv = Device.get_authorized_by_name_bi(user, device_name_bi)
+    if dv is None:
         return http_json_response(False, 400, **{"error": UNAUTHORIZED_USER_ERROR_MSG})
 
     topic = format_topic(user.mqtt_creds.username, dv.mqtt_creds.username)
@@ -383,17 +585,17 @@ def trigger_action():
     payload = create_payload(user.mqtt_creds.username, {
         "action": ac.name.decode("utf-8"),
         "additional_data": additional_data
-    })
+    }, dv.payload_version)
     client.publish(topic, payload)
     return http_json_response()
 
 
 @api.route('/scene/trigger', methods=['GET'])
-@require_api_token()
+@require_api_token(load=("mqtt_creds",))
 def trigger_scene():
     name_bi = request.args.get("name_bi", None)
     additional_data = request.args.get("additional_data", None)
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
 
     arg_check = check_missing_request_argument(
         (name_bi, ACTION_NAME_BI_MISSING_ERROR_MSG),
@@ -415,7 +617,7 @@ def trigger_scene():
         payload = create_payload(user.mqtt_creds.username, {
             "action": ac.name.decode("utf-8"),
             "additional_data": additional_data
-        })
+        }, ac.device.payload_version)
         topic = format_topic(user.mqtt_creds.username, ac.device.mqtt_creds.username)
         client.publish(topic, payload)
 
@@ -427,7 +629,7 @@ def trigger_scene():
 def authorize_user():
     device_name_bi = request.form.get("device_name_bi", None)
     auth_user_id = request.form.get("auth_user_id", None)  # ID of user to be authorized
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
     auth_user = User.get_by_id(auth_user_id)
 
     arg_check = check_missing_request_argument(
@@ -437,8 +639,8 @@ def authorize_user():
     if arg_check is not True:
         return arg_check
 
-    device = Device.get_by_name_bi(device_name_bi)
-    if device is None or not User.can_use_device(user, device.id):
+    device = Device.get_authorized_by_name_bi(user, device_name_bi)
+    if device is None:
         return http_json_response(False, 400, **{"error": UNAUTHORIZED_USER_ERROR_MSG})
 
     if not auth_user.is_registered_with_broker:
@@ -466,7 +668,7 @@ def authorize_user():
 def revoke_user():
     device_name_bi = request.form.get("device_name_bi", None)
     revoke_user_id = request.form.get("revoke_user_id", None)  # ID of user to be revoked
-    user = User.get_using_jwt_token(request.headers.get("Authorization", ""))
+    user = g.user
     user_to_revoke = User.get_by_id(revoke_user_id)
 
     arg_check = check_missing_request_argument(
@@ -476,12 +678,10 @@ def revoke_user():
     if arg_check is not True:
         return arg_check
 
-    device = Device.get_by_name_bi(device_name_bi)
-    if device is None or not User.can_use_device(user, device.id):
+    device = Device.get_authorized_by_name_bi(user, device_name_bi)
+    if device is None:
         return http_json_response(False, 400, **{"error": UNAUTHORIZED_USER_ERROR_MSG})
 
-    device = Device.get_by_id(device.id)
-
     if next((ud for ud in device.users if ud.user_id == user_to_revoke.id), None) is None:
         return http_json_response(False, 400, **{"error": REVOKE_USER_NOT_AUTHORIZED_ERROR_MSG})
 
@@ -20,6 +20,46 @@ def register_models():
     from app.models.models import Device, DeviceType, User, DeviceData, Action, Scene, AttrAuthUser, MasterKeypair, PrivateKey, Attribute, UserDevice, MQTTUser, ACL  # noqa pylint: disable=unused-variable, cyclic-import
 
 
+def configure_mqtt_client(mqtt_client, app):
+    try:
+        mqtt_client.tls_set(ca_certs=app.config["CA_CERTS_PATH"],
+                            certfile=app.config["CLIENT_CERTFILE_PATH"],
+                            keyfile=app.config["CLIENT_KEYFILE_PATH"],
+                            tls_version=ssl.PROTOCOL_TLSv1_2)
+        mqtt_client.tls_insecure_set(app.config["SSL_INSECURE"])
+    except ValueError as e:
+        app.logger.error(e)
+    mqtt_client.username_pw_set(app.config["MQTT_USERNAME"], base64.urlsafe_b64decode(app.config["MQTT_PASSWORD"]).decode())
+    mqtt_client.max_inflight_messages_set(app.config["MQTT_MAX_INFLIGHT"])
+    mqtt_client.max_queued_messages_set(app.config["MQTT_MAX_QUEUED"])
+
+
+def create_ingest_app(config_name):
+    """ Creates app for standalone ingest worker - no blueprints, no MQTT client and DB is expected to be set up by web app. """
+    app = Flask(__name__)
+    app.config.from_object(config[config_name])
+    app.logger.info("USING CONFIGURATION TYPE: " + config_name)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    config[config_name].init_app(app)
+
+    db.init_app(app)
+    register_models()
+
+    from app.mqtt import ingest_buffer
+    ingest_buffer.init_app(app, db)
+    from app.models.device_registry import device_registry
+    device_registry.init_app(app)
+    from app.models.models import Device
+    with app.app_context():
+        device_registry.load(Device.get_user_ids)
+
+    from app.invalidation import invalidation_bus
+    invalidation_bus.init_app(app)
+
+    return app
+
+
 def create_app(config_name):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
@@ -37,6 +77,18 @@ def create_app(config_name):
     oauth.init_app(app)
     from app.auth import oauth_aa
     oauth_aa.init_app(app)
+    from app.auth.token_cache import token_cache
+    token_cache.init_app(app)
+    from app.models.acl_cache import acl_cache
+    acl_cache.init_app(app)
+    from app.models.row_cache import row_cache
+    row_cache.init_app(app)
+    from app.models.range_cache import range_cache
+    range_cache.init_app(app)
+    from app.models.hot_tier import hot_tier
+    hot_tier.init_app(app)
+    from app.compression import response_compression
+    response_compression.init_app(app)
 
     # Set up extensions
     register_models()
@@ -73,13 +125,22 @@ def create_app(config_name):
             from app.errors import errors
             app.register_error_handler(Exception, errors.handle_error)
 
-            from app.mqtt import handle_on_connect, handle_on_log, handle_on_publish, handle_on_message
+            from app.mqtt import handle_on_connect, handle_on_log, handle_on_publish, handle_on_message, ingest_buffer, ingest_topics
+            ingest_buffer.init_app(app, db)
+            from app.models.device_registry import device_registry
+            from app.models.models import Device
+            device_registry.init_app(app)
+            if app.config["INGEST_IN_WEB_APP"]:
+                device_registry.load(Device.get_user_ids)
+
+            # With standalone ingest workers (`python -m app.mqtt.worker`) web app only publishes
+            topics = ingest_topics() if app.config["INGEST_IN_WEB_APP"] else []
 
             def on_connect(mqtt_client, userdata, flags, rc):
-                handle_on_connect(mqtt_client, userdata, flags, rc)
+                handle_on_connect(mqtt_client, userdata, flags, rc, topics)
 
             def on_log(mqtt_client, userdata, level, buf):
-                handle_on_log(mqtt_client, userdata, level, buf)
+                handle_on_log(mqtt_client, userdata, level, buf, app)
 
             def on_publish(mqtt_client, userdata, mid):
                 handle_on_publish(mqtt_client, userdata, mid)
@@ -92,23 +153,25 @@ def create_app(config_name):
             client.on_publish = on_publish
             client.on_message = on_message
 
-            try:
-                client.tls_set(ca_certs=app.config["CA_CERTS_PATH"],
-                               certfile=app.config["CLIENT_CERTFILE_PATH"],
-                               keyfile=app.config["CLIENT_KEYFILE_PATH"],
-                               tls_version=ssl.PROTOCOL_TLSv1_2)
-                client.tls_insecure_set(app.config["SSL_INSECURE"])
-            except ValueError as e:
-                app.logger.error(e)
-            client.username_pw_set(app.config["MQTT_USERNAME"], base64.urlsafe_b64decode(app.config["MQTT_PASSWORD"]).decode())
+            configure_mqtt_client(client, app)
             client.connect(app.config["MQTT_BROKER_URL"], app.config["MQTT_BROKER_PORT"], 60)
             app.logger.info("Client connected...")
 
+            # Network loop runs in its own thread, so incoming messages are handled as soon as they arrive
+            client.loop_start()
+
             scheduler = BackgroundScheduler()
-            scheduler.add_job(func=client.loop, trigger="interval", seconds=3)
+            scheduler.add_job(func=ingest_buffer.flush, trigger="interval", seconds=app.config["INGEST_FLUSH_INTERVAL"] / 1000)
             scheduler.start()
 
-            # Shut down the scheduler when exiting the app
+            from app.invalidation import invalidation_bus
+            invalidation_bus.init_app(app)
+
+            # Stop the network loop, write buffered device data and shut down the scheduler when exiting the app
+            atexit.register(ingest_buffer.close)
+            atexit.register(ingest_buffer.flush)
             atexit.register(scheduler.shutdown)
+            atexit.register(client.loop_stop)
+            atexit.register(invalidation_bus.stop)
 
     return app
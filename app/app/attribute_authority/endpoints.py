@@ -1,4 +1,4 @@
-from flask import request
+from flask import request, g
 
 from app.attribute_authority.utils import create_attributes, parse_attr_list, get_private_key_based_on_owner, create_private_key
 from app.app_setup import db
@@ -22,7 +22,7 @@ from app.utils import http_json_response, check_missing_request_argument
 @attr_authority.route('/set_username', methods=['POST'])
 @require_api_token("attr_auth")
 def set_username():
-    user = AttrAuthUser.get_using_jwt_token(request.headers.get("Authorization", None))
+    user = g.user
     api_username = request.form.get("api_username", None)
 
     arg_check = check_missing_request_argument((api_username, API_USERNAME_MISSING_ERROR_MSG))
@@ -48,7 +48,7 @@ def key_setup():
     public_key, master_key = cp_abe.setup()
 
     # "store keypair in DB"
-    user = AttrAuthUser.get_using_jwt_token(request.headers.get("Authorization", None))
+    user = g.user
 
     serialized_public_key = serialize_charm_object(public_key, pairing_group)
     serialized_master_key = serialize_charm_object(master_key, pairing_group)
@@ -62,9 +62,9 @@ def key_setup():
 
 
 @attr_authority.route('/user/keygen', methods=['POST'])
-@require_api_token("attr_auth")
+@require_api_token("attr_auth", load=("master_keypair",))
 def keygen():
-    data_owner = AttrAuthUser.get_using_jwt_token(request.headers.get("Authorization", None))
+    data_owner = g.user
     attr_list = request.form.get("attr_list", None)
     api_username = request.form.get("api_username", None)
     device_id = request.form.get("device_id", None)
@@ -101,9 +101,9 @@ def keygen():
 
 
 @attr_authority.route('/device/keygen', methods=['POST'])
-@require_api_token("attr_auth")
+@require_api_token("attr_auth", load=("master_keypair",))
 def device_keygen():
-    data_owner = AttrAuthUser.get_using_jwt_token(request.headers.get("Authorization", None))
+    data_owner = g.user
     attr_list = request.form.get("attr_list", None)
 
     arg_check = check_missing_request_argument(
@@ -124,9 +124,9 @@ def device_keygen():
 
 
 @attr_authority.route('/user/retrieve_private_keys', methods=['POST'])
-@require_api_token("attr_auth")
+@require_api_token("attr_auth", load=("private_keys",))
 def retrieve_private_keys():
-    user = AttrAuthUser.get_using_jwt_token(request.headers.get("Authorization", None))
+    user = g.user
 
     private_keys = [{
         "data": key.data.decode("utf-8"),
@@ -140,9 +140,9 @@ def retrieve_private_keys():
 
 
 @attr_authority.route('/encrypt', methods=['GET'])
-@require_api_token("attr_auth")
+@require_api_token("attr_auth", load=("master_keypair",))
 def encrypt():
-    data_owner = AttrAuthUser.get_using_jwt_token(request.headers.get("Authorization", None))
+    data_owner = g.user
     plaintext = request.args.get("message", None)
     policy_string = request.args.get("policy_string", None)
 
@@ -164,7 +164,7 @@ def encrypt():
 @attr_authority.route('/decrypt', methods=['GET'])  # NOTE: ciphertext might be too long for url
 @require_api_token("attr_auth")
 def decrypt():
-    decryptor = AttrAuthUser.get_using_jwt_token(request.headers.get("Authorization", None))
+    decryptor = g.user
     owner_api_username = request.args.get("api_username", None)
     serialized_ciphertext = request.args.get("ciphertext", None)
 
@@ -1,18 +1,19 @@
 from authlib.common.security import generate_token
-from flask import request, url_for, current_app, session
+from flask import request, url_for, current_app, session, g
 
 from app.app_setup import db
+from app.invalidation import invalidation_bus
 from app.auth import login, login_aa, remote_aa, nonce_key_aa, backend_aa
 from app.auth import remote as remote_app, nonce_key as nonce_key_app, backend as backend_app
 from app.auth.utils import handle_authorize, require_api_token
-from app.models.models import AttrAuthUser, User
 from app.utils import http_json_response
 
 
 @login_aa.route('/delete_account', methods=['POST'])
 @require_api_token("attr_auth")
 def delete_account_aa():
-    user = AttrAuthUser.get_using_jwt_token(request.headers.get('Authorization', ""))
+    user = g.user
+    invalidation_bus.notify("token", ["attr_auth", user.id])
     db.session.delete(user)
     db.session.commit()
 
@@ -22,7 +23,8 @@ def delete_account_aa():
 @login.route('/delete_account', methods=['POST'])
 @require_api_token()
 def delete_account():
-    user = User.get_using_jwt_token(request.headers.get('Authorization', ""))
+    user = g.user
+    invalidation_bus.notify("token", [None, user.id])
     db.session.delete(user)
     db.session.commit()
 
@@ -0,0 +1,73 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from app.invalidation import invalidation_bus
+
+
+class VerifiedTokenCache:
+    """
+    LRU cache of access tokens that were already verified using `bcrypt`, so that only first request with given token
+    pays for hashing. Entries are keyed by (bind, user id, SHA-256 digest of token) and remember `access_token` hash
+    and `access_token_update` of user they were verified against, so entry stops matching as soon as user's token changes
+    (also in other worker processes). Entries expire after `TOKEN_CACHE_TTL` seconds.
+    """
+
+    def __init__(self):
+        self.max_size = 0
+        self.ttl = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def init_app(self, app):
+        self.max_size = app.config["TOKEN_CACHE_SIZE"]
+        self.ttl = app.config["TOKEN_CACHE_TTL"]
+        self.clear()
+
+    def is_verified(self, bind, user, token):
+        """ Returns True if :param token was already verified against current `access_token` of :param user. """
+        key = _key(bind, user.id, token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[:2] == (user.access_token, user.access_token_update) and entry[2] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return True
+            if entry is not None:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return False
+
+    def add(self, bind, user, token):
+        if self.max_size <= 0:
+            return
+        key = _key(bind, user.id, token)
+        with self._lock:
+            self._entries[key] = (user.access_token, user.access_token_update, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, bind, user_id):
+        """ Removes all tokens of user, should be called when user's `access_token` changes or user is deleted. """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == bind and key[1] == user_id]:
+                del self._entries[key]
+            self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _key(bind, user_id, token):
+    return bind, user_id, hashlib.sha256(token.encode()).digest()
+
+
+token_cache = VerifiedTokenCache()
+invalidation_bus.register("token", lambda key: token_cache.invalidate_user(*key))
@@ -3,13 +3,15 @@ import json
 from functools import wraps
 
 import requests
-from flask import request, current_app
+from flask import request, current_app, g
 from itsdangerous import (TimedJSONWebSignatureSerializer
                           as Serializer, SignatureExpired, BadSignature)
 from passlib.hash import bcrypt
 
-from app.utils import http_json_response
+from app.utils import http_json_response, token_serializer
 from app.app_setup import db
+from app.auth.token_cache import token_cache
+from app.invalidation import invalidation_bus
 from app.models.models import User, AttrAuthUser
 
 INVALID_ACCESS_TOKEN_ERROR_MSG = "The Access Token you provided is invalid."
@@ -34,6 +36,7 @@ def save_user(remote, user_info, token):
             user = AttrAuthUser(id=user_info["sub"], name=user_info["preferred_username"])
 
     db.session.flush()
+    invalidation_bus.notify("token", [None if remote.name == "github" else "attr_auth", user.id])
     user.access_token = bcrypt.using(rounds=13).hash(token["access_token"])
     user.access_token_update = datetime.datetime.utcnow()
     db.session.add(user)
@@ -60,13 +63,18 @@ def query_github_api(token):
     return requests.get('https://api.github.com/user/emails', headers={'Authorization': f'token {token}'})
 
 
-def require_api_token(bind=None):
+def require_api_token(bind=None, load=()):
+    """
+    Verifies `Authorization` token and stores its user (`User` or `AttrAuthUser` if :param bind is "attr_auth") in `g.user`.
+    :param load names relationships of user that endpoint needs, they are loaded in the same query as user.
+    """
     def do_require_api_token(func):
         @wraps(func)
         def check_token(*args, **kwargs):
-            token = request.headers.get("Authorization", "")
-            if not validate_token(bind, token):
+            user = get_user_from_token(bind, request.headers.get("Authorization", ""), load)
+            if user is None:
                 return http_json_response(False, 400, **{"error": INVALID_ACCESS_TOKEN_ERROR_MSG})
+            g.user = user
             return func(*args, **kwargs)
 
         return check_token
@@ -75,18 +83,27 @@ def require_api_token(bind=None):
 
 
 def validate_token(bind, token):
-    s = Serializer(current_app.config['SECRET_KEY'])
+    return get_user_from_token(bind, token) is not None
+
+
+def get_user_from_token(bind, token, load=()):
+    """ Decodes token and returns its user if token is valid, otherwise returns None. """
     try:
-        data = s.loads(token)
+        data = token_serializer(current_app.config['SECRET_KEY']).loads(token)
     except SignatureExpired:
-        return False  # valid token, but expired
+        return None  # valid token, but expired
     except BadSignature:
-        return False  # invalid token
+        return None  # invalid token
     if bind is None:
-        user = User.get_by_id(data['id'])
+        user = User.get_by_id(data['id'], load)
     else:
-        user = AttrAuthUser.get_by_id(data['id'])
+        user = AttrAuthUser.get_by_id(data['id'], load)
 
-    if user is not None:
-        return bcrypt.verify(data["token"], user.access_token)
-    return False
+    if user is None:
+        return None
+    if token_cache.is_verified(bind, user, data["token"]):
+        return user
+    if bcrypt.verify(data["token"], user.access_token):
+        token_cache.add(bind, user, data["token"])
+        return user
+    return None
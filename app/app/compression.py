@@ -0,0 +1,40 @@
+import gzip
+
+from flask import request
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/msgpack", "text/html", "text/plain", "text/css", "application/javascript"}
+
+
+class ResponseCompression:
+    """
+    Compresses responses using `gzip` if client accepts it. Nginx in front of app (`webserver/`) only proxies requests,
+    so without this responses (e.g. device data - mostly base64 encoded ciphertexts) are sent uncompressed.
+    Set `RESPONSE_COMPRESSION=False` if proxy compresses responses itself. Streamed responses are not compressed.
+    """
+
+    def __init__(self):
+        self.level = 6
+        self.min_size = 0
+
+    def init_app(self, app):
+        self.level = app.config["RESPONSE_COMPRESSION_LEVEL"]
+        self.min_size = app.config["RESPONSE_COMPRESSION_MIN_SIZE"]
+        if app.config["RESPONSE_COMPRESSION"]:
+            app.after_request(self.compress)
+
+    def compress(self, response):
+        if response.direct_passthrough or response.is_streamed or response.mimetype not in COMPRESSIBLE_MIMETYPES \
+                or "Content-Encoding" in response.headers:
+            return response
+        response.vary.add("Accept-Encoding")
+        if not request.accept_encodings["gzip"]:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        response.set_data(gzip.compress(data, self.level))
+        response.headers["Content-Encoding"] = "gzip"
+        return response
+
+
+response_compression = ResponseCompression()
@@ -24,6 +24,37 @@ class Config:
     MQTT_USERNAME = os.getenv('MQTT_USERNAME', '')
     MQTT_PASSWORD = os.getenv('MQTT_PASSWORD', '')
     MQTT_REFRESH_TIME = 1.0  # refresh time in seconds
+    MQTT_MAX_INFLIGHT = int(os.getenv('MQTT_MAX_INFLIGHT', '100'))  # QoS > 0 messages that can be in flight at once
+    MQTT_MAX_QUEUED = int(os.getenv('MQTT_MAX_QUEUED', '0'))  # outgoing messages queued beyond inflight window (0 = unlimited)
+
+    INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '500'))  # flush after this many buffered device messages
+    INGEST_FLUSH_INTERVAL = int(os.getenv('INGEST_FLUSH_INTERVAL', '1000'))  # ... or after this many milliseconds
+    INGEST_MAX_PENDING = int(os.getenv('INGEST_MAX_PENDING', '100000'))  # messages kept in memory while DB is unavailable
+    INGEST_IN_WEB_APP = os.getenv('INGEST_IN_WEB_APP', 'True') == 'True'  # set to False when running standalone ingest workers
+    INGEST_PARTITION = os.getenv('INGEST_PARTITION', '0/1')  # `<index>/<count>` - devices processed by ingest worker, one worker per partition
+    INGEST_PARTITIONS = int(os.getenv('INGEST_PARTITIONS', '4'))  # threads per ingest worker, messages are partitioned by device id
+    MQTT_LOG_MESSAGES = os.getenv('MQTT_LOG_MESSAGES', 'False') == 'True'  # print every valid device message received (slows down ingest)
+    INGEST_SPOOL_DIR = os.getenv('INGEST_SPOOL_DIR', '')  # on-disk spool of received device messages, one per process ('' = in memory)
+    INGEST_SPOOL_FSYNC = os.getenv('INGEST_SPOOL_FSYNC', 'interval')  # `always` (every message), `interval` (every flush) or `never`
+    INGEST_SPOOL_SEGMENT_SIZE = int(os.getenv('INGEST_SPOOL_SEGMENT_SIZE', '16777216'))  # bytes, segment is removed once all its messages are in DB
+    INGEST_SPOOL_MAX_SIZE = int(os.getenv('INGEST_SPOOL_MAX_SIZE', '1073741824'))  # bytes, messages received beyond are dropped (0 = unlimited)
+    INGEST_SPOOL_REPLAY_BATCHES = int(os.getenv('INGEST_SPOOL_REPLAY_BATCHES', '20'))  # batches written to DB per flush while draining spool
+    DATA_PAGE_MAX_LIMIT = int(os.getenv('DATA_PAGE_MAX_LIMIT', '10000'))  # maximum `limit` of paginated data queries
+    DATA_STREAM_CHUNK_SIZE = int(os.getenv('DATA_STREAM_CHUNK_SIZE', '1000'))  # rows fetched from DB cursor at once when streaming
+    RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'True') == 'True'  # gzip responses in app, disable if proxy compresses them
+    RESPONSE_COMPRESSION_LEVEL = int(os.getenv('RESPONSE_COMPRESSION_LEVEL', '6'))
+    RESPONSE_COMPRESSION_MIN_SIZE = int(os.getenv('RESPONSE_COMPRESSION_MIN_SIZE', '1024'))  # smaller responses are sent as they are
+    TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '10000'))  # verified access tokens kept in memory (0 = disabled)
+    TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', '600'))  # seconds before token has to be verified using bcrypt again
+    ACL_CACHE_SIZE = int(os.getenv('ACL_CACHE_SIZE', '10000'))  # users whose authorized devices are kept in memory (0 = disabled)
+    ROW_CACHE_SIZE = int(os.getenv('ROW_CACHE_SIZE', '10000'))  # device data rows kept in memory encoded for responses (0 = disabled)
+    RANGE_CACHE_SIZE = int(os.getenv('RANGE_CACHE_SIZE', '1000'))  # range query responses kept in memory (0 = disabled)
+    RANGE_CACHE_MAX_BODY_SIZE = int(os.getenv('RANGE_CACHE_MAX_BODY_SIZE', '1048576'))  # bytes, larger responses are not cached
+    DEVICE_REGISTRY_SIZE = int(os.getenv('DEVICE_REGISTRY_SIZE', '100000'))  # devices known to MQTT ingest without DB lookup (0 = disabled)
+    HOT_TIER_DEVICES = int(os.getenv('HOT_TIER_DEVICES', '100'))  # devices whose recent data are indexed in memory (0 = disabled, requires NumPy)
+    HOT_TIER_DEVICE_ROWS = int(os.getenv('HOT_TIER_DEVICE_ROWS', '10000'))  # newest rows indexed per device (24 bytes each)
+    CACHE_INVALIDATION_CHANNEL = os.getenv('CACHE_INVALIDATION_CHANNEL', 'cache_invalidation')  # Postgres NOTIFY channel
+    CACHE_INVALIDATION_LISTEN = os.getenv('CACHE_INVALIDATION_LISTEN', 'True') == 'True'  # evict keys changed by other workers
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
     CA_CERTS_PATH = os.path.join(os.path.dirname(__file__), "..", "resources/certs/server/server.crt")
@@ -63,6 +94,7 @@ class TestingConfig(Config):
         'attr_auth': os.getenv('TEST_DATABASE_ATTR_AUTH_URL', 'postgres+psycopg2://postgres:postgres@db_test/attr_auth_testing'),
     }
     WTF_CSRF_ENABLED = False
+    INGEST_BATCH_SIZE = 1  # write device data immediately, so that tests can query it right after receiving message
 
 
 class HostTestingConfig(TestingConfig):
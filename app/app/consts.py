@@ -15,6 +15,15 @@ DEVICE_NAME_INVALID_ERROR_MSG = 'Device ID is invalid.'
 DEVICE_NAME_BI_INVALID_ERROR_MSG = 'Device name Blind Index is invalid.'
 DATA_RANGE_MISSING_ERROR_MSG = 'Missing upper and lower range for query.'
 DATA_OUT_OF_OUTPUT_RANGE_ERROR_MSG = 'Value out of OPE output range.'
+DATA_LIMIT_INVALID_ERROR_MSG = 'Limit has to be a positive integer.'
+DATA_CURSOR_INVALID_ERROR_MSG = 'Invalid cursor for next page of data.'
+DATA_LAYOUT_INVALID_ERROR_MSG = 'Layout has to be either "rows" or "columns".'
+DATA_ORDER_BY_INVALID_ERROR_MSG = 'Data can be ordered only by "id", "added" or "num_data".'
+DATA_DIRECTION_INVALID_ERROR_MSG = 'Direction has to be either "asc" or "desc".'
+DATA_COLUMN_INVALID_ERROR_MSG = 'Aggregates can be computed only over "added" or "num_data".'
+DATA_BUCKETS_INVALID_ERROR_MSG = 'Bucket boundaries have to be ascending integers in OPE output range.'
+DATA_EXTREMES_INVALID_ERROR_MSG = 'Extremes has to be a positive integer.'
+DATA_SINCE_INVALID_ERROR_MSG = 'Since has to be a non-negative integer.'
 CORRECTNESS_HASH_MISSING_ERROR_MSG = 'Correctness Hash needs to be provided.'
 DEVICE_ID_MISSING_ERROR_MSG = 'Missing device id.'
 PUBLIC_KEY_MISSING_ERROR_MSG = 'Missing user public key for key exchange.'
@@ -0,0 +1,92 @@
+import json
+import select
+import threading
+
+from sqlalchemy import select as sql_select, func
+
+from app.app_setup import db
+
+
+class InvalidationBus:
+    """
+    Keeps in-process caches of all worker processes consistent using Postgres `LISTEN`/`NOTIFY`.
+
+    Cache registers handler that evicts single key (`register("acl", acl_cache.invalidate)`), writes call `notify`,
+    which evicts key locally and sends `NOTIFY` on `CACHE_INVALIDATION_CHANNEL` as part of current transaction,
+    so other workers receive it only if transaction commits. Each worker runs listener thread that evicts notified keys.
+    """
+
+    def __init__(self):
+        self.channel = None
+        self.handlers = {}
+        self.stats = {"sent": 0, "received": 0, "errors": 0}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        self.channel = app.config["CACHE_INVALIDATION_CHANNEL"]
+        if app.config["CACHE_INVALIDATION_LISTEN"] and db.get_engine(app).dialect.name == "postgresql":
+            self.start(db.get_engine(app))
+
+    def register(self, name, handler):
+        self.handlers[name] = handler
+
+    def notify(self, name, key, connection=None):
+        """ Evicts :param key from cache :param name in this process and in all other processes after commit. """
+        self._evict(name, key)
+        if self.channel is None:
+            return
+        executor = connection if connection is not None else db.session
+        dialect = connection.dialect if connection is not None else db.session.get_bind().dialect
+        if dialect.name == "postgresql":
+            executor.execute(sql_select([func.pg_notify(self.channel, json.dumps([name, key]))]))
+            self.stats["sent"] += 1
+
+    def start(self, engine):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._listen, args=(engine,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _listen(self, engine):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                connection.detach()  # connection is used only by this thread, don't return it to pool
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute(f'LISTEN "{self.channel}"')
+                while not self._stop.is_set():
+                    if select.select([dbapi_connection], [], [], 5) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        self._handle(dbapi_connection.notifies.pop(0).payload)
+            except Exception as e:  # connection lost, reconnect
+                self.stats["errors"] += 1
+                print(f"Cache invalidation listener failed: {repr(e)}", flush=True)
+                self._stop.wait(5)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _handle(self, payload):
+        self.stats["received"] += 1
+        try:
+            name, key = json.loads(payload)
+        except ValueError:
+            return
+        self._evict(name, key)
+
+    def _evict(self, name, key):
+        handler = self.handlers.get(name)
+        if handler is not None:
+            handler(key)
+
+
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+
+from app.invalidation import invalidation_bus
+
+
+class DeviceAuthorizationCache:
+    """
+    LRU cache mapping user ID to devices that user can use (`{name_bi: device_id}`). Each entry remembers
+    `User.devices_version` it was loaded for, the version is incremented in DB whenever user gets or loses access
+    to a device, so stale entries stop matching in every worker process without any extra query.
+    """
+
+    def __init__(self):
+        self.max_size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def init_app(self, app):
+        self.max_size = app.config["ACL_CACHE_SIZE"]
+        self.clear()
+
+    def get(self, user, loader):
+        """ Returns `{name_bi: device_id}` of devices authorized for :param user, calls :param loader(user) on miss. """
+        version = user.devices_version
+        with self._lock:
+            entry = self._entries.get(user.id)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(user.id)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+        devices = loader(user)
+        if version is not None and self.max_size > 0:
+            with self._lock:
+                self._entries[user.id] = (version, devices)
+                self._entries.move_to_end(user.id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return devices
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+acl_cache = DeviceAuthorizationCache()
+invalidation_bus.register("acl", acl_cache.invalidate)
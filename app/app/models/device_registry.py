@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+
+from app.invalidation import invalidation_bus
+
+
+class DeviceRegistry:
+    """
+    LRU cache of existing devices and IDs of users that can use them (`{device_id: frozenset(user_ids)}`), used by MQTT ingest
+    so that messages of known devices don't need any lookup query. Up to `DEVICE_REGISTRY_SIZE` devices are loaded at startup,
+    other devices are loaded on first message (unknown device IDs are always checked in DB, so new devices are found immediately).
+    Device is evicted in all processes whenever user gets or loses access to it or device is removed.
+    """
+
+    def __init__(self):
+        self.max_size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0  # incremented by every invalidation, so that devices loaded before it aren't stored
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def init_app(self, app):
+        self.max_size = app.config["DEVICE_REGISTRY_SIZE"]
+        self.clear()
+
+    def load(self, loader):
+        """ Warms up registry with devices returned by :param loader(None, limit). """
+        if self.max_size > 0:
+            generation = self._generation
+            self._add(loader(None, self.max_size), generation)
+
+    def users(self, device_ids, loader):
+        """
+        Returns `{device_id: frozenset(user_ids)}` of devices with :param device_ids that exist, devices missing in registry
+        are loaded using single :param loader(device_ids, None) call.
+        """
+        result = {}
+        with self._lock:
+            for device_id in device_ids:
+                users = self._entries.get(device_id)
+                if users is not None:
+                    self._entries.move_to_end(device_id)
+                    result[device_id] = users
+            self.stats["hits"] += len(result)
+        missing = [device_id for device_id in device_ids if device_id not in result]
+        if missing:
+            self.stats["misses"] += len(missing)
+            generation = self._generation
+            loaded = loader(missing, None)
+            self._add(loaded, generation)
+            result.update(loaded)
+        return result
+
+    def invalidate(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+            self._generation += 1
+            self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _add(self, devices, generation):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            for device_id, users in devices.items():
+                self._entries[device_id] = users
+                self._entries.move_to_end(device_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+device_registry = DeviceRegistry()
+invalidation_bus.register("devices", device_registry.invalidate)
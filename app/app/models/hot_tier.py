@@ -0,0 +1,234 @@
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # hot tier is optional, without NumPy all queries are answered by DB
+    np = None
+
+
+class Window:
+    """
+    Immutable snapshot of indexed rows of single device - IDs and OPE encrypted `added` and `num_data` values sorted by `(added, id)`.
+    Window holds every row of device with `added` greater than `boundary` (all rows if `boundary` is None) and is valid
+    for `version` (`Device.data_version`), `removals` (`Device.data_removals`) and rows ingested up to `seq`.
+    """
+
+    __slots__ = ("version", "removals", "seq", "boundary", "ids", "added", "num_data", "_by_num")
+
+    def __init__(self, version, removals, seq, boundary, ids, added, num_data):
+        self.version = version
+        self.removals = removals
+        self.seq = seq
+        self.boundary = boundary
+        self.ids = ids
+        self.added = added
+        self.num_data = num_data
+        self._by_num = None
+
+    def by_num(self):
+        """ Returns positions of rows ordered by `(num_data, id)` (computed once per window). """
+        if self._by_num is None:
+            self._by_num = np.lexsort((self.ids, self.num_data))
+        return self._by_num
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class HotTier:
+    """
+    In-memory index of recent data of `HOT_TIER_DEVICES` most recently queried devices (LRU), each holding up to
+    `HOT_TIER_DEVICE_ROWS` rows with highest `added` (older rows are evicted). Range, latest-N and count queries that fall
+    into window are answered using `searchsorted` over sorted NumPy arrays, bodies of rows come from `row_cache`.
+
+    Rows inserted by this process (e.g. ingest inside of web app) are added to windows after commit, other processes load
+    rows ingested since window was built (`seq` greater than `Window.seq`) on next query. Window is reloaded if data of device
+    were removed. Disabled if NumPy is not installed.
+    """
+
+    def __init__(self):
+        self.max_devices = 0
+        self.max_rows = 0
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "refreshes": 0, "loads": 0, "applied": 0}
+
+    def init_app(self, app):
+        self.max_devices = app.config["HOT_TIER_DEVICES"] if np is not None else 0
+        self.max_rows = app.config["HOT_TIER_DEVICE_ROWS"]
+        self.clear()
+
+    @property
+    def enabled(self):
+        return self.max_devices > 0 and self.max_rows > 0
+
+    def holds(self, device_id):
+        return device_id in self._windows
+
+    def window(self, device, load):
+        """
+        Returns window of :param device valid for its loaded `data_version` or None if its data can't be indexed.
+        :param load(device_id, since_seq, limit) returns `(id, added, num_data, seq)` of rows ingested after `since_seq`
+        (if not None) ordered by `added` descending.
+        """
+        with self._lock:
+            window = self._windows.get(device.id)
+            if window is not None:
+                self._windows.move_to_end(device.id)
+            if window is not None and window.version == device.data_version:
+                self.stats["hits"] += 1
+                return window
+            refresh = window is not None and window.removals == device.data_removals and device.data_seq - window.seq <= self.max_rows
+            self.stats["refreshes" if refresh else "loads"] += 1
+        if refresh:
+            window = self._extend(window, load(device.id, window.seq, None), device.data_version)
+        else:
+            window = self._build(device, load(device.id, None, self.max_rows + 1))
+        if window is not None:
+            self._store(device.id, window)
+        return window
+
+    def apply(self, changes):
+        """ Adds rows inserted by committed transaction, :param changes are `(device_id, data_version before insert, rows)`. """
+        for device_id, version, rows in changes:
+            with self._lock:
+                window = self._windows.get(device_id)
+            if window is not None and window.version == version:
+                if self._store(device_id, self._extend(window, rows, version + 1), replaces=window):
+                    with self._lock:
+                        self.stats["applied"] += len(rows)
+
+    def drop(self, device_ids):
+        with self._lock:
+            for device_id in device_ids:
+                self._windows.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+    def __len__(self):
+        return len(self._windows)
+
+    def page(self, window, num_data=(None, None), added=(None, None), limit=None, after=None, order_by="id", descending=False):
+        """
+        Returns `(ids, last)` of rows in :param window matching the same arguments as `DeviceData.in_range` and `DeviceData.get_page`
+        or None if some of the rows might be outside of window.
+        """
+        lower, upper = added
+        start = 0 if lower is None else np.searchsorted(window.added, lower, "right")
+        end = len(window) if upper is None else np.searchsorted(window.added, upper, "left")
+        positions = np.arange(start, end)
+        lower, upper = num_data
+        if lower is not None:
+            positions = positions[window.num_data[positions] > lower]
+        if upper is not None:
+            positions = positions[window.num_data[positions] < upper]
+
+        ids = window.ids[positions]
+        if order_by == "id":
+            values = ids
+            order = np.argsort(ids)
+        elif order_by == "added":
+            values = window.added[positions]
+            order = np.arange(len(positions))
+        else:
+            values = window.num_data[positions]
+            order = np.lexsort((ids, values))
+        if descending:
+            order = order[::-1]
+        ids, values = ids[order], values[order]
+        if after is not None:
+            id_, value = after
+            if order_by == "id":
+                following = ids < id_ if descending else ids > id_
+            elif descending:
+                following = (values < value) | ((values == value) & (ids < id_))
+            else:
+                following = (values > value) | ((values == value) & (ids > id_))
+            ids, values = ids[following], values[following]
+
+        # Rows outside of window have lower `added`, so they can only follow rows in window ordered by `added` descending
+        if window.boundary is not None and (added[0] is None or added[0] < window.boundary) \
+                and not (order_by == "added" and descending and limit is not None and len(ids) > limit):
+            return None
+        if limit is None or len(ids) <= limit:
+            return ids.tolist(), None
+        return ids[:limit].tolist(), (int(ids[limit - 1]), None if order_by == "id" else int(values[limit - 1]))
+
+    def aggregate(self, window, column, boundaries=(), extremes=1):
+        """
+        Returns `(count, bucket_counts, lowest_ids, highest_ids)` over OPE encrypted :param column same as `DeviceData.aggregate`
+        (extremes as row IDs) or None if window doesn't hold all data of device.
+        """
+        if window.boundary is not None:
+            return None
+        if column == "added":
+            values, ids = window.added, window.ids
+        else:
+            order = window.by_num()
+            values, ids = window.num_data[order], window.ids[order]
+        bucket_counts = np.diff(np.searchsorted(values, np.array(boundaries, dtype=np.int64), "left")).tolist()
+        return len(ids), bucket_counts, ids[:extremes].tolist(), ids[::-1][:extremes].tolist()
+
+    def _build(self, device, rows):
+        """ Builds window from :param rows - up to `max_rows + 1` rows with highest `added`, ordered by `added` descending. """
+        if any(added is None or num_data is None for _, added, num_data, _ in rows):
+            return None
+        boundary = None
+        if len(rows) > self.max_rows:
+            boundary = rows[self.max_rows][1]
+            rows = [row for row in rows if row[1] > boundary]
+        seq = max([device.data_seq] + [row[3] for row in rows if row[3] is not None])
+        window = Window(device.data_version, device.data_removals, seq, boundary, *_columns(rows[::-1]))
+        return self._trim(window)
+
+    def _extend(self, window, rows, version):
+        """ Returns copy of :param window with :param rows added (rows with `added` outside of window or already present are skipped). """
+        if any(added is None or num_data is None for _, added, num_data, _ in rows):
+            return None
+        seq = max([window.seq] + [row[3] for row in rows if row[3] is not None])
+        ids, added, num_data = _columns(rows)
+        new = ~np.isin(ids, window.ids)
+        if window.boundary is not None:
+            new &= added > window.boundary
+        ids, added, num_data = (np.concatenate((old, inserted[new])) for old, inserted in
+                                ((window.ids, ids), (window.added, added), (window.num_data, num_data)))
+        order = np.lexsort((ids, added))
+        extended = Window(version, window.removals, seq, window.boundary, ids[order], added[order], num_data[order])
+        return self._trim(extended)
+
+    def _trim(self, window):
+        """ Evicts rows with lowest `added` if :param window holds more than `max_rows` rows (rows with equal `added` are evicted together). """
+        if len(window) <= self.max_rows:
+            return window
+        boundary = int(window.added[len(window) - self.max_rows - 1])
+        start = np.searchsorted(window.added, boundary, "right")
+        return Window(window.version, window.removals, window.seq, boundary, window.ids[start:], window.added[start:], window.num_data[start:])
+
+    def _store(self, device_id, window, replaces=None):
+        """
+        Stores :param window of device (drops it if None), if :param replaces is set, only if it's still current window of device
+        (window extended by `apply` must not overwrite newer window loaded meanwhile). Returns whether window was stored.
+        """
+        if window is None:
+            self.drop([device_id])
+            return False
+        with self._lock:
+            if replaces is not None and self._windows.get(device_id) is not replaces:
+                return False
+            self._windows[device_id] = window
+            self._windows.move_to_end(device_id)
+            while len(self._windows) > self.max_devices:
+                self._windows.popitem(last=False)
+        return True
+
+
+def _columns(rows):
+    """ Returns IDs, `added` and `num_data` of :param rows (`(id, added, num_data, seq)` tuples) as NumPy arrays. """
+    ids, added, num_data = (np.array([row[i] for row in rows], dtype=np.int64) for i in range(3))
+    return ids, added, num_data
+
+
+hot_tier = HotTier()
@@ -1,17 +1,19 @@
 from flask import current_app
-from itsdangerous import (TimedJSONWebSignatureSerializer as Serializer)
+from sqlalchemy import LargeBinary
+from sqlalchemy.orm import joinedload
 
 from app.app_setup import db
-from app.utils import is_number
+from app.utils import is_number, token_serializer
 
 
 class MixinGetById:
     id = db.Column(db.Integer, primary_key=True)
 
     @classmethod
-    def get_by_id(cls, id_):
+    def get_by_id(cls, id_, load=()):
+        """ :param load names relationships that should be loaded together with the object """
         if is_number(id_):
-            return db.session.query(cls).filter(cls.id == id_).first()
+            return db.session.query(cls).options(*[joinedload(getattr(cls, name)) for name in load]).filter(cls.id == id_).first()
         return None
 
 
@@ -28,11 +30,42 @@ class MixinGetUsingJWT:
 
     @classmethod
     def get_using_jwt_token(cls, token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        data = s.loads(token)
+        data = token_serializer(current_app.config['SECRET_KEY']).loads(token)
         return db.session.query(cls).filter(cls.id == data['id']).first()
 
 
 class MixinAsDict:
     def as_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+    @classmethod
+    def row_serializer(cls):
+        """ Returns `RowSerializer` for `SERIALIZED_COLUMNS` (all columns if not set) of model, it's compiled only once per model. """
+        if "_row_serializer" not in cls.__dict__:
+            cls._row_serializer = RowSerializer(cls, getattr(cls, "SERIALIZED_COLUMNS", None))
+        return cls._row_serializer
+
+
+class RowSerializer:
+    """
+    Converts rows of `query.with_entities(*serializer.columns)` to JSON serializable dicts (binary columns are decoded),
+    so that neither ORM objects nor intermediate dicts have to be created. Names, positions and types of columns are resolved
+    once from column metadata, e.g. `[("id", 0, False), ("data", 1, True)]`.
+    """
+
+    def __init__(self, model, column_names=None):
+        table_columns = [c for c in model.__table__.columns if column_names is None or c.name in column_names]
+        self.columns = [getattr(model, c.key) for c in table_columns]
+        self._spec = [(c.name, i, isinstance(c.type, LargeBinary)) for i, c in enumerate(table_columns)]
+
+    def __call__(self, row):
+        return {name: (row[i].decode() if binary and row[i] is not None else row[i]) for name, i, binary in self._spec}
+
+    def columnar(self, rows):
+        """ Converts :param rows to single dict of column name -> list of values (struct of arrays), so keys are not repeated per row. """
+        columns = list(zip(*rows)) or [()] * len(self._spec)
+        return {name: [None if v is None else v.decode() for v in columns[i]] if binary else list(columns[i]) for name, i, binary in self._spec}
+
+    def query(self, query):
+        """ Returns :param query projected to serialized columns. """
+        return query.with_entities(*self.columns)
@@ -1,12 +1,17 @@
 import datetime
+from collections import Counter
 from uuid import uuid4
-from sqlalchemy import func, and_
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import func, and_, or_, case, tuple_, event
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, object_session, Session
 
 from app.utils import is_number
 from app.app_setup import db
+from app.invalidation import invalidation_bus
+from app.models.acl_cache import acl_cache
+from app.models.device_registry import device_registry
+from app.models.hot_tier import hot_tier
 from app.models.mixins import MixinGetById, MixinAsDict, MixinGetUsingJWT, MixinGetByUsername
 
 scene_action_table = db.Table('scene_action',
@@ -31,6 +36,60 @@ class UserDevice(db.Model):
             .filter(and_(UserDevice.device_id == device_id,
                          UserDevice.user_id == user_id)).first()
 
+    @classmethod
+    def set_public_session_key(cls, device_id, user_id, public_key):
+        """ Updates session key of device shared with user using single UPDATE (without loading the row). """
+        db.session.query(UserDevice) \
+            .filter(and_(UserDevice.device_id == device_id,
+                         UserDevice.user_id == user_id)) \
+            .update({UserDevice.device_public_session_key: public_key}, synchronize_session=False)
+
+
+@event.listens_for(UserDevice, "after_insert")
+@event.listens_for(UserDevice, "after_delete")
+def _bump_user_devices_version(mapper, connection, target):
+    """ Invalidates cached authorized devices of user in all processes, as part of the same transaction. """
+    connection.execute(User.__table__.update()
+                       .where(User.__table__.c.id == target.user_id)
+                       .values(devices_version=User.__table__.c.devices_version + 1))
+    invalidation_bus.notify("acl", target.user_id, connection)
+    object_session(target).info.setdefault("acl_changed_users", set()).add(target.user_id)
+    _invalidate_device(connection, object_session(target), target.device_id)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _invalidate_changed_acls(session, transaction):
+    """ Entries loaded while transaction was in progress might contain access that was rolled back. """
+    if transaction.parent is None:
+        for user_id in session.info.pop("acl_changed_users", ()):
+            acl_cache.invalidate(user_id)
+
+
+def _invalidate_device(connection, session, device_id):
+    """ Evicts device from `device_registry` of all processes, as part of the same transaction. """
+    invalidation_bus.notify("devices", device_id, connection)
+    session.info.setdefault("registry_changed_devices", set()).add(device_id)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _invalidate_changed_devices(session, transaction):
+    """ Devices loaded by ingest while transaction was in progress might have users that were rolled back. """
+    if transaction.parent is None:
+        for device_id in session.info.pop("registry_changed_devices", ()):
+            device_registry.invalidate(device_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_hot_tier_changes(session):
+    """ Rows inserted by `DeviceData.insert_sequenced` are added to `hot_tier` of this process once they are visible to other transactions. """
+    if not session.transaction.nested:
+        hot_tier.apply(session.info.pop("hot_tier_changes", ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_hot_tier_changes(session):
+    session.info.pop("hot_tier_changes", None)
+
 
 class User(MixinGetUsingJWT, MixinGetById, db.Model):
     __tablename__ = 'user'
@@ -45,19 +104,20 @@ class User(MixinGetUsingJWT, MixinGetById, db.Model):
     devices = relationship("UserDevice", back_populates="user", cascade="all,delete")
     owned_devices = relationship("Device", back_populates="owner", cascade="all,delete")
     mqtt_creds = relationship("MQTTUser", uselist=False, cascade='all,delete', back_populates="user", passive_deletes=True)
+    devices_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # incremented when `devices` change
 
     @classmethod
     def can_use_device(cls, user, device_id):
         if not is_number(device_id):
             return False
-        q = db.session.query(
-            db.session.query(User).
-            join(UserDevice).
-            filter(User.id == user.id).
-            filter(UserDevice.device_id == device_id).
-            exists()
-        )
-        return q.scalar()
+        return int(device_id) in cls.authorized_devices(user).values()
+
+    @classmethod
+    def authorized_devices(cls, user):
+        """ Returns `{name_bi: device_id}` of all devices :param user can use, cached until user's `devices_version` changes. """
+        return acl_cache.get(user, lambda u: dict(db.session.query(Device.name_bi, UserDevice.device_id)
+                                                  .join(UserDevice)
+                                                  .filter(UserDevice.user_id == u.id)))
 
     def create_mqtt_creds_for_user(self, password, session):
         session.flush()
@@ -126,6 +186,11 @@ class Device(MixinGetById, MixinAsDict, db.Model):
 
     correctness_hash = db.Column(db.String(200), nullable=False)  # correctness_hash("name")
 
+    data_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # last ingest sequence number assigned to `data`
+    data_version = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # incremented when `data` are inserted or removed
+    data_removals = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # incremented when `data` are removed
+    payload_version = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')  # MQTT payload format used by device in key exchange
+
     def create_mqtt_creds_for_device(self, password, session):
         session.flush()
         self.mqtt_creds = MQTTUser(
@@ -168,6 +233,74 @@ class Device(MixinGetById, MixinAsDict, db.Model):
     def get_by_name_bi(cls, bi):
         return db.session.query(Device).filter(Device.name_bi == bi).first()
 
+    @classmethod
+    def get_user_ids(cls, device_ids=None, limit=None):
+        """
+        Returns `{device_id: frozenset(user_ids)}` of existing devices with :param device_ids and users that can use them
+        (or of first :param limit devices if :param device_ids is None).
+        """
+        devices = db.session.query(cls.id)
+        devices = devices.filter(cls.id.in_(device_ids)) if device_ids is not None else devices.order_by(cls.id).limit(limit)
+        result = {}
+        for device_id, user_id in db.session.query(cls.id, UserDevice.user_id).outerjoin(UserDevice, UserDevice.device_id == cls.id) \
+                .filter(cls.id.in_(devices)):
+            result.setdefault(device_id, set())
+            if user_id is not None:
+                result[device_id].add(user_id)
+        return {device_id: frozenset(user_ids) for device_id, user_ids in result.items()}
+
+    @classmethod
+    def get_payload_version(cls, device_id):
+        """ Returns MQTT payload format negotiated with device (None if device doesn't exist). """
+        return db.session.query(cls.payload_version).filter(cls.id == device_id).scalar()
+
+    @classmethod
+    def set_payload_version(cls, device_id, version):
+        """ Stores MQTT payload format of device using single UPDATE (row is not written if format didn't change). """
+        db.session.query(cls) \
+            .filter(and_(cls.id == device_id, cls.payload_version != version)) \
+            .update({cls.payload_version: version}, synchronize_session=False)
+
+    @classmethod
+    def get_authorized_by_name_bi(cls, user, bi):
+        """ Returns device with blind index :param bi if :param user can use it, otherwise None. """
+        device_id = User.authorized_devices(user).get(bi)
+        if device_id is None:
+            return None
+        return db.session.query(Device).get(device_id)
+
+    @classmethod
+    def reserve_data_seqs(cls, counts):
+        """
+        Reserves :param counts (`{device_id: number of rows}`) ingest sequence numbers for each device, returns `{device_id: (last
+        number used before, data_version before)}`. Device rows stay locked (in `id` order, so concurrent writers can't deadlock) until
+        end of transaction, hence transactions inserting data of the same device commit in sequence order and reader never skips
+        uncommitted lower number.
+        """
+        current = {device_id: (seq, version) for device_id, seq, version in
+                   db.session.query(cls.id, cls.data_seq, cls.data_version).filter(cls.id.in_(list(counts))).order_by(cls.id).with_for_update()}
+        if current:
+            db.session.execute(cls.__table__.update()
+                               .where(cls.__table__.c.id.in_(list(current)))
+                               .values(data_seq=case({device_id: seq + counts[device_id] for device_id, (seq, _) in current.items()},
+                                                     value=cls.__table__.c.id),
+                                       data_version=cls.__table__.c.data_version + 1))
+        return current
+
+    @classmethod
+    def bump_data_version(cls, device_ids):
+        """
+        Invalidates cached results of data queries of :param device_ids after their data were removed (rows are locked
+        in `id` order, as in `reserve_data_seqs`).
+        """
+        ids = [device_id for device_id, in db.session.query(cls.id).filter(cls.id.in_(list(device_ids))).order_by(cls.id).with_for_update()]
+        if ids:
+            db.session.execute(cls.__table__.update()
+                               .where(cls.__table__.c.id.in_(ids))
+                               .values(data_version=cls.__table__.c.data_version + 1,
+                                       data_removals=cls.__table__.c.data_removals + 1))
+            hot_tier.drop(ids)
+
 
 class MQTTUser(db.Model):
     __tablename__ = 'mqtt_user'
@@ -201,9 +334,20 @@ class ACL(db.Model):
     acc = db.Column(db.Integer)  # Access 1 = read-only; 2 = write-only; 3 = both
 
 
+@event.listens_for(Device, "after_delete")
+def _invalidate_deleted_device(mapper, connection, target):
+    _invalidate_device(connection, object_session(target), target.id)
+
+
 class DeviceData(MixinAsDict, db.Model):
     __tablename__ = 'device_data'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        db.Index('ix_device_data_device_id_id', 'device_id', 'id'),  # keyset pagination
+        db.Index('ix_device_data_device_id_num_data', 'device_id', 'num_data', 'id'),  # OPE range and ordered queries
+        db.Index('ix_device_data_device_id_added', 'device_id', 'added', 'id'),
+        db.Index('ix_device_data_device_id_seq', 'device_id', 'seq'),  # delta sync
+        {'extend_existing': True}
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     tid = db.Column(db.LargeBinary)
@@ -212,6 +356,7 @@ class DeviceData(MixinAsDict, db.Model):
     data = db.Column(db.LargeBinary)
     device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'))
     device = relationship("Device", back_populates="data")
+    seq = db.Column(db.BigInteger)  # ingest sequence number within device, assigned by `insert_sequenced`
 
     tid_bi = db.Column(db.String(200), unique=True, nullable=True, index=True)  # Blind index for .tid
 
@@ -219,11 +364,166 @@ class DeviceData(MixinAsDict, db.Model):
 
     @classmethod
     def delete_by_tid_bi(cls, tid_bi, device_id):
-        db.session.query(DeviceData) \
-            .filter(and_(
-                DeviceData.tid_bi == tid_bi,
-                DeviceData.device_id == device_id,
-            )).delete()
+        cls.delete_by_device_tid_bi_pairs([(device_id, tid_bi)])
+
+    @classmethod
+    def in_range(cls, device_id, num_data=(None, None), added=(None, None)):
+        """
+        Returns query for data of device with OPE encrypted `num_data` and `added` between (exclusive) given `(lower, upper)` bounds,
+        any bound might be None. Uses `(device_id, num_data)` and `(device_id, added)` indexes.
+        """
+        query = db.session.query(cls).filter(cls.device_id == device_id)
+        for column, (lower, upper) in ((cls.num_data, num_data), (cls.added, added)):
+            if lower is not None:
+                query = query.filter(column > lower)
+            if upper is not None:
+                query = query.filter(column < upper)
+        return query
+
+    SERIALIZED_COLUMNS = ("id", "tid", "added", "num_data", "data", "device_id", "tid_bi", "correctness_hash")  # `seq` is internal
+    ORDER_COLUMNS = ("id", "added", "num_data")
+    OPE_COLUMNS = ("added", "num_data")
+
+    @classmethod
+    def aggregate(cls, device_id, column, boundaries=(), extremes=1):
+        """
+        Computes aggregates of device data over OPE encrypted :param column using single SQL statement, returns
+        `(count, bucket_counts, lowest, highest)`, where `bucket_counts[i]` is number of rows with value in
+        `[boundaries[i], boundaries[i + 1])` and `lowest`/`highest` are up to :param extremes rows (tuples of
+        `row_serializer` columns) with lowest/highest value (first row holds MIN/MAX). OPE preserves order,
+        so results match aggregates over plaintexts.
+        """
+        col = getattr(cls, column)
+        buckets = [func.count(case([(and_(col >= lower, col < upper), 1)])) for lower, upper in zip(boundaries, boundaries[1:])]
+        stats = db.session.query(func.count(cls.id), *buckets).filter(cls.device_id == device_id).subquery()
+
+        def extreme_ids(*order_by):
+            return db.session.query(cls.id).filter(cls.device_id == device_id, col.isnot(None)).order_by(*order_by).limit(extremes).subquery()
+
+        serializer = cls.row_serializer()
+        result = db.session.query(*stats.c, *serializer.columns).select_from(stats) \
+            .outerjoin(cls, or_(cls.id.in_(extreme_ids(col, cls.id)), cls.id.in_(extreme_ids(col.desc(), cls.id.desc())))).all()
+
+        stats_len = len(stats.c)
+        col_index, id_index = (serializer.columns.index(c) for c in (col, cls.id))
+        rows = sorted((row[stats_len:] for row in result if row[stats_len + id_index] is not None), key=lambda row: (row[col_index], row[id_index]))
+        return result[0][0], list(result[0][1:stats_len]), rows[:extremes], rows[::-1][:extremes]
+
+    @classmethod
+    def get_page(cls, query, limit=None, after=None, order_by="id", descending=False):
+        """
+        Returns rows of :param query ordered by :param order_by column (`id`, or OPE encrypted `added` or `num_data`, ties are
+        ordered by `id`) that follow :param after `(id, value)` position (keyset pagination) and position of last returned row
+        if more rows follow (otherwise None). All rows are returned if :param limit is None.
+        """
+        query = cls._after(query, after, order_by, descending)
+        if limit is None:
+            return query.all(), None
+        rows = query.limit(limit + 1).all()
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            return rows[:limit], (last.id, None if order_by == "id" else getattr(last, order_by))
+        return rows, None
+
+    @classmethod
+    def stream(cls, query, limit=None, after=None, chunk_size=1000, order_by="id", descending=False):
+        """ Iterates over rows of :param query (ordered as in `get_page`) fetching :param chunk_size rows at once from server-side cursor. """
+        query = cls._after(query, after, order_by, descending)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.yield_per(chunk_size)
+
+    @classmethod
+    def _after(cls, query, after, order_by="id", descending=False):
+        """ OPE preserves order, so ordering by encrypted column orders by plaintext, it's served by `(device_id, <column>, id)` indexes. """
+        columns = [cls.id] if order_by == "id" else [getattr(cls, order_by), cls.id]
+        if after is not None:
+            id_, value = after
+            key, position = (cls.id, id_) if order_by == "id" else (tuple_(*columns), tuple_(value, id_))
+            query = query.filter(key < position if descending else key > position)
+        return query.order_by(*[c.desc() if descending else c for c in columns])
+
+    @classmethod
+    def insert_many(cls, rows, chunk_size=1000, skip_duplicates=False):
+        """
+        Inserts :param rows (list of column -> value dicts) using multi-row `INSERT ... VALUES (...), (...)` statements, returns number
+        of inserted rows. With :param skip_duplicates rows with `tid_bi` that is already present (e.g. message redelivered
+        by broker or resent by device) are skipped instead of failing whole statement (`ON CONFLICT (tid_bi) DO NOTHING`).
+        """
+        insert = cls.__table__.insert()
+        if skip_duplicates:
+            if db.session.get_bind().dialect.name == "postgresql":
+                insert = pg_insert(cls.__table__).on_conflict_do_nothing(index_elements=[cls.__table__.c.tid_bi])
+            else:
+                rows = cls._without_duplicates(rows)
+        inserted = 0
+        for i in range(0, len(rows), chunk_size):
+            inserted += db.session.execute(insert.values(rows[i:i + chunk_size])).rowcount
+        return inserted
+
+    @classmethod
+    def _without_duplicates(cls, rows):
+        """ Returns :param rows without rows with `tid_bi` already present in DB or in preceding row (used by other DBs than PostgreSQL). """
+        seen = {tid_bi for tid_bi, in db.session.query(cls.tid_bi).filter(cls.tid_bi.in_({row["tid_bi"] for row in rows if row["tid_bi"] is not None}))}
+        result = []
+        for row in rows:
+            if row["tid_bi"] is None or row["tid_bi"] not in seen:
+                seen.add(row["tid_bi"])
+                result.append(row)
+        return result
+
+    @classmethod
+    def insert_sequenced(cls, rows, chunk_size=1000, skip_duplicates=False):
+        """
+        Assigns each of :param rows next ingest sequence number (`seq`) of its device and inserts them using `insert_many`, returns
+        `(inserted, rejected)` - number of inserted rows (skipped duplicates leave gaps in sequence) and number of rows skipped because
+        their device doesn't exist (e.g. it was removed after rows were received). Inserted rows of devices held in `hot_tier` are added
+        to it after commit.
+        """
+        reserved = Device.reserve_data_seqs(Counter(row["device_id"] for row in rows))
+        rejected = len(rows)
+        rows = [row for row in rows if row["device_id"] in reserved]
+        rejected -= len(rows)
+        last = {device_id: seq for device_id, (seq, _) in reserved.items()}
+        for row in rows:
+            last[row["device_id"]] += 1
+            row["seq"] = last[row["device_id"]]
+        inserted = cls.insert_many(rows, chunk_size, skip_duplicates)
+
+        held = [device_id for device_id in reserved if hot_tier.holds(device_id)]
+        if held:
+            new_rows = db.session.query(cls.device_id, cls.id, cls.added, cls.num_data, cls.seq) \
+                .filter(or_(*[and_(cls.device_id == device_id, cls.seq > reserved[device_id][0]) for device_id in held])).all()
+            db.session.info.setdefault("hot_tier_changes", []).extend(
+                (device_id, reserved[device_id][1], [row[1:] for row in new_rows if row[0] == device_id]) for device_id in held)
+        return inserted, rejected
+
+    @classmethod
+    def hot_rows(cls, device_id, since_seq=None, limit=None):
+        """ Returns `(id, added, num_data, seq)` of rows of device ingested after :param since_seq (if not None), newest `added` first. """
+        query = db.session.query(cls.id, cls.added, cls.num_data, cls.seq).filter(cls.device_id == device_id)
+        if since_seq is not None:
+            query = query.filter(cls.seq > since_seq)  # served by `(device_id, seq)` index
+        return query.order_by(cls.added.desc(), cls.id.desc()).limit(limit).all()
+
+    @classmethod
+    def delete_by_device_tid_bi_pairs(cls, pairs):
+        """
+        Deletes all rows matching any of :param pairs (list of `(device_id, tid_bi)` tuples) using single DELETE, bumps
+        `data_version` of affected devices and evicts rows from `row_cache` of all processes (IDs are sent in chunks,
+        so they fit into `NOTIFY` payload).
+        """
+        condition = tuple_(cls.device_id, cls.tid_bi).in_(pairs)
+        if db.session.get_bind().dialect.name == "postgresql":
+            deleted = db.session.execute(cls.__table__.delete().where(condition).returning(cls.__table__.c.id, cls.__table__.c.device_id)).fetchall()
+        else:
+            deleted = db.session.query(cls.id, cls.device_id).filter(condition).all()
+            db.session.query(cls).filter(condition).delete(synchronize_session=False)
+        if deleted:
+            Device.bump_data_version({device_id for _, device_id in deleted})
+        ids = [id_ for id_, _ in deleted]
+        for i in range(0, len(ids), 500):
+            invalidation_bus.notify("rows", ids[i:i + 500])
 
 
 class Action(MixinGetById, db.Model):
@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+
+
+class RangeResultCache:
+    """
+    LRU cache of encoded responses of device data range queries. Each entry remembers `Device.data_version` it was
+    computed for, the version is incremented in DB whenever data of device are inserted or removed, so stale entries
+    stop matching in every worker process and repeated query costs only comparison with version of already loaded device.
+    Responses larger than `RANGE_CACHE_MAX_BODY_SIZE` bytes are not cached.
+    """
+
+    def __init__(self):
+        self.max_size = 0
+        self.max_body_size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def init_app(self, app):
+        self.max_size = app.config["RANGE_CACHE_SIZE"]
+        self.max_body_size = app.config["RANGE_CACHE_MAX_BODY_SIZE"]
+        self.clear()
+
+    def get(self, key, version):
+        """ Returns `(body, mimetype)` cached under :param key if it was computed for data :param version, otherwise None. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+
+    def add(self, key, version, body, mimetype):
+        if self.max_size <= 0 or len(body) > self.max_body_size:
+            return
+        with self._lock:
+            self._entries[key] = (version, (body, mimetype))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+range_cache = RangeResultCache()
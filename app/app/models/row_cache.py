@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+from app.invalidation import invalidation_bus
+
+
+class SerializedRowCache:
+    """
+    LRU cache of device data rows already encoded for responses (JSON or MessagePack fragment of single row object),
+    keyed by row ID. Rows are never updated after insert, so entries stay valid until row is removed, removals
+    evict them in every worker process (`DeviceData.delete_by_device_tid_bi_pairs`). Responses are assembled
+    by concatenating cached fragments, so rows read by many users are serialized only once.
+    """
+
+    def __init__(self):
+        self.max_size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def init_app(self, app):
+        self.max_size = app.config["ROW_CACHE_SIZE"]
+        self.clear()
+
+    def get_many(self, mimetype, ids):
+        """ Returns `{id: fragment}` of rows with :param ids that are cached encoded as :param mimetype. """
+        result = {}
+        with self._lock:
+            for id_ in ids:
+                fragment = self._entries.get(id_, {}).get(mimetype)
+                if fragment is not None:
+                    self._entries.move_to_end(id_)
+                    result[id_] = fragment
+            self.stats["hits"] += len(result)
+            self.stats["misses"] += len(ids) - len(result)
+        return result
+
+    def add(self, mimetype, id_, fragment):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries.setdefault(id_, {})[mimetype] = fragment
+            self._entries.move_to_end(id_)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, ids):
+        with self._lock:
+            for id_ in ids:
+                self._entries.pop(id_, None)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+row_cache = SerializedRowCache()
+invalidation_bus.register("rows", row_cache.evict)
@@ -1 +1,2 @@
-from .mqtt import handle_on_connect, handle_on_log, handle_on_publish, handle_on_message
+from .mqtt import handle_on_connect, handle_on_log, handle_on_publish, handle_on_message, ingest_topics
+from .ingest import ingest_buffer
@@ -0,0 +1,211 @@
+import threading
+import time
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy.exc import IntegrityError
+
+from app.models.device_registry import device_registry
+from app.models.models import Device, DeviceData
+from app.mqtt.spool import Spool
+
+SAVE_DATA = "save_data"
+REMOVE_DATA = "remove_data"
+MAX_RETRY_DELAY = 30  # seconds between attempts to write spooled messages while DB is unavailable
+
+
+class IngestBuffer:
+    """
+    Collects `save_data` and `remove_data` messages received from devices and writes them to DB in batches.
+    Consecutive saves are written using multi-row INSERT, consecutive removals using single set-based DELETE
+    and whole batch is committed in one transaction (order of operations is preserved). Saved rows get ingest
+    sequence numbers of their devices (`DeviceData.seq`), which are used by clients for delta sync. Rows that were
+    already saved (same `tid_bi`, e.g. QoS 1 redelivery or retry of device) are skipped and counted as `duplicates`.
+
+    Batch is flushed when `INGEST_BATCH_SIZE` messages are buffered or every `INGEST_FLUSH_INTERVAL` milliseconds
+    (scheduled in `create_app`), whichever comes first. Remaining messages are flushed on shutdown.
+
+    With `INGEST_SPOOL_DIR` set, messages are appended to on-disk `Spool` instead and receiving thread never waits for DB.
+    Scheduled flush replays them in batches of `INGEST_BATCH_SIZE`, at most `INGEST_SPOOL_REPLAY_BATCHES` batches at once,
+    so that recovering DB isn't flooded by backlog. While DB is unavailable, delay between attempts doubles up to `MAX_RETRY_DELAY`.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.db = None
+        self.batch_size = 1
+        self.max_pending = None
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.spool = None
+        self.replay_batches = 1
+        self._retry_delay = 0
+        self._retry_at = 0
+        self.stats = {"received": 0, "flushes": 0, "commits": 0, "inserted": 0, "duplicates": 0, "removed": 0, "rejected": 0, "dropped": 0}
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.batch_size = max(1, app.config["INGEST_BATCH_SIZE"])
+        self.max_pending = app.config["INGEST_MAX_PENDING"]
+        if app.config["INGEST_SPOOL_DIR"]:
+            self.spool = Spool(app.config["INGEST_SPOOL_DIR"], app.config["INGEST_SPOOL_FSYNC"], app.config["INGEST_SPOOL_SEGMENT_SIZE"],
+                               app.config["INGEST_SPOOL_MAX_SIZE"] or None)
+            self.replay_batches = max(1, app.config["INGEST_SPOOL_REPLAY_BATCHES"])
+
+    def add(self, device_id, action, payload):
+        """ Converts :param payload to DB row and buffers it, raises `KeyError`/`ValueError` if payload is malformed. """
+        if action == SAVE_DATA:
+            op = (device_id, action, _payload_to_row(device_id, payload))
+        elif action == REMOVE_DATA:
+            op = (device_id, action, payload["tid_bi"])
+        else:
+            raise ValueError(f"Unknown action: {action}")
+        if self.spool is not None:
+            appended = self.spool.append(op)
+            with self._lock:
+                self.stats["received"] += 1
+                if not appended:
+                    self.stats["dropped"] += 1
+            return
+        with self._lock:
+            self._pending.append(op)
+            self.stats["received"] += 1
+            should_flush = len(self._pending) >= self.batch_size
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """ Writes all buffered messages to DB, returns number of messages that were processed. """
+        if self.spool is not None:
+            return self._replay()
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            self.stats["flushes"] += 1
+            with self.app.app_context():
+                try:
+                    self._process(batch)
+                except Exception as e:  # DB is unavailable, keep messages for next flush
+                    self.db.session.rollback()
+                    self._requeue(batch)
+                    print(f"Failed to flush {len(batch)} messages: {repr(e)}", flush=True)
+            return len(batch)
+
+    def close(self):
+        """ Closes spool, messages that weren't written to DB yet are replayed on next start. """
+        if self.spool is not None:
+            self.spool.close()
+
+    def pending(self):
+        if self.spool is not None:
+            return len(self.spool)
+        with self._lock:
+            return len(self._pending)
+
+    def _replay(self):
+        """ Writes up to `replay_batches` batches of spooled messages to DB, checkpoint of spool is moved after each commit. """
+        processed = 0
+        with self._flush_lock:
+            self.spool.sync()
+            if time.monotonic() < self._retry_at:
+                return 0
+            for _ in range(self.replay_batches):
+                batch, position = self.spool.read(self.batch_size)
+                if not batch:
+                    break
+                self.stats["flushes"] += 1
+                with self.app.app_context():
+                    try:
+                        self._process([tuple(op) for op in batch])
+                    except Exception as e:  # DB is unavailable, messages stay in spool
+                        self.db.session.rollback()
+                        self._retry_delay = min(MAX_RETRY_DELAY, max(2 * self._retry_delay, self.app.config["INGEST_FLUSH_INTERVAL"] / 1000))
+                        self._retry_at = time.monotonic() + self._retry_delay
+                        print(f"Failed to replay {len(batch)} spooled messages, retrying in {self._retry_delay:.1f}s: {repr(e)}", flush=True)
+                        break
+                self.spool.commit(position, len(batch))
+                self._retry_delay = 0
+                processed += len(batch)
+        return processed
+
+    def _process(self, batch):
+        """ Writes :param batch in one transaction, conflicting batch is retried message by message. """
+        batch = self._filter_existing(batch)
+        try:
+            self._write(batch)
+        except IntegrityError:
+            self.db.session.rollback()
+            self._write_one_by_one(batch)
+
+    def _filter_existing(self, batch):
+        existing = device_registry.users({device_id for device_id, _, _ in batch}, Device.get_user_ids)
+        valid = []
+        for op in batch:
+            if op[0] in existing:
+                valid.append(op)
+            else:
+                self.stats["rejected"] += 1
+                print(f"Device with id: {op[0]} doesn't exist.", flush=True)
+        return valid
+
+    def _write(self, batch):
+        if not batch:
+            return
+        duplicates, rejected = 0, 0
+        for action, run in groupby(batch, key=itemgetter(1)):
+            run = list(run)
+            if action == SAVE_DATA:
+                inserted, missing = DeviceData.insert_sequenced([row for _, _, row in run], skip_duplicates=True)
+                duplicates += len(run) - missing - inserted
+                rejected += missing
+            else:
+                DeviceData.delete_by_device_tid_bi_pairs([(device_id, tid_bi) for device_id, _, tid_bi in run])
+        self.db.session.commit()
+        self.stats["commits"] += 1
+        if rejected:
+            print(f"Rejected {rejected} messages of removed devices.", flush=True)
+        self._count_written(batch, duplicates, rejected)
+
+    def _write_one_by_one(self, batch):
+        """ Fallback used when batch contains row violating constraint, so that single message can't discard whole batch. """
+        for op in batch:
+            try:
+                self._write([op])
+            except IntegrityError as e:
+                self.db.session.rollback()
+                self.stats["rejected"] += 1
+                print(f"Rejected message from device {op[0]}: {e.orig}", flush=True)
+
+    def _requeue(self, batch):
+        with self._lock:
+            self._pending[:0] = batch
+            overflow = len(self._pending) - self.max_pending if self.max_pending else 0
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.stats["dropped"] += overflow
+
+    def _count_written(self, ops, duplicates, rejected):
+        for op in ops:
+            self.stats["inserted" if op[1] == SAVE_DATA else "removed"] += 1
+        self.stats["inserted"] -= duplicates + rejected
+        self.stats["duplicates"] += duplicates
+        self.stats["rejected"] += rejected
+
+
+def _payload_to_row(device_id, payload):
+    return {
+        "tid": str.encode(payload["tid"]),
+        "tid_bi": payload["tid_bi"],
+        "data": str.encode(payload["data"]),
+        "device_id": device_id,
+        "correctness_hash": payload["correctness_hash"],
+        "num_data": int(payload["num_data"]),
+        "added": int(payload["added"])
+    }
+
+
+ingest_buffer = IngestBuffer()
@@ -1,80 +1,83 @@
-from flask import current_app
+from functools import partial
 
-from app.models.models import Device, DeviceData, User
+from app.models.device_registry import device_registry
+from app.models.models import Device, UserDevice
+from app.mqtt.ingest import ingest_buffer, SAVE_DATA, REMOVE_DATA
+from app.mqtt.parser import parse_payload, route_topic
 from app.mqtt.utils import Payload
-from app.utils import bytes_to_json, is_number
+from app.utils import is_number, payload_version
+
+# Topics published by devices to server (`d:<id>/server` and `d:<id>/server/<action>`), MQTT wildcards can't match
+# part of topic level, so sender type is checked in `handle_on_message`
+INGEST_TOPICS = ["+/server", "+/server/+"]
+
+
+def ingest_topics():
+    """ Returns topic filters for device messages sent to server. """
+    return list(INGEST_TOPICS)
 
 
 # The callback for when the client receives a CONNACK response from the server.
-def handle_on_connect(client, userdata, flags, rc):
+def handle_on_connect(client, userdata, flags, rc, topics):
     print("Connected with result code " + str(rc), flush=True)
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe("#")
+    if topics:
+        client.subscribe([(topic, 1) for topic in topics])
 
 
 # The callback for when a PUBLISH message is received from the server.
 def handle_on_message(client, userdata, msg, app, db):
-    try:
-        msg.payload = bytes_to_json(msg.payload)
-        print("Received message '" + str(msg.payload) + "' on topic '" + msg.topic + "' with QoS " + str(msg.qos), flush=True)
-    except:
-        print("Received invalid message '" + str(msg.payload) + "' on topic '" + msg.topic + "' with QoS " + str(msg.qos), flush=True)
+    payload, version = parse_payload(msg.payload), payload_version(msg.payload)
+    if payload is None:
+        print(f"Received invalid message '{msg.payload}' on topic '{msg.topic}' with QoS {msg.qos}", flush=True)
         return
-    if msg.topic.endswith("/"):
-        msg.topic = msg.topic[:-1].encode()
-    topic = msg.topic.split("/")
-    if len(topic) >= 2 and topic[1] == "server":
-        t, sender_id = topic[0].split(":")
-        if t == "d" and is_number(sender_id):
-            if len(topic) == 2:
-                _save_device_pk(int(sender_id), msg, app, db)
-            elif len(topic) == 3:
-                if topic[2] in ["save_data", "remove_data"]:
-                    _edit_device_data(int(sender_id), topic[2], msg, app, db)
-                else:
-                    print(f"Invalid topic: {msg.topic}", flush=True)
+    msg.payload = payload
+    if app.config["MQTT_LOG_MESSAGES"]:
+        print(f"Received message '{payload}' on topic '{msg.topic}' with QoS {msg.qos}", flush=True)
+
+    route, error = route_topic(msg.topic)
+    if error is not None:
+        print(error, flush=True)
+    elif route is not None:
+        device_id, action = route
+        handler = TOPIC_HANDLERS.get(action)
+        if handler is None:
+            print(f"Invalid topic: {msg.topic}", flush=True)
         else:
-            print(f"Invalid Device type or ID", flush=True)
+            handler(device_id, payload, app, db, version)
 
 
-def _save_device_pk(sender_id, msg, app, db):
-    payload = Payload(**msg.payload)
+def _save_device_pk(sender_id, payload, app, db, version):
+    """ Stores public key sent by device in key exchange, format of the message is used for messages sent to device later on. """
+    payload = Payload(**payload)
     with app.app_context():
-        user = User.get_by_id(payload.user_id)
-        user_device = next((d for d in user.devices if d.device_id == sender_id), None)
-        if user_device:
-            user_device.device_public_session_key = payload.device_public_key
-            db.session.add(user_device)
+        users = device_registry.users([sender_id], Device.get_user_ids).get(sender_id, frozenset())
+        if is_number(payload.user_id) and int(payload.user_id) in users:
+            UserDevice.set_public_session_key(sender_id, int(payload.user_id), payload.device_public_key)
+            Device.set_payload_version(sender_id, version)
             db.session.commit()
         else:
             print(f"This User can't access device {sender_id}", flush=True)
 
 
-def _edit_device_data(device_id, action, msg, app, db):
-    with app.app_context():
-        device = db.session.query(Device).filter(Device.id == device_id).first()
-        if device is not None:
-            if action == "save_data":
-                # noinspection PyArgumentList
-                db.session.add(DeviceData(
-                        tid=str.encode(msg.payload["tid"]),
-                        tid_bi=msg.payload["tid_bi"],
-                        data=str.encode(msg.payload["data"]),
-                        device=device,
-                        correctness_hash=msg.payload["correctness_hash"],
-                        num_data=int(msg.payload["num_data"]),
-                        added=int(msg.payload["added"])
-                    ))
-            else:
-                DeviceData.delete_by_tid_bi(msg.payload["tid_bi"], device_id)
-            db.session.commit()
-        else:
-            print(f"Device with id: {device_id} doesn't exist.", flush=True)
+def _edit_device_data(action, device_id, payload, app, db, version):
+    try:
+        ingest_buffer.add(device_id, action, payload)
+    except (KeyError, ValueError, TypeError):
+        print(f"Invalid payload for {action} from device {device_id}.", flush=True)
+
+
+# Handlers of device messages by action in topic (`d:<id>/server/<action>`, None for `d:<id>/server`)
+TOPIC_HANDLERS = {
+    None: _save_device_pk,
+    SAVE_DATA: partial(_edit_device_data, SAVE_DATA),
+    REMOVE_DATA: partial(_edit_device_data, REMOVE_DATA),
+}
 
 
-def handle_on_log(client, userdata, level, buf):
-    if not current_app.testing:
+def handle_on_log(client, userdata, level, buf, app):
+    if not app.testing:  # called from network loop thread, outside of application context
         print("[ON LOG]: level: {} data: {}".format(level, buf), flush=True)
 
 
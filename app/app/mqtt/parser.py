@@ -0,0 +1,86 @@
+import json
+import re
+from functools import lru_cache
+
+import msgpack
+
+from app.utils import BINARY_PAYLOAD_MAGIC, BINARY_PAYLOAD_VERSION
+
+# Payloads sent by devices are flat objects of string or integer values, written either as JSON or with single quotes
+# (e.g. `{'added': 6987, 'tid_bi': '...'}`), optionally wrapped in double quotes. String values might contain raw new lines
+# (PEM keys). Framing and quoting are checked in place, before payload is copied. Devices that negotiated binary format send
+# the same objects in envelope (`app.utils.encode_payload`).
+MAX_PAYLOAD_SIZE = 64 * 1024
+_SINGLE_TO_DOUBLE_QUOTES = bytes.maketrans(b"'", b'"')
+_DECODER = json.JSONDecoder(strict=False)
+
+# Topics published by devices to server: `d:<id>/server` (public key exchange) and `d:<id>/server/<action>`
+SERVER_TOPIC_PATTERN = re.compile(r"(?P<type>[^/:]*):(?P<id>[^/]*)/server(?:/(?P<action>[^/]+))?/?")
+DEVICE_TOPIC_ERROR = "Invalid Device type or ID"
+
+
+def parse_payload(payload):
+    """
+    Returns dict parsed from :param payload (`bytes`, `bytearray` or `memoryview`) or None if it's malformed - too large,
+    not single object, mixes quote styles, has unknown envelope version or contains other values than strings and integers.
+    """
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
+    start, end = 0, len(payload)
+    if end > MAX_PAYLOAD_SIZE:
+        return None
+    if end >= 2 and payload[0] == BINARY_PAYLOAD_MAGIC:
+        return _parse_envelope(payload)
+    if end >= 2 and payload[0] == 0x22 and payload[-1] == 0x22:  # `"{...}"`
+        start, end = 1, end - 1
+    if end - start < 2 or payload[start] != 0x7b or payload[end - 1] != 0x7d:  # `{...}`
+        return None
+    single_quoted = payload.find(b"'", start, end) != -1
+    if single_quoted and payload.find(b'"', start, end) != -1:
+        return None
+    data = payload[start:end] if end - start != len(payload) else payload
+    if single_quoted:
+        data = data.translate(_SINGLE_TO_DOUBLE_QUOTES)
+    try:
+        text = data.decode()
+        result, parsed_end = _DECODER.raw_decode(text)
+    except ValueError:  # invalid JSON or UTF-8
+        return None
+    if parsed_end != len(text) or type(result) is not dict:
+        return None
+    return _flat(result)
+
+
+def _parse_envelope(payload):
+    if payload[1] != BINARY_PAYLOAD_VERSION:
+        return None
+    try:
+        result = msgpack.unpackb(payload[2:], raw=False)
+    except (ValueError, TypeError, msgpack.UnpackException):  # invalid msgpack or UTF-8, trailing data, unhashable key
+        return None
+    if type(result) is not dict or not all(type(key) is str for key in result):
+        return None
+    return _flat(result)
+
+
+def _flat(result):
+    """ Returns :param result if all its values are strings or integers, otherwise None. """
+    for value in result.values():
+        if type(value) is not str and type(value) is not int:  # `bool` and nested values are rejected too
+            return None
+    return result
+
+
+@lru_cache(maxsize=65536)
+def route_topic(topic):
+    """
+    Returns `((device_id, action), error)` of device message sent to server on :param topic (`action` is None for public key
+    exchange), `(None, None)` if topic isn't sent to server or `(None, error message)` if sender isn't valid device.
+    Devices publish to few topics each, so results are cached.
+    """
+    match = SERVER_TOPIC_PATTERN.fullmatch(topic)
+    if match is None:
+        return None, None
+    if match.group("type") != "d" or not match.group("id").isdecimal():
+        return None, DEVICE_TOPIC_ERROR
+    return (int(match.group("id")), match.group("action")), None
@@ -0,0 +1,184 @@
+import fcntl
+import os
+import struct
+import threading
+import zlib
+
+import msgpack
+
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+
+_HEADER = struct.Struct("<II")  # length and CRC32 of record body
+_SEGMENT_SUFFIX = ".seg"
+_CHECKPOINT = "checkpoint"
+_LOCK = "lock"
+
+
+class Spool:
+    """
+    Append-only on-disk queue of received device messages (ingest operations), kept between MQTT receive and DB write,
+    so that ingest keeps accepting data while DB is slow or down. Messages are appended to segment files
+    (`<id>.seg`, new one is started after `segment_size` bytes) as length and CRC prefixed msgpack records,
+    reader starts at checkpoint (`(segment id, offset)` of first message not yet written to DB) that is moved
+    by `commit` once messages are committed, segments before checkpoint are removed.
+
+    :param fsync controls durability of appended messages - `always` (every message, survives power loss),
+    `interval` (on every `sync`, i.e. every ingest flush) or `never` (left to OS, survives only crash of process).
+    Messages after checkpoint are replayed after restart, so message might be written to DB twice (ingest is idempotent).
+    Directory is locked, every process needs its own.
+    """
+
+    def __init__(self, path, fsync=FSYNC_INTERVAL, segment_size=16 * 1024 * 1024, max_size=None):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f"Invalid fsync policy: {fsync}")
+        self.path = path
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, _LOCK), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"Spool directory {path} is used by another process")
+        self._tail = None
+        self._recover()
+
+    def append(self, op):
+        """ Appends :param op (msgpack serializable), returns False if spool is full. """
+        body = msgpack.packb(op, use_bin_type=True)
+        record = _HEADER.pack(len(body), zlib.crc32(body)) + body
+        with self._lock:
+            if self.max_size is not None and self._size + len(record) > self.max_size:
+                return False
+            if self._tail_size > 0 and self._tail_size + len(record) > self.segment_size:
+                self._rotate()
+            self._tail.write(record)
+            if self.fsync == FSYNC_ALWAYS:
+                os.fsync(self._tail.fileno())
+            self._tail_size += len(record)
+            self._size += len(record)
+            self._pending += 1
+        return True
+
+    def read(self, limit):
+        """ Returns `(ops, position)` - up to :param limit oldest uncommitted messages and position to `commit` after they are written. """
+        ops = []
+        with self._lock:
+            segment_id, offset = self._checkpoint
+            while len(ops) < limit:
+                with open(self._segment_path(segment_id), "rb") as segment:
+                    segment.seek(offset)
+                    for body, end in _records(segment, offset, limit - len(ops)):
+                        ops.append(msgpack.unpackb(body, raw=False))
+                        offset = end
+                if len(ops) >= limit or segment_id == self._tail_id:
+                    break
+                segment_id, offset = segment_id + 1, 0
+        return ops, (segment_id, offset)
+
+    def commit(self, position, count):
+        """ Moves checkpoint to :param position returned by `read` after :param count messages were written, removes passed segments. """
+        with self._lock:
+            self._write_checkpoint(position)
+            for segment_id in range(self._checkpoint[0], position[0]):
+                self._size -= os.path.getsize(self._segment_path(segment_id))
+                os.remove(self._segment_path(segment_id))
+            self._checkpoint = position
+            self._pending -= count
+
+    def sync(self):
+        """ Forces appended messages to disk (with `interval` fsync policy). """
+        if self.fsync == FSYNC_INTERVAL:
+            with self._lock:
+                os.fsync(self._tail.fileno())
+
+    def close(self):
+        with self._lock:
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._tail.fileno())
+            self._tail.close()
+        self._lock_file.close()
+
+    @property
+    def size(self):
+        """ Bytes held by segments on disk. """
+        return self._size
+
+    def __len__(self):
+        """ Number of messages not yet committed. """
+        return self._pending
+
+    def _recover(self):
+        """ Loads checkpoint, removes passed segments and truncates torn record at the end of last segment (left by crash). """
+        segment_ids = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.path) if name.endswith(_SEGMENT_SUFFIX))
+        checkpoint = self._read_checkpoint()
+        if checkpoint is None or checkpoint[0] not in segment_ids:
+            checkpoint = (segment_ids[0], 0) if segment_ids else (0, 0)
+        for segment_id in [segment_id for segment_id in segment_ids if segment_id < checkpoint[0]]:
+            os.remove(self._segment_path(segment_id))
+        segment_ids = [segment_id for segment_id in segment_ids if segment_id >= checkpoint[0]] or [checkpoint[0]]
+
+        self._checkpoint = checkpoint
+        self._tail_id = segment_ids[-1]
+        self._pending = 0
+        for segment_id in segment_ids:
+            offset = checkpoint[1] if segment_id == checkpoint[0] else 0
+            with open(self._segment_path(segment_id), "ab+") as segment:
+                segment.seek(offset)
+                for _, offset in _records(segment, offset):
+                    self._pending += 1
+                if segment_id == self._tail_id:
+                    segment.truncate(offset)
+        self._tail = open(self._segment_path(self._tail_id), "ab", buffering=0)
+        self._tail_size = os.path.getsize(self._segment_path(self._tail_id))
+        self._size = sum(os.path.getsize(self._segment_path(segment_id)) for segment_id in segment_ids)
+
+    def _rotate(self):
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self._tail.fileno())
+        self._tail.close()
+        self._tail_id += 1
+        self._tail = open(self._segment_path(self._tail_id), "ab", buffering=0)
+        self._tail_size = 0
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.path, _CHECKPOINT)) as checkpoint:
+                segment_id, offset = checkpoint.read().split()
+                return int(segment_id), int(offset)
+        except (OSError, ValueError):
+            return None
+
+    def _write_checkpoint(self, position):
+        """ Replaces checkpoint file atomically, so that crash leaves either old or new checkpoint. """
+        temporary = os.path.join(self.path, _CHECKPOINT + ".tmp")
+        with open(temporary, "w") as checkpoint:
+            checkpoint.write(f"{position[0]} {position[1]}")
+            if self.fsync == FSYNC_ALWAYS:
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+        os.replace(temporary, os.path.join(self.path, _CHECKPOINT))
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.path, f"{segment_id:016d}{_SEGMENT_SUFFIX}")
+
+
+def _records(segment, offset, limit=None):
+    """ Yields `(body, end offset)` of valid records of :param segment read from :param offset, stops at torn or corrupted record. """
+    count = 0
+    while limit is None or count < limit:
+        header = segment.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        length, checksum = _HEADER.unpack(header)
+        body = segment.read(length)
+        if len(body) < length or zlib.crc32(body) != checksum:
+            return
+        offset += _HEADER.size + length
+        count += 1
+        yield body, offset
@@ -1,6 +1,8 @@
 import json
 from datetime import date, datetime
 
+from app.utils import LEGACY_PAYLOAD_VERSION, encode_payload
+
 
 class Payload:
 
@@ -9,22 +11,22 @@ class Payload:
             setattr(self, key, value)
 
     def __bytes__(self):
-        result = b'{'
-        for attr, value in self.__dict__.items():
-            result += b'\'%s\': \'%s\', ' % (attr.encode('utf-8'), convert_based_on_type(value).encode('utf-8'))
-        return result[:-2] + b'}'
+        return b'{%s}' % b', '.join(b'\'%s\': \'%s\'' % (attr.encode('utf-8'), convert_based_on_type(value).encode('utf-8'))
+                                    for attr, value in self.__dict__.items())
 
     def __str__(self):
-        result = '{'
-        for attr, value in self.__dict__.items():
-            value = convert_based_on_type(value).replace("\\", "\\\\")
-            result = f'{result}\"{attr}\": \"{value}\", '
-        result = result[:-2] + '}'
-        return json.dumps(json.loads(result, strict=False), indent=4)
+        return json.dumps({attr: convert_based_on_type(value) for attr, value in self.__dict__.items()}, indent=4)
 
     def __repr__(self):
         return f'Payload: {self.__str__()}'
 
+    def encode(self, version=LEGACY_PAYLOAD_VERSION):
+        """ Returns payload in format of :param version, legacy payload is wrapped in double quotes. """
+        if version == LEGACY_PAYLOAD_VERSION:
+            return b'"%s"' % bytes(self)
+        return encode_payload({attr: value if isinstance(value, (int, str)) else convert_based_on_type(value)
+                               for attr, value in self.__dict__.items()}, version)
+
 
 def convert_based_on_type(value):
     if isinstance(value, int):
@@ -0,0 +1,136 @@
+import os
+import queue
+import threading
+import uuid
+import zlib
+
+import click
+import paho.mqtt.client as mqtt
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from app.app_setup import create_ingest_app, configure_mqtt_client, db
+from app.invalidation import invalidation_bus
+from app.mqtt.ingest import ingest_buffer
+from app.mqtt.mqtt import handle_on_connect, handle_on_log, handle_on_message, ingest_topics
+
+_STOP = object()
+
+
+def sender_of(topic):
+    """ Returns sender part of topic (e.g. `d:23` for `d:23/server/save_data`), topic might be either `str` or `bytes`. """
+    if isinstance(topic, str):
+        topic = topic.encode()
+    return topic.split(b"/", 1)[0]
+
+
+def parse_partition(value):
+    """ Returns `(index, count)` parsed from :param value in `<index>/<count>` format, raises `ValueError` if it's invalid. """
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid partition: {value}")
+    return index, count
+
+
+def worker_partition_of(sender, count):
+    """ Returns ingest worker partition of :param sender, high bits of hash are used, low bits select thread within worker. """
+    return (zlib.crc32(sender) >> 16) % count
+
+
+class PartitionedDispatcher:
+    """
+    Hands messages to `partitions` worker threads, messages from the same sender always go to the same thread,
+    so that they are processed in the order in which they were received while different devices are processed concurrently.
+    """
+
+    def __init__(self, partitions, handler):
+        self.handler = handler
+        self._queues = [queue.Queue() for _ in range(max(1, partitions))]
+        self._threads = [threading.Thread(target=self._run, args=(q,), daemon=True) for q in self._queues]
+        for thread in self._threads:
+            thread.start()
+
+    def partition_of(self, key):
+        return zlib.crc32(key) % len(self._queues)
+
+    def dispatch(self, key, msg):
+        self._queues[self.partition_of(key)].put(msg)
+
+    def stop(self):
+        """ Processes already dispatched messages and stops worker threads. """
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, q):
+        while True:
+            msg = q.get()
+            if msg is _STOP:
+                return
+            try:
+                self.handler(msg)
+            except Exception as e:  # keep partition alive, single message must not stop processing of the device
+                print(f"Failed to process message on topic '{msg.topic}': {repr(e)}", flush=True)
+
+
+class IngestWorker:
+    """
+    Standalone process that receives device messages from MQTT and writes them to DB, so that ingest scales independently
+    of web app, which should then run with `INGEST_IN_WEB_APP=False`.
+
+    Devices are statically partitioned between `count` workers (`partition=(index, count)`) by hash of sender, every worker
+    subscribes to all device messages and processes only messages of its own devices (rest is dropped before parsing).
+    Messages of one device are therefore always processed by the same worker, in the order in which they were received
+    (see `PartitionedDispatcher`), so e.g. `remove_data` can't be applied before preceding `save_data` of the same row.
+    Exactly one worker must run for every partition. Shared subscriptions (`$share/...`) aren't used, because Mosquitto
+    distributes their messages between members round-robin, which breaks order of messages of the device.
+    """
+
+    def __init__(self, app, partition, threads):
+        self.app = app
+        self.index, self.count = partition
+        self.topics = ingest_topics()
+        self.client = mqtt.Client(client_id=f'ingest_{self.index}_{self.count}_{str(uuid.uuid4())}')
+        self.dispatcher = PartitionedDispatcher(threads, lambda msg: handle_on_message(self.client, None, msg, app, db))
+        self.client.on_connect = lambda mqtt_client, userdata, flags, rc: handle_on_connect(mqtt_client, userdata, flags, rc, self.topics)
+        self.client.on_log = lambda mqtt_client, userdata, level, buf: handle_on_log(mqtt_client, userdata, level, buf, app)
+        self.client.on_message = lambda mqtt_client, userdata, msg: self.receive(msg)
+        configure_mqtt_client(self.client, app)
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.add_job(func=ingest_buffer.flush, trigger="interval", seconds=app.config["INGEST_FLUSH_INTERVAL"] / 1000)
+
+    def receive(self, msg):
+        """ Dispatches :param msg to processing thread if its sender belongs to partition of this worker. """
+        sender = sender_of(msg.topic)
+        if self.count == 1 or worker_partition_of(sender, self.count) == self.index:
+            self.dispatcher.dispatch(sender, msg)
+
+    def run_forever(self):
+        self.scheduler.start()
+        self.client.connect(self.app.config["MQTT_BROKER_URL"], self.app.config["MQTT_BROKER_PORT"], 60)
+        try:
+            self.client.loop_forever()
+        finally:
+            self.dispatcher.stop()
+            self.scheduler.shutdown()
+            ingest_buffer.flush()
+            ingest_buffer.close()
+            invalidation_bus.stop()
+
+
+@click.command("ingest")
+@click.option('--config', 'config_name', default=lambda: os.getenv('ENV_TYPE', 'development'), help='Configuration type.')
+@click.option('--partition', default=None, help='Devices processed by this worker as `<index>/<count>`, defaults to INGEST_PARTITION.')
+@click.option('--threads', default=None, type=int, help='Number of processing threads, defaults to INGEST_PARTITIONS.')
+def ingest(config_name, partition, threads):
+    app = create_ingest_app(config_name)
+    try:
+        partition = parse_partition(partition or app.config["INGEST_PARTITION"])
+    except ValueError:
+        raise click.BadParameter("expected `<index>/<count>` with 0 <= index < count", param_hint="--partition")
+    worker = IngestWorker(app, partition, threads or app.config["INGEST_PARTITIONS"])
+    worker.run_forever()
+
+
+if __name__ == '__main__':
+    ingest()  # pylint: disable=no-value-for-parameter
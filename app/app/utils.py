@@ -1,14 +1,74 @@
+import base64
 import json
 import re
+from functools import lru_cache
 from uuid import UUID
 
-from flask import jsonify
+import msgpack
+from flask import jsonify, Response
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+MSGPACK_MIMETYPE = "application/msgpack"
+
+# Payload formats negotiated per device: legacy (JSON-like string) and versioned binary envelope - `BINARY_PAYLOAD_MAGIC`,
+# schema version byte and msgpack encoded map. Magic byte is never used by msgpack nor UTF-8, so legacy payloads
+# (starting with `{` or `"`) can't be mistaken for envelope.
+LEGACY_PAYLOAD_VERSION = 0
+BINARY_PAYLOAD_VERSION = 1
+BINARY_PAYLOAD_MAGIC = 0xc1
 
 
 def http_json_response(success=True, code=200, **data):
     return jsonify(success=success, **data), code
 
 
+def http_msgpack_response(success=True, code=200, **data):
+    """ Same as `http_json_response`, but body is encoded using MessagePack. """
+    return Response(msgpack.packb(dict(success=success, **data), use_bin_type=True), status=code, mimetype=MSGPACK_MIMETYPE)
+
+
+def http_json_fragments_response(name, fragments, success=True, code=200, **data):
+    """ Same as `http_json_response`, but value of :param name is array of already encoded JSON :param fragments. """
+    rest = json.dumps(dict(success=success, **data)).encode()
+    body = b"".join([b"{", json.dumps(name).encode(), b": [", b", ".join(fragments), b"], ", rest[1:]])
+    return Response(body, status=code, mimetype="application/json")
+
+
+def http_msgpack_fragments_response(name, fragments, success=True, code=200, **data):
+    """ Same as `http_msgpack_response`, but value of :param name is array of already encoded MessagePack :param fragments. """
+    packer = msgpack.Packer(use_bin_type=True)
+    data = dict(success=success, **data)
+    parts = [packer.pack_map_header(len(data) + 1), packer.pack(name), packer.pack_array_header(len(fragments)), *fragments]
+    parts.extend(packer.pack(item) for pair in data.items() for item in pair)
+    return Response(b"".join(parts), status=code, mimetype=MSGPACK_MIMETYPE)
+
+
+@lru_cache(maxsize=None)
+def token_serializer(secret_key):
+    """ Serializer used to decode access tokens, it holds no per-token state, so it's created only once. """
+    return Serializer(secret_key)
+
+
+def encode_cursor(position, order_by="id"):
+    """ Creates opaque cursor pointing after row at :param position - `(id, value of order_by column)` (used for keyset pagination). """
+    id_, value = position
+    cursor = {"id": id_} if order_by == "id" else {"id": id_, "value": value, "order_by": order_by}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(cursor, order_by="id"):
+    """ Returns `(id, value)` position encoded in :param cursor or None if cursor is invalid or was created for other ordering. """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        id_, value = cursor["id"], cursor.get("value")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if cursor.get("order_by", "id") != order_by or not isinstance(id_, int) or not (order_by == "id" or isinstance(value, int)):
+        return None
+    return id_, value
+
+
 def bytes_to_json(value):
     value = value.decode("utf8")
     if value.startswith('"') and value.endswith('"'):
@@ -49,7 +109,22 @@ def is_number(s):
         return False
 
 
-def create_payload(user_id, pairs):
+def encode_payload(fields, version=BINARY_PAYLOAD_VERSION):
+    """ Returns binary envelope of :param fields (`dict`) in schema :param version. """
+    return bytes((BINARY_PAYLOAD_MAGIC, version)) + msgpack.packb(fields, use_bin_type=True)
+
+
+def payload_version(payload):
+    """ Returns schema version of binary envelope :param payload or `LEGACY_PAYLOAD_VERSION` if it's legacy string. """
+    if len(payload) >= 2 and payload[0] == BINARY_PAYLOAD_MAGIC:
+        return payload[1]
+    return LEGACY_PAYLOAD_VERSION
+
+
+def create_payload(user_id, pairs, version=LEGACY_PAYLOAD_VERSION):
+    """ Returns message with :param pairs sent on behalf of :param user_id to device in payload format :param version. """
+    if version != LEGACY_PAYLOAD_VERSION:
+        return encode_payload({**pairs, "user_id": user_id}, version)
     payload = {}
     for k, v in pairs.items():
         payload[f'"{k}"'] = f'"{pairs[k]}"'
@@ -0,0 +1,108 @@
+import socket
+import struct
+import threading
+import time
+from timeit import default_timer as timer
+
+import paho.mqtt.client as mqtt
+
+from tests.test_utils.paho_test import gen_connack, gen_suback, pack_remaining_length
+
+# Compares message throughput of server MQTT client when network loop is polled using `client.loop` every
+# `POLL_INTERVAL` seconds (previous `BackgroundScheduler` setup) and when it runs in its own thread (`client.loop_start`).
+# Run from repository root: `python -m benchmark.mqtt_loop`
+
+MESSAGES_NUM = 5000
+POLL_INTERVAL = 3
+POLL_DURATION = 15
+TOPIC = "d:23/server/save_data"
+PAYLOAD = b"{'added': 6987, 'num_data': 31164, 'data': 'gAAAAABcTFAz9Wr5ZsnMcVYbQiXlnZCvT36MfDatZNyLwDpm_ixbzkZhM1NA4w7MN2p3CW3gyTA8gYtuKtDTomhulszvLTFfPA==', " \
+          b"'tid': 'encrypted_tid(8)', 'tid_bi': 'b209eba637a54f1f617cf5a6f925e4eb9fc083e66029061018b369e64b9864d7', " \
+          b"'correctness_hash': '$2b$12$9hxKg4pjXbm0kpbItQTd2uMICAGn2ntRw1qQskHIL/7tLa3ISIlmO'}"
+
+
+def gen_publish(topic, payload):
+    topic = topic.encode('utf-8')
+    variable = struct.pack("!H", len(topic)) + topic + payload
+    return struct.pack("!B", 48) + pack_remaining_length(len(variable)) + variable
+
+
+def read_packet(conn):
+    header = conn.recv(1)
+    multiplier, remaining = 1, 0
+    while True:
+        byte = conn.recv(1)[0]
+        remaining += (byte & 127) * multiplier
+        multiplier *= 128
+        if not byte & 128:
+            break
+    body = b""
+    while len(body) < remaining:
+        body += conn.recv(remaining - len(body))
+    return header, body
+
+
+class StandInBroker:
+    """ Accepts single client, acknowledges its CONNECT and SUBSCRIBE and then sends it `messages_num` PUBLISH packets. """
+
+    def __init__(self, messages_num):
+        self.messages_num = messages_num
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("localhost", 0))
+        self._sock.listen(1)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        conn, _ = self._sock.accept()
+        read_packet(conn)  # CONNECT
+        conn.sendall(gen_connack())
+        _, body = read_packet(conn)  # SUBSCRIBE
+        conn.sendall(gen_suback(struct.unpack("!H", body[:2])[0], 0))
+        packet = gen_publish(TOPIC, PAYLOAD)
+        for _ in range(self.messages_num):
+            conn.sendall(packet)
+        time.sleep(POLL_DURATION + 5)
+        conn.close()
+        self._sock.close()
+
+
+def connected_client(broker):
+    received = []
+    client = mqtt.Client(client_id="benchmark")
+    client.on_message = lambda c, userdata, msg: received.append(msg.payload)
+    client.connect("localhost", broker.port, 60)
+    client.subscribe("#")
+    return client, received
+
+
+def benchmark_polling():
+    broker = StandInBroker(MESSAGES_NUM)
+    client, received = connected_client(broker)
+    start = timer()
+    while timer() - start < POLL_DURATION and len(received) < MESSAGES_NUM:
+        client.loop()
+        time.sleep(POLL_INTERVAL)
+    end = timer()
+    client.disconnect()
+    return len(received), end - start
+
+
+def benchmark_threaded_loop():
+    broker = StandInBroker(MESSAGES_NUM)
+    client, received = connected_client(broker)
+    start = timer()
+    client.loop_start()
+    while timer() - start < POLL_DURATION and len(received) < MESSAGES_NUM:
+        time.sleep(0.01)
+    end = timer()
+    client.loop_stop()
+    return len(received), end - start
+
+
+if __name__ == '__main__':
+    for name, run in [(f"client.loop every {POLL_INTERVAL}s", benchmark_polling), ("client.loop_start", benchmark_threaded_loop)]:
+        count, duration = run()
+        print(f'{name}: received {count}/{MESSAGES_NUM} messages in {duration:.2f}s ({count / duration:.1f} messages/s)')
@@ -0,0 +1,54 @@
+import os
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from app.mqtt.parser import parse_payload, route_topic  # noqa pylint: disable=wrong-import-position
+from app.utils import bytes_to_json, is_number, encode_payload  # noqa pylint: disable=wrong-import-position
+from benchmark.mqtt_loop import TOPIC, PAYLOAD  # noqa pylint: disable=wrong-import-position
+
+# Compares messages parsed per second on one core by previous parsing of device messages in `handle_on_message`
+# (`bytes_to_json`, splitting of topic and log string built for every message) and by `app.mqtt.parser`
+# (payload validated and parsed from bytes by precompiled patterns, topic matched by single pattern, message is logged only
+# with `MQTT_LOG_MESSAGES`, which is off by default), for legacy payload and for the same payload in binary envelope
+# (`app.utils.encode_payload`).
+# Run from repository root: `python -m benchmark.mqtt_parser`
+
+MESSAGES_NUM = int(os.getenv('BENCHMARK_MESSAGES_NUM', '100000'))
+
+
+def legacy(topic, payload):
+    payload = bytes_to_json(payload)
+    log = "Received message '" + str(payload) + "' on topic '" + topic + "' with QoS " + str(1)
+    if topic.endswith("/"):
+        topic = topic[:-1]
+    parts = topic.split("/")
+    if len(parts) >= 2 and parts[1] == "server":
+        t, sender_id = parts[0].split(":")
+        if t == "d" and is_number(sender_id) and len(parts) == 3 and parts[2] in ["save_data", "remove_data"]:
+            return int(sender_id), parts[2], payload, log
+    return None
+
+
+def parser(topic, payload):
+    payload = parse_payload(payload)
+    route, error = route_topic(topic)
+    if payload is None or route is None:
+        return None
+    return route[0], route[1], payload
+
+
+def measure(parse, payload):
+    start = timer()
+    for _ in range(MESSAGES_NUM):
+        parse(TOPIC, payload)
+    return MESSAGES_NUM / (timer() - start)
+
+
+if __name__ == '__main__':
+    binary_payload = encode_payload(parse_payload(PAYLOAD))
+    assert legacy(TOPIC, PAYLOAD)[:3] == parser(TOPIC, PAYLOAD) == parser(TOPIC, binary_payload)
+    for name, parse, payload in [("bytes_to_json + topic split", legacy, PAYLOAD), ("parse_payload + route_topic", parser, PAYLOAD),
+                                 ("parse_payload + route_topic (binary)", parser, binary_payload)]:
+        print(f'{name}: {measure(parse, payload):.0f} messages/s, {len(payload)} bytes/message')
@@ -0,0 +1,66 @@
+import os
+import random
+import sys
+
+from flask import Flask
+from sqlalchemy import and_, text
+from sqlalchemy.dialects import postgresql
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from app.app_setup import db, register_models  # noqa pylint: disable=wrong-import-position
+from app.config import config  # noqa pylint: disable=wrong-import-position
+
+# Shows query plans of OPE range query (`/api/data/get_by_num_range`) before (join on `device.name_bi`, no composite
+# indexes) and after (filter on `device_data.device_id`, `(device_id, num_data)` index).
+# Runs against Postgres DB populated using `populate.sql` or `generate_rows.py` (`BENCHMARK_DATABASE_URL`, defaults to
+# development DB), which is padded with `ROWS_NUM` synthetic rows. Everything runs in single transaction that is rolled back,
+# so DB is left unchanged. Run from repository root: `python -m benchmark.range_query_plan`
+
+ROWS_NUM = int(os.getenv('BENCHMARK_ROWS_NUM', '200000'))
+COMPOSITE_INDEXES = ["ix_device_data_device_id_num_data", "ix_device_data_device_id_added"]
+
+
+def pad_dataset(device_data, device_ids):
+    device_data.insert_many([{
+        "tid": b"gAAAAABcTFAz9Wr5ZsnMcVYbQiXlnZCvT36MfDatZNyLwDpm_ixbzkZhM1NA4w7MN2p3CW3gyTA8gYtuKtDTomhulszvLTFfPA==",
+        "data": b"eJyVVdty4jgQ/RWKV5iKJOs6VfPAbSAB5wIBwmy2KDDmEjsJxECSSeXf192SHOZt58Flq9VSd59zuv1Rjmj5e+mj3JjuN+kixu/pNEpnWTad5qvy",
+        "device_id": random.choice(device_ids),
+        "correctness_hash": "$2b$12$9hxKg4pjXbm0kpbItQTd2uMICAGn2ntRw1qQskHIL/7tLa3ISIlmO",
+        "num_data": random.randint(-214748364800, 214748364700),
+        "added": random.randint(0, 2 ** 32)
+    } for _ in range(ROWS_NUM)], chunk_size=5000)
+    db.session.execute(text("ANALYZE device_data"))
+
+
+def explain(name, query):
+    sql = str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    plan = db.session.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}")).fetchall()
+    print(f"--- {name}")
+    print("\n".join(row[0] for row in plan))
+
+
+if __name__ == '__main__':
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=os.getenv('BENCHMARK_DATABASE_URL', config["development"].SQLALCHEMY_DATABASE_URI),
+                      SQLALCHEMY_TRACK_MODIFICATIONS=False)
+    db.init_app(app)
+    register_models()
+    from app.models.models import Device, DeviceData
+    with app.app_context():
+        device = db.session.query(Device).first()
+        pad_dataset(DeviceData, [d.id for d in db.session.query(Device.id)])
+        lower, upper = -1000000000, 1000000000
+
+        db.session.execute(text("SAVEPOINT before_indexes"))
+        for index in COMPOSITE_INDEXES:
+            db.session.execute(text(f"DROP INDEX {index}"))
+        explain("join on device.name_bi, without composite indexes",
+                db.session.query(DeviceData).join(Device).filter(and_(DeviceData.num_data > lower,
+                                                                      DeviceData.num_data < upper,
+                                                                      Device.name_bi == device.name_bi)).order_by(DeviceData.id))
+        db.session.execute(text("ROLLBACK TO SAVEPOINT before_indexes"))
+
+        explain("filter on device_data.device_id, with composite indexes",
+                DeviceData.in_range(device.id, num_data=(lower, upper)).order_by(DeviceData.id))
+        db.session.rollback()
@@ -0,0 +1,89 @@
+import json
+import os
+import sys
+from timeit import default_timer as timer
+
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from app.app_setup import db, register_models  # noqa pylint: disable=wrong-import-position
+
+# Compares serialization of device data rows using `as_dict` on ORM objects followed by per-row decode loop (previous
+# implementation of data endpoints) with `RowSerializer` applied to `Query.with_entities` tuples, and encoding of response
+# body using `json.dumps` with concatenation of fragments from warm `row_cache` (only row IDs are queried).
+# Uses in-memory SQLite DB, run from repository root: `python -m benchmark.serializers`
+
+ROWS_NUM = 50000
+REPEAT = 5
+
+
+def as_dict_path(query):
+    result = []
+    for row in query.all():
+        r = row.as_dict()
+        for k, v in r.items():
+            if isinstance(v, bytes):
+                r[k] = v.decode()
+        result.append(r)
+    return result
+
+
+def row_serializer_path(query, serializer):
+    return [serializer(row) for row in serializer.query(query).all()]
+
+
+def encoded_path(query, serializer):
+    return json.dumps([serializer(row) for row in serializer.query(query).all()]).encode()
+
+
+def row_cache_path(query, serializer, encoded_rows):
+    ids = [id_ for id_, in query.with_entities(serializer.columns[0])]  # `id` column
+    return b"[" + b", ".join(encoded_rows(serializer, ids, "application/json")) + b"]"
+
+
+def populate(device_data):
+    device_data.insert_many([{
+        "tid": b"gAAAAABcTFAz9Wr5ZsnMcVYbQiXlnZCvT36MfDatZNyLwDpm_ixbzkZhM1NA4w7MN2p3CW3gyTA8gYtuKtDTomhulszvLTFfPA==",
+        "tid_bi": f"b209eba637a54f1f617cf5a6f925e4eb9fc083e66029061018b369e64b98{i}",
+        "data": b"eJyVVdty4jgQ/RWKV5iKJOs6VfPAbSAB5wIBwmy2KDDmEjsJxECSSeXf192SHOZt58Flq9VSd59zuv1Rjmj5e+mj3JjuN+kixu/pNEpnWTad5qvy",
+        "device_id": 23,
+        "correctness_hash": "$2b$12$9hxKg4pjXbm0kpbItQTd2uMICAGn2ntRw1qQskHIL/7tLa3ISIlmO",
+        "num_data": 31164 + i,
+        "added": 6987 + i
+    } for i in range(ROWS_NUM)])
+    db.session.commit()
+
+
+def measure(name, func):
+    best = min(_duration(func) for _ in range(REPEAT))
+    print(f'{name}: {ROWS_NUM / best:.0f} rows/s ({best:.3f}s per {ROWS_NUM} rows)')
+
+
+def _duration(func):
+    db.session.expunge_all()  # don't let identity map of previous run help ORM path
+    start = timer()
+    func()
+    return timer() - start
+
+
+if __name__ == '__main__':
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI="sqlite://", SQLALCHEMY_TRACK_MODIFICATIONS=False, ROW_CACHE_SIZE=ROWS_NUM)
+    db.init_app(app)
+    register_models()
+    from app.models.models import DeviceData
+    from app.models.row_cache import row_cache
+    from app.api.endpoints import _encoded_rows
+    row_cache.init_app(app)
+    with app.app_context():
+        db.metadata.create_all(db.engine, tables=[DeviceData.__table__])
+        populate(DeviceData)
+        query = db.session.query(DeviceData).filter(DeviceData.device_id == 23)
+        assert [{k: v for k, v in row.items() if k in DeviceData.SERIALIZED_COLUMNS} for row in as_dict_path(query)] == \
+            row_serializer_path(query, DeviceData.row_serializer())
+        measure("as_dict + decode loop", lambda: as_dict_path(query))
+        measure("RowSerializer + with_entities", lambda: row_serializer_path(query, DeviceData.row_serializer()))
+        assert json.loads(encoded_path(query, DeviceData.row_serializer())) == json.loads(row_cache_path(query, DeviceData.row_serializer(), _encoded_rows))
+        measure("RowSerializer + json.dumps", lambda: encoded_path(query, DeviceData.row_serializer()))
+        measure("row_cache fragments", lambda: row_cache_path(query, DeviceData.row_serializer(), _encoded_rows))
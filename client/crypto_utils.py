@@ -76,10 +76,15 @@ def correctness_hash(*strings):
 
 
 def check_correctness_hash(query_result, *keys):
+    """ Reports rows of :param query_result whose correctness hash doesn't match values of :param keys, returns rows that passed. """
+    passed = []
     for item in query_result:
         secret = "".join(str(item[key]) for key in keys)
         if not bcrypt.verify(secret, item["correctness_hash"]):
             click.echo(f"{item} failed correctness hash test!")
+        else:
+            passed.append(item)
+    return passed
 
 
 def derive_key(key):
@@ -195,6 +200,12 @@ def encrypt_using_fernet_hex(h, plaintext):
     return ciphertext
 
 
+def encrypt_using_ope_hex(h, plaintext):
+    cipher = hex_to_ope(h)
+    ciphertext = cipher.encrypt(int(plaintext))
+    return ciphertext
+
+
 def decrypt_using_ope_hex(h, ciphertext):
     cipher = hex_to_ope(h)
     plaintext = cipher.decrypt(int(ciphertext))
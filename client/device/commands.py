@@ -22,16 +22,18 @@ try:  # for packaged CLI (setup.py)
     from client.crypto_utils import generate, encrypt_row, \
         hex_to_key, key_to_hex, hex_to_fernet, decrypt_using_fernet_hex, get_random_seed, blind_index, encrypt_using_abe_serialized_key, hex_to_ope, \
         correctness_hash, pad_payload_attr, encrypt_using_fernet_hex
-    from client.utils import get_tinydb_table, search_tinydb_doc, is_number
+    from client.utils import get_tinydb_table, search_tinydb_doc, is_number, encode_payload, decode_payload, LEGACY_PAYLOAD_VERSION
 except ImportError:  # pragma: no un-packaged CLI cover
     from crypto_utils import generate, encrypt_row, \
         hex_to_key, key_to_hex, hex_to_fernet, decrypt_using_fernet_hex, get_random_seed, blind_index, \
         correctness_hash, pad_payload_attr, encrypt_using_fernet_hex
-    from utils import get_tinydb_table, search_tinydb_doc, is_number
+    from utils import get_tinydb_table, search_tinydb_doc, is_number, encode_payload, decode_payload, LEGACY_PAYLOAD_VERSION
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 path = f'{dir_path}/data.json'
 
+STDIN_DATA = "-"  # `data` argument of device commands reading binary payload from stdin
+
 
 @click.group()
 def device():
@@ -43,9 +45,11 @@ def device():
 @click.argument('password')
 @click.argument('owner_id')
 @click.argument('action_names', nargs=-1)
-def init(device_id, password, owner_id, action_names):
+@click.option('--payload-version', type=int, default=LEGACY_PAYLOAD_VERSION, help="MQTT payload format, 0 for legacy or 1 for binary")
+def init(device_id, password, owner_id, action_names, payload_version):
     table = get_tinydb_table(path, 'device')
-    table.upsert({'id': device_id, 'password': password, "owner_id": owner_id, "actions": action_names}, Query().id.exists())
+    table.upsert({'id': device_id, 'password': password, "owner_id": owner_id, "actions": action_names, "payload_version": payload_version},
+                 Query().id.exists())
     db = TinyDB(path)
     db.purge_table('users')
     table = get_tinydb_table(path, 'users')
@@ -57,9 +61,10 @@ def init(device_id, password, owner_id, action_names):
 def parse_msg(data):
     """ Can be trigger by: `./cli.py -b "172.21.0.3" user send-message 23 "{\"action\": true}"` """
     try:
+        data = read_message(data)
         if "ciphertext" in data:
 
-            data = json.loads(data)
+            data = message_to_dict(data)
             doc = get_user_data()
             plaintext = decrypt_using_fernet_hex(doc["shared_key"], data["ciphertext"])
             click.echo(plaintext)
@@ -75,9 +80,10 @@ def parse_msg(data):
 def save_column_keys(data):
     """ Can be trigger by: `./cli.py -b "172.26.0.8" user send-column-keys 1 23` """
     try:
-        if bool(re.search('\"\w+:\w+\"', data)):
+        data = read_message(data)
+        if isinstance(data, dict) or bool(re.search('\"\w+:\w+\"', data)):
 
-            data = json.loads(data)
+            data = message_to_dict(data)
             if get_owner_id() != int(data["user_id"]):
                 click.echo("This command is only available for device owner.")
                 return
@@ -106,11 +112,12 @@ def save_column_keys(data):
 @click.argument('data')
 def receive_pk(data):
     try:
+        data = read_message(data)
         if "user_public_key" in data:
-            json_data = json.loads(data.replace("'", '"'), strict=False)
+            json_data = data if isinstance(data, dict) else json.loads(data.replace("'", '"'), strict=False)
 
             pk_user_pem = json.dumps(json_data['user_public_key'])
-            user_id = int(json.dumps(json_data['user_id'])[1:-1])
+            user_id = int(json_data['user_id'])
 
             if get_owner_id() != user_id:
                 click.echo("This command is only available for device owner.")
@@ -138,9 +145,14 @@ def receive_pk(data):
             public_pem = public_key.public_bytes(
                 encoding=serialization.Encoding.PEM,
                 format=serialization.PublicFormat.SubjectPublicKeyInfo
-            ).decode('utf-8').replace("\n", "\\n")
-            payload = f'{{"user_id": {int(user_id)}, "device_public_key": "{public_pem}"}}'
-            click.echo(payload)
+            ).decode('utf-8')
+            version = get_self_payload_version()
+            if version == LEGACY_PAYLOAD_VERSION:
+                public_pem = public_pem.replace("\n", "\\n")
+                payload = f'{{"user_id": {int(user_id)}, "device_public_key": "{public_pem}"}}'
+            else:
+                payload = encode_payload({"user_id": int(user_id), "device_public_key": public_pem}, version)
+            echo_payload(payload)
 
     except Exception as e:  # pragma: no exc cover
         _, _, exc_tb = sys.exc_info()
@@ -174,9 +186,9 @@ def get_fake_tuple(bound):
         if bound == "lower_bound":
             doc["integrity"]["device_data"] = increment_bounds(doc["integrity"]["device_data"], bound=bound)
 
-        payload = dict_to_payload(**row)
+        payload = create_payload(row)
         table.update(doc)
-        click.echo(payload)
+        echo_payload(payload)
 
     except Exception as e:  # pragma: no exc cover
         _, _, exc_tb = sys.exc_info()
@@ -202,17 +214,23 @@ def get_self_id():
     return device_id
 
 
+def get_self_payload_version():
+    doc = search_tinydb_doc(path, 'device', Query().id.exists())
+    return doc.get("payload_version", LEGACY_PAYLOAD_VERSION) if doc else LEGACY_PAYLOAD_VERSION
+
+
 @device.command()
 @click.argument('data')
 def get_fake_tuple_info(data):
     try:
+        data = read_message(data)
         if "request" in data:
-            data = json.loads(data)
+            data = message_to_dict(data)
             if data["request"] == "fake_tuple_info":
                 doc = get_user_data()
 
                 payload = encrypt_fake_tuple_info(doc, data["user_id"])
-                click.echo(payload)
+                echo_payload(payload)
 
     except Exception as e:  # pragma: no exc cover
         _, _, exc_tb = sys.exc_info()
@@ -221,22 +239,22 @@ def get_fake_tuple_info(data):
 
 
 def encrypt_fake_tuple_info(doc, user_id):
-    payload = "{\"device_data\": \""
-    data = "{"
-    for k, v in doc["integrity"]["device_data"].items():
-        data += f'"{k}": {dict_to_payload(**v)}, '
-    data = data[:-2] + "}"
-    payload += encrypt_using_fernet_hex(doc["shared_key"], data).decode()
-    payload += f"\", \"topic\":\"d:{get_self_id()}/u:{user_id}/\"}}"
-    return payload
+    data = "{" + ", ".join(f'"{k}": {dict_to_payload(**v)}' for k, v in doc["integrity"]["device_data"].items()) + "}"
+    device_data = encrypt_using_fernet_hex(doc["shared_key"], data).decode()
+    topic = f"d:{get_self_id()}/u:{user_id}/"
+    version = get_self_payload_version()
+    if version == LEGACY_PAYLOAD_VERSION:
+        return f"{{\"device_data\": \"{device_data}\", \"topic\":\"{topic}\"}}"
+    return encode_payload({"device_data": device_data, "topic": topic}, version)
 
 
 @device.command()
 @click.argument('data')
 def process_action(data):
     try:
+        data = read_message(data)
         if "action" in data:
-            data = json.loads(data)
+            data = message_to_dict(data)
             doc = get_user_data()
             user_id = int(broker_username_to_id(data["user_id"]))
             if user_id == doc["id"]:
@@ -273,8 +291,8 @@ def save_data(user_id, data, num_data):
         num_data = int(num_data)
 
         current_time_millis = int(round(time.time()))
-        payload = dict_to_payload(**create_row(data, num_data, get_next_tid(), current_time_millis))
-        click.echo(payload)
+        payload = create_payload(create_row(data, num_data, get_next_tid(), current_time_millis))
+        echo_payload(payload)
 
     except Exception as e:  # pragma: no exc cover
         _, _, exc_tb = sys.exc_info()
@@ -323,15 +341,39 @@ def get_user_data():
 
 
 def dict_to_payload(**kwargs):
-    result = "{"
-    for col, val in kwargs.items():
-        if isinstance(val, bool):
-            result += f'"{col}": {str(val).lower()}, '
-        elif isinstance(val, int):
-            result += f'"{col}": {val}, '
-        else:
-            result += f'"{col}": "{val}", '
-    return result[:-2] + "}"
+    return "{" + ", ".join(f'"{col}": {_payload_value(val)}' for col, val in kwargs.items()) + "}"
+
+
+def _payload_value(val):
+    if isinstance(val, bool):
+        return str(val).lower()
+    if isinstance(val, int):
+        return str(val)
+    return f'"{val}"'
+
+
+def create_payload(fields):
+    """ Returns message with :param fields sent by device, in payload format set by `init`. """
+    version = get_self_payload_version()
+    if version == LEGACY_PAYLOAD_VERSION:
+        return dict_to_payload(**fields)
+    return encode_payload(fields, version)
+
+
+def read_message(data):
+    """ Returns :param data argument of command, or dict decoded from binary payload read from stdin if `data` is `STDIN_DATA`. """
+    if data == STDIN_DATA:
+        return decode_payload(click.get_binary_stream('stdin').read())
+    return data
+
+
+def message_to_dict(data):
+    return data if isinstance(data, dict) else json.loads(data)
+
+
+def echo_payload(payload):
+    """ Prints :param payload, binary payload is written without trailing new line, so that it can be published as is. """
+    click.echo(payload, nl=not isinstance(payload, bytes))
 
 
 def init_integrity_data():
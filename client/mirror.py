@@ -0,0 +1,69 @@
+import sqlite3
+from contextlib import closing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS device_data (
+    device_id TEXT NOT NULL,
+    tid INTEGER NOT NULL,
+    added INTEGER,
+    num_data INTEGER,
+    data TEXT,
+    PRIMARY KEY (device_id, tid)
+);
+CREATE INDEX IF NOT EXISTS ix_device_data_added ON device_data (device_id, added);
+CREATE INDEX IF NOT EXISTS ix_device_data_num_data ON device_data (device_id, num_data);
+CREATE TABLE IF NOT EXISTS sync (
+    device_id TEXT PRIMARY KEY,
+    watermark INTEGER NOT NULL
+);
+"""
+
+
+def open_mirror(path):
+    """
+    Opens local mirror of device data (SQLite DB at :param path, created if missing). Mirror holds decrypted
+    and verified real rows of devices together with `watermark` of last sync, so queries don't need server.
+    """
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_mirror_watermark(conn, device_id):
+    """ Returns `watermark` of data of :param device_id stored in mirror (None if device was never synced). """
+    with closing(conn.execute("SELECT watermark FROM sync WHERE device_id = ?", (str(device_id),))) as cursor:
+        row = cursor.fetchone()
+    return None if row is None else row["watermark"]
+
+
+def store_rows(conn, device_id, rows, watermark, replace=False):
+    """
+    Stores decrypted :param rows (dicts with `tid`, `added`, `num_data` and `data`) of :param device_id and :param watermark
+    in single transaction, so mirror never holds rows without matching watermark. Existing rows are removed if :param replace.
+    """
+    device_id = str(device_id)
+    with conn:
+        if replace:
+            conn.execute("DELETE FROM device_data WHERE device_id = ?", (device_id,))
+        conn.executemany("INSERT OR REPLACE INTO device_data (device_id, tid, added, num_data, data) VALUES (?, ?, ?, ?, ?)",
+                         [(device_id, int(row["tid"]), row["added"], row["num_data"], row["data"]) for row in rows])
+        conn.execute("INSERT OR REPLACE INTO sync (device_id, watermark) VALUES (?, ?)", (device_id, watermark))
+
+
+def query_rows(conn, device_id, added=(None, None), num_data=(None, None)):
+    """
+    Returns rows of :param device_id with `added` and `num_data` between (exclusive, same as server range queries)
+    given `(lower, upper)` bounds, any bound might be None. Rows are ordered by `added`.
+    """
+    conditions, params = ["device_id = ?"], [str(device_id)]
+    for column, (lower, upper) in (("added", added), ("num_data", num_data)):
+        if lower is not None:
+            conditions.append(f"{column} > ?")
+            params.append(int(lower))
+        if upper is not None:
+            conditions.append(f"{column} < ?")
+            params.append(int(upper))
+    sql = f"SELECT added, num_data, data, tid FROM device_data WHERE {' AND '.join(conditions)} ORDER BY added, tid"
+    with closing(conn.execute(sql, params)) as cursor:
+        return [dict(row) for row in cursor]
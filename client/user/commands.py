@@ -5,10 +5,11 @@ import random
 import ssl
 import sys
 from binascii import b2a_hex
+from contextlib import closing
 from datetime import datetime
-from json import JSONDecodeError
 
 import click
+import msgpack
 import requests
 from apscheduler.schedulers.blocking import BlockingScheduler
 from cryptography.hazmat.backends import default_backend
@@ -27,18 +28,22 @@ sys.stdout = sys.__stdout__
 
 try:  # for packaged CLI (setup.py)
     from client.crypto_utils import correctness_hash, check_correctness_hash, int_to_bytes, instantiate_ope_cipher, int_from_bytes, hex_to_key, \
-        key_to_hex, hex_to_fernet, hex_to_ope, decrypt_using_fernet_hex, decrypt_using_ope_hex, encrypt_using_fernet_hex, murmur_hash, \
-        decrypt_using_abe_serialized_key, blind_index, unpad_row, pad_payload_attr, unpad_payload_attr
-    from client.utils import json_string_with_bytes_to_dict, _create_payload, search_tinydb_doc, get_tinydb_table, insert_into_tinydb, \
-        get_shared_key_by_device_id, bytes_to_json, is_number
+        key_to_hex, hex_to_fernet, hex_to_ope, decrypt_using_fernet_hex, decrypt_using_ope_hex, encrypt_using_ope_hex, encrypt_using_fernet_hex, \
+        murmur_hash, decrypt_using_abe_serialized_key, blind_index, unpad_row, pad_payload_attr, unpad_payload_attr
+    from client.utils import json_string_with_bytes_to_dict, search_tinydb_doc, get_tinydb_table, insert_into_tinydb, \
+        get_shared_key_by_device_id, get_data_watermark, set_data_watermark, is_number, create_payload, decode_payload, \
+        get_payload_version, LEGACY_PAYLOAD_VERSION
     from client.password_hashing import pbkdf2_hash
+    from client.mirror import open_mirror, get_mirror_watermark, store_rows, query_rows
 except ImportError:  # pragma: no un-packaged CLI cover
     from crypto_utils import correctness_hash, check_correctness_hash, instantiate_ope_cipher, int_from_bytes, hex_to_key, key_to_hex, \
-        hex_to_fernet, hex_to_ope, decrypt_using_fernet_hex, decrypt_using_ope_hex, encrypt_using_fernet_hex, murmur_hash, \
+        hex_to_fernet, hex_to_ope, decrypt_using_fernet_hex, decrypt_using_ope_hex, encrypt_using_ope_hex, encrypt_using_fernet_hex, murmur_hash, \
         decrypt_using_abe_serialized_key, blind_index, unpad_row, pad_payload_attr, unpad_payload_attr
-    from utils import json_string_with_bytes_to_dict, _create_payload, search_tinydb_doc, get_tinydb_table, insert_into_tinydb, \
-        get_shared_key_by_device_id, bytes_to_json, is_number
+    from utils import json_string_with_bytes_to_dict, search_tinydb_doc, get_tinydb_table, insert_into_tinydb, \
+        get_shared_key_by_device_id, get_data_watermark, set_data_watermark, is_number, create_payload, decode_payload, \
+        get_payload_version, LEGACY_PAYLOAD_VERSION
     from password_hashing import pbkdf2_hash
+    from mirror import open_mirror, get_mirror_watermark, store_rows, query_rows
 
 URL_BASE = "https://localhost/api/"
 URL_PUBLISH = URL_BASE + "publish"
@@ -53,6 +58,8 @@ URL_AUTHORIZE_USER = URL_BASE + "device/authorize"
 URL_REVOKE_USER = URL_BASE + "device/revoke"
 URL_GET_DEVICE = URL_BASE + "device/get"
 URL_GET_DEVICE_DATA_BY_RANGE = URL_BASE + "data/get_by_num_range"
+URL_GET_DEVICE_DATA_BY_TIME_RANGE = URL_BASE + "data/get_by_time_range"
+URL_GET_DEVICE_DATA_AGGREGATE = URL_BASE + "data/aggregate"
 URL_GET_DEVICE_DATA = URL_BASE + "data/get_device_data"
 URL_START_KEY_EXCHANGE = URL_BASE + "exchange_session_keys"
 URL_RECEIVE_PUBLIC_KEY = URL_BASE + "retrieve_public_key"
@@ -69,8 +76,12 @@ AA_URL_SK_RETRIEVE = AA_URL_BASE + "user/retrieve_private_keys"
 AA_URL_ENCRYPT = AA_URL_BASE + "encrypt"
 AA_URL_DECRYPT = AA_URL_BASE + "decrypt"
 
+DEVICE_DATA_PAGE_LIMIT = 1000  # rows of device data requested at once
+MSGPACK_MIMETYPE = "application/msgpack"
+
 dir_path = os.path.dirname(os.path.realpath(__file__))
 path = f'{dir_path}/keystore.json'
+mirror_path = f'{dir_path}/mirror.sqlite'
 fake_tuple_data = None
 
 
@@ -103,7 +114,7 @@ def send_message(user_id, device_id, data):
 
     client = _setup_client(user_id)
 
-    payload = f'"{json.dumps(_create_payload({"ciphertext": token.decode()}, user_id))}"'
+    payload = create_payload({"ciphertext": token.decode()}, user_id, doc.get("payload_version", LEGACY_PAYLOAD_VERSION))
     ret = client.publish(f"u:{user_id}/d:{device_id}/", payload)
     click.echo(f"RC and MID = {ret}")
 
@@ -401,11 +412,15 @@ def get_devices(device_name, device_id, token):
 @click.argument('device_name')
 @click.option('--lower', required=False)
 @click.option('--upper', required=False)
+@click.option('--local', is_flag=True, help="Sync new data to local mirror and answer from it.")
 @click.option('--token', envvar='ACCESS_TOKEN')
-def get_device_data_by_num_range(user_id, device_id, device_name, lower=None, upper=None, token=""):
+def get_device_data_by_num_range(user_id, device_id, device_name, lower=None, upper=None, local=False, token=""):
     if lower is not None and upper is not None and upper <= lower:
         click.echo("Upper bound needs to be greater then lower bound.")
         return
+    if local:
+        _echo_local_data(user_id, device_id, device_name, token, num_data=(lower, upper))
+        return
     device_name_bi = blind_index(get_device_bi_key(device_id), device_name)
     if lower is not None and upper is not None:
         data = {"lower": int(lower), "upper": int(upper), "device_name_bi": device_name_bi}
@@ -421,17 +436,75 @@ def get_device_data_by_num_range(user_id, device_id, device_name, lower=None, up
         data = {"lower": lower,
                 "upper": upper,
                 "device_name_bi": device_name_bi}
-    r = requests.get(URL_GET_DEVICE_DATA_BY_RANGE, headers={"Authorization": token}, params=data, verify=VERIFY_CERTS)
-    content = r.content.decode('unicode-escape')
-    json_content = json_string_with_bytes_to_dict(content)
+    result = _get_verified_range_data(user_id, device_id, URL_GET_DEVICE_DATA_BY_RANGE, data, token, {"device_data:num_data": (lower, upper)})
+    click.echo('{"device_data":' + str(result).replace("'", '"') + '}')
+
+
+@user.command()
+@click.argument('user_id')
+@click.argument('device_id')
+@click.argument('device_name')
+@click.option('--lower', required=False, help='Unix timestamp, data added after it are returned.')
+@click.option('--upper', required=False, help='Unix timestamp, data added before it are returned.')
+@click.option('--num-lower', required=False)
+@click.option('--num-upper', required=False)
+@click.option('--local', is_flag=True, help="Sync new data to local mirror and answer from it.")
+@click.option('--token', envvar='ACCESS_TOKEN')
+def get_device_data_by_time_range(user_id, device_id, device_name, lower=None, upper=None, num_lower=None, num_upper=None, local=False, token=""):
+    """
+    Queries server for data of :param device_id device added between :param lower and :param upper (optionally also with
+    `num_data` between :param num_lower and :param num_upper). Bounds are encrypted using OPE keys of `added` and `num_data` columns.
+    """
+    if lower is None and upper is None:
+        click.echo("Lower or upper bound is required.")
+        return
+    if lower is not None and upper is not None and int(upper) <= int(lower):
+        click.echo("Upper bound needs to be greater then lower bound.")
+        return
+    if local:
+        _echo_local_data(user_id, device_id, device_name, token, added=(lower, upper), num_data=(num_lower, num_upper))
+        return
+    keys = get_encryption_keys(device_id, ["device_data:added", "device_data:num_data"])
+    data = {"device_name_bi": blind_index(get_device_bi_key(device_id), device_name)}
+    for name, value, key in (("lower", lower, keys["device_data:added"]), ("upper", upper, keys["device_data:added"]),
+                             ("num_lower", num_lower, keys["device_data:num_data"]), ("num_upper", num_upper, keys["device_data:num_data"])):
+        if value is not None:
+            data[name] = encrypt_using_ope_hex(key, value)
+    bounds = {
+        "device_data:added": (-100000000000 if lower is None else lower, 100000000000 if upper is None else upper),
+        "device_data:num_data": (-100000000000 if num_lower is None else num_lower, 100000000000 if num_upper is None else num_upper)
+    }
+
+    result = _get_verified_range_data(user_id, device_id, URL_GET_DEVICE_DATA_BY_TIME_RANGE, data, token, bounds)
+    click.echo('{"device_data":' + str(result).replace("'", '"') + '}')
+
 
+def _echo_local_data(user_id, device_id, device_name, token, added=(None, None), num_data=(None, None)):
+    """ Syncs local mirror with server and outputs mirrored rows of :param device_id in given plaintext bounds (see `query_rows`). """
+    with closing(open_mirror(mirror_path)) as conn:
+        if _sync_mirror(conn, user_id, device_id, device_name, True, token):
+            result = query_rows(conn, device_id, added=added, num_data=num_data)
+            click.echo('{"device_data":' + str(result).replace("'", '"') + '}')
+
+
+def _get_verified_range_data(user_id, device_id, url, data, token, bounds):
+    """
+    Queries :param url for data of :param device_id device, verifies that received fake tuples match fake tuples generated
+    in :param bounds (plaintext `(lower, upper)` per column, e.g. `{"device_data:num_data": (1, 5)}`), checks correctness
+    hash of real rows and returns them unpadded.
+    """
     _get_fake_tuple_data(int(user_id), int(device_id))
     decrypted_fake_tuple_data = {
         "device_data": json.loads(decrypt_using_fernet_hex(get_shared_key_by_device_id(path, device_id), fake_tuple_data["device_data"]).decode())}
 
-    fake_tuples, rows = _divide_fake_and_real_data(json_content["device_data"], str(device_id), decrypted_fake_tuple_data)
-    generated_tuples = generate_fake_tuples_in_range(decrypted_fake_tuple_data["device_data"])
-    expected_fake_rows = slice_by_range(generated_tuples, int(lower), int(upper), "device_data:num_data")
+    fake_tuples, rows = [], []
+    for json_content in _get_device_data_pages(url, data, token):
+        page_fake_tuples, page_rows = _divide_fake_and_real_data(json_content["device_data"], str(device_id), decrypted_fake_tuple_data)
+        fake_tuples.extend(page_fake_tuples)
+        rows.extend(page_rows)
+    expected_fake_rows = generate_fake_tuples_in_range(decrypted_fake_tuple_data["device_data"])
+    for col, (lower, upper) in bounds.items():
+        expected_fake_rows = slice_by_range(expected_fake_rows, int(lower), int(upper), col)
     verify_integrity_data(expected_fake_rows, fake_tuples)
 
     if json_content["success"]:
@@ -443,7 +516,80 @@ def get_device_data_by_num_range(user_id, device_id, device_name, lower=None, up
             result.append(unpad_row("data", row))
         except Exception as e:
             click.echo(str(e))
-    click.echo('{"device_data":' + str(result).replace("'", '"') + '}')
+    return result
+
+
+@user.command()
+@click.argument('user_id')
+@click.argument('device_id')
+@click.argument('device_name')
+@click.option('--column', type=click.Choice(['num_data', 'added']), default='num_data')
+@click.option('--bucket', 'buckets', multiple=True, type=int, help='Histogram bucket boundary, can be repeated.')
+@click.option('--token', envvar='ACCESS_TOKEN')
+def get_device_data_aggregate(user_id, device_id, device_name, column, buckets, token):
+    """
+    Queries server for count, min, max and histogram (counts of rows between consecutive :param buckets boundaries)
+    of :param column of :param device_id device data. Only bucket boundaries are encrypted and only :param column and `tid`
+    of rows holding extremes are decrypted. Fake tuples (generated using fake tuple info from device) are excluded from results.
+    """
+    col_name = f"device_data:{column}"
+    keys = get_encryption_keys(device_id, [col_name, "device_data:tid"])
+    _get_fake_tuple_data(int(user_id), int(device_id))
+    fake_tuple_info = json.loads(decrypt_using_fernet_hex(get_shared_key_by_device_id(path, device_id), fake_tuple_data["device_data"]).decode())
+    fake_values = [row[column] for row in generate_fake_tuples_in_range(fake_tuple_info)]
+
+    boundaries = sorted(set(buckets))
+    data = {"device_name_bi": blind_index(get_device_bi_key(device_id), device_name),
+            "column": column,
+            "buckets": ",".join(str(encrypt_using_ope_hex(keys[col_name], b)) for b in boundaries),
+            "extremes": len(fake_values) + 1}  # at least one of returned extremes is real row
+    r = requests.get(URL_GET_DEVICE_DATA_AGGREGATE, headers={"Authorization": token}, params=data, verify=VERIFY_CERTS)
+    content = json.loads(r.content.decode('unicode-escape'))
+    if not content["success"]:
+        click.echo(content["error"])
+        return
+
+    def first_real_value(rows):
+        for row in rows:
+            if not is_fake({"tid": decrypt_using_fernet_hex(keys["device_data:tid"], row["tid"]).decode()}):
+                return decrypt_using_ope_hex(keys[col_name], row[column])
+        return None
+
+    result = {
+        "count": content["count"] - len(fake_values),
+        "min": first_real_value(content["lowest"]),
+        "max": first_real_value(content["highest"]),
+        "buckets": [{"lower": lower, "upper": upper, "count": count - sum(lower <= value < upper for value in fake_values)}
+                    for (lower, upper), count in zip(zip(boundaries, boundaries[1:]), content["buckets"])]
+    }
+    click.echo(json.dumps(result))
+
+
+def _get_device_data_pages(url, params, token):
+    """
+    Yields pages of device data returned by :param url. Pages of `DEVICE_DATA_PAGE_LIMIT` rows are requested
+    in compact form - MessagePack encoded, column-oriented (gzip compressed by server) - and converted back to list of rows.
+    If server responds with JSON instead (e.g. error), it's yielded as single page.
+    """
+    params = dict(params, limit=DEVICE_DATA_PAGE_LIMIT, layout="columns")
+    while True:
+        r = requests.get(url, headers={"Authorization": token, "Accept": MSGPACK_MIMETYPE}, params=params, verify=VERIFY_CERTS)
+        if r.headers.get("Content-Type") != MSGPACK_MIMETYPE:
+            content = r.content.decode('unicode-escape')
+            yield json_string_with_bytes_to_dict(content)
+            return
+        page = msgpack.unpackb(r.content, raw=False)
+        page["device_data"] = columns_to_rows(page["device_data"])
+        yield page
+        if page["next"] is None:
+            return
+        params["after"] = page["next"]
+
+
+def columns_to_rows(columns):
+    """ Converts column-oriented data (`{"id": [1, 2], "data": ["a", "b"]}`) to list of rows (`[{"id": 1, "data": "a"}, ...]`). """
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
 
 
 def slice_by_range(all_tuples, lower, upper, key_name):
@@ -532,6 +678,7 @@ def retrieve_device_public_key(device_id, token):
     table.update(delete("public_key"), Query().device_id == device_id)
     table.update(delete("private_key"), Query().device_id == device_id)
     table.update(set("shared_key", key), Query().device_id == device_id)
+    table.update(set("payload_version", json_content.get("payload_version", LEGACY_PAYLOAD_VERSION)), Query().device_id == device_id)
 
 
 @user.command()
@@ -579,7 +726,7 @@ def send_column_keys(user_id, device_id, policy):
     table.upsert(doc, Query().device_id == device_id)
 
     client = _setup_client(user_id)
-    payload = f'"{json.dumps(_create_payload(payload_keys, user_id))}"'
+    payload = create_payload(payload_keys, user_id, doc.get("payload_version", LEGACY_PAYLOAD_VERSION))
     ret = client.publish(f"u:{user_id}/d:{device_id}/", payload)
     click.echo(f"RC and MID = {ret}")
 
@@ -659,46 +806,120 @@ def setup_authorized_device(device_id, abe_pk, bi_key, token):
 @click.argument('device_id')
 @click.argument('device_name')
 @click.option('--owner/--no-owner', default=True)
+@click.option('--since-last-sync', is_flag=True, help="Fetch only data ingested since last run of this command.")
+@click.option('--local', is_flag=True, help="Sync new data to local mirror and answer from it.")
 @click.option('--token', envvar='ACCESS_TOKEN')
-def get_device_data(user_id, device_id, device_name, owner, token):
+def get_device_data(user_id, device_id, device_name, owner, since_last_sync, local, token):
     """
     Queries server for data of :param device_id device and then verifies the received data using
     integrity information from device (received using MQTT Broker) and correctness hash attribute
-    of each DB row.
+    of each DB row. Watermark returned by server is stored in keystore, with `--since-last-sync` only
+    rows ingested after it are fetched (fake tuples among them are verified, but missing ones can't be detected).
     """
+    if local:
+        with closing(open_mirror(mirror_path)) as conn:
+            if _sync_mirror(conn, user_id, device_id, device_name, owner, token):
+                click.echo(query_rows(conn, device_id))
+        return
+
     user_id = int(user_id)
     device_name_bi = blind_index(get_device_bi_key(device_id), device_name)
     data = {"device_name_bi": device_name_bi}
+    since = get_data_watermark(path, device_id) if since_last_sync else None
+    if since is not None:
+        data["since"] = since
 
-    r = requests.get(URL_GET_DEVICE_DATA, headers={"Authorization": token}, params=data, verify=VERIFY_CERTS)
-    content = r.content.decode('unicode-escape')
-    json_content = json_string_with_bytes_to_dict(content)
-
-    if not json_content["success"]:
-        click.echo(json_content["error"])
+    json_content = _get_all_device_data(URL_GET_DEVICE_DATA, data, token)
+    if json_content is None:
         return
 
     if owner:
-        _get_fake_tuple_data(user_id, int(device_id))
-        decrypted_fake_tuple_data = {
-            "device_data": json.loads(decrypt_using_fernet_hex(get_shared_key_by_device_id(path, device_id), fake_tuple_data["device_data"]).decode())}
+        click.echo(_verify_device_data(user_id, device_id, json_content["device_data"], partial=since is not None))
+    else:
+        get_foreign_device_data(device_id, json_content)
 
-        fake_tuples, rows = _divide_fake_and_real_data(json_content["device_data"], device_id, decrypted_fake_tuple_data)
-        # NOTE:      ^ Not checking for ability of user to decrypt (having SK that satisfies Ciphertext) because owner should have keys setup
-        #              so that he can decrypt all data from his devices
+    if json_content.get("watermark") is not None:
+        set_data_watermark(path, device_id, json_content["watermark"])
 
-        verify_integrity_data(generate_fake_tuples_in_range(decrypted_fake_tuple_data["device_data"]), fake_tuples)
-        check_correctness_hash(rows, 'added', 'data', 'num_data', 'tid')
 
-        result = []
-        for row in rows:
-            try:
-                result.append(unpad_row("data", row))
-            except Exception as e:
-                click.echo(str(e))
-        click.echo(result)
-    else:
-        get_foreign_device_data(device_id, json_content)
+@user.command()
+@click.argument('user_id')
+@click.argument('device_id')
+@click.argument('device_name')
+@click.option('--full', is_flag=True, help="Discard mirrored data and fetch all data again (e.g. to drop removed rows).")
+@click.option('--token', envvar='ACCESS_TOKEN')
+def sync_device_data(user_id, device_id, device_name, full, token):
+    """
+    Fetches data of :param device_id device ingested since last sync, verifies them and stores decrypted real rows
+    in local mirror (`mirror.sqlite` next to `keystore.json`). Local queries (`--local`) sync the same way before answering.
+    """
+    with closing(open_mirror(mirror_path)) as conn:
+        if _sync_mirror(conn, user_id, device_id, device_name, True, token, full):
+            click.echo(f"Device {device_id} synced, watermark: {get_mirror_watermark(conn, device_id)}")
+
+
+def _sync_mirror(conn, user_id, device_id, device_name, owner, token, full=False):
+    """
+    Fetches data of :param device_id ingested after watermark stored in mirror (all data if :param full or device
+    was never synced) and stores verified rows (only rows that passed correctness hash check) in mirror, so only new rows
+    are downloaded, decrypted and verified. Returns False if data could not be synced.
+    """
+    if not owner:
+        click.echo("Local mirror is available only for owned devices.")
+        return False
+    since = None if full else get_mirror_watermark(conn, device_id)
+    data = {"device_name_bi": blind_index(get_device_bi_key(device_id), device_name)}
+    if since is not None:
+        data["since"] = since
+
+    json_content = _get_all_device_data(URL_GET_DEVICE_DATA, data, token)
+    if json_content is None:
+        return False
+    rows = _verify_device_data(int(user_id), device_id, json_content["device_data"], partial=since is not None, only_valid=True)
+    store_rows(conn, device_id, rows, json_content["watermark"], replace=since is None)
+    return True
+
+
+def _get_all_device_data(url, data, token):
+    """ Returns all pages of device data returned by :param url merged into single response, None if server returned error. """
+    json_content = None
+    for page in _get_device_data_pages(url, data, token):
+        if not page["success"]:
+            click.echo(page["error"])
+            return None
+        if json_content is None:
+            json_content = page
+        else:
+            json_content["device_data"].extend(page["device_data"])
+    return json_content
+
+
+def _verify_device_data(user_id, device_id, rows, partial=False, only_valid=False):
+    """
+    Verifies :param rows of device owned by user using fake tuple information from device and correctness hash of each
+    real row (:param partial as in `verify_integrity_data`), returns unpadded real rows (only those that passed
+    correctness hash check if :param only_valid).
+    """
+    _get_fake_tuple_data(user_id, int(device_id))
+    decrypted_fake_tuple_data = {
+        "device_data": json.loads(decrypt_using_fernet_hex(get_shared_key_by_device_id(path, device_id), fake_tuple_data["device_data"]).decode())}
+
+    fake_tuples, rows = _divide_fake_and_real_data(rows, device_id, decrypted_fake_tuple_data)
+    # NOTE:      ^ Not checking for ability of user to decrypt (having SK that satisfies Ciphertext) because owner should have keys setup
+    #              so that he can decrypt all data from his devices
+
+    verify_integrity_data(generate_fake_tuples_in_range(decrypted_fake_tuple_data["device_data"]), fake_tuples, partial=partial)
+    passed = check_correctness_hash(rows, 'added', 'data', 'num_data', 'tid')
+    if only_valid:
+        rows = passed
+
+    result = []
+    for row in rows:
+        try:
+            result.append(unpad_row("data", row))
+        except Exception as e:
+            click.echo(str(e))
+    return result
 
 
 def get_foreign_device_data(device_id, data):
@@ -727,8 +948,8 @@ def get_foreign_device_data(device_id, data):
 
 def _handle_on_message(mqtt_client, userdata, msg, device_id, user_id):
     try:
-        msg.payload = bytes_to_json(msg.payload)
-    except JSONDecodeError:
+        msg.payload = decode_payload(msg.payload)
+    except ValueError:
         click.echo(f"Received invalid payload: {msg.payload.decode()}")
         return
     topic = msg.topic.split("/")
@@ -750,7 +971,7 @@ def _get_fake_tuple_data(user_id, device_id):
         _handle_on_message(mqtt_client, userdata, msg, device_id, user_id)
 
     client = _setup_client(str({user_id}))
-    payload = f'"{json.dumps(_create_payload(payload_dict, user_id))}"'
+    payload = create_payload(payload_dict, user_id, get_payload_version(path, device_id))
     sub_topic = f"d:{device_id}/u:{user_id}/"
     client.subscribe(sub_topic)
     client.publish(f"u:{user_id}/d:{device_id}/", payload)
@@ -875,12 +1096,14 @@ def is_fake(row_values):
     return int(row_values["tid"]) >= 0  # Positive numbers are fake
 
 
-def verify_integrity_data(expected_tuples, present_rows):
+def verify_integrity_data(expected_tuples, present_rows, partial=False):
     """
     :param expected_tuples: list of dicts with keys as column names and values as values from server DB
         (generated fake tuples, that should be present in DB)
     :param present_rows: list of dicts with keys as column names and values as values from server DB
         (queried tuples)
+    :param partial: :param present_rows are only part of the data (e.g. delta sync), so only their presence
+        among :param expected_tuples is checked
     :return: False if any of the rows does not satisfy 'fakeness' check of if there less/more fake
     rows than there should be
     """
@@ -888,7 +1111,7 @@ def verify_integrity_data(expected_tuples, present_rows):
     for i, row in enumerate(modified):
         modified[i].pop("correctness_hash")
 
-    if expected_tuples == modified:
+    if (all(row in expected_tuples for row in modified) if partial else expected_tuples == modified):
         click.echo("Data Integrity satisfied.")
     else:
         click.echo("Data Integrity NOT satisfied.")
@@ -1,7 +1,14 @@
 import json
 
+import msgpack
 from tinydb import TinyDB, Query
 
+# MQTT payload formats, same as in `app.utils` - legacy (JSON-like string) and versioned binary envelope (`BINARY_PAYLOAD_MAGIC`,
+# schema version byte and msgpack encoded map). Format of each device is negotiated in key exchange.
+LEGACY_PAYLOAD_VERSION = 0
+BINARY_PAYLOAD_VERSION = 1
+BINARY_PAYLOAD_MAGIC = 0xc1
+
 
 def json_string_with_bytes_to_dict(value):
     return json.loads(value.replace("\\", "\\\\"), strict=False)
@@ -23,6 +30,29 @@ def _create_payload(pairs, user_id=None):
     return payload
 
 
+def create_payload(pairs, user_id=None, version=LEGACY_PAYLOAD_VERSION):
+    """ Returns message with :param pairs sent to device in payload format :param version. """
+    if version == LEGACY_PAYLOAD_VERSION:
+        return f'"{json.dumps(_create_payload(pairs, user_id))}"'
+    if user_id is not None:
+        pairs = {**pairs, "user_id": user_id}
+    return encode_payload(pairs, version)
+
+
+def encode_payload(fields, version=BINARY_PAYLOAD_VERSION):
+    """ Returns binary envelope of :param fields (`dict`) in schema :param version. """
+    return bytes((BINARY_PAYLOAD_MAGIC, version)) + msgpack.packb(fields, use_bin_type=True)
+
+
+def decode_payload(payload):
+    """ Returns dict parsed from :param payload (`bytes`) - binary envelope or legacy string, raises `ValueError` if it's malformed. """
+    if len(payload) >= 2 and payload[0] == BINARY_PAYLOAD_MAGIC:
+        if payload[1] != BINARY_PAYLOAD_VERSION:
+            raise ValueError(f"Unsupported payload version: {payload[1]}")
+        return msgpack.unpackb(payload[2:], raw=False)
+    return bytes_to_json(payload)
+
+
 def get_tinydb_table(path, table_name):
     db = TinyDB(path)
     table = db.table(name=table_name)
@@ -46,6 +76,26 @@ def get_shared_key_by_device_id(path, device_id):
         return doc["shared_key"]
 
 
+def get_payload_version(path, device_id):
+    """ Returns MQTT payload format of :param device_id received in key exchange (legacy if keys weren't exchanged yet). """
+    doc = search_tinydb_doc(path, "device_keys", Query().device_id == str(device_id))
+    if doc:
+        return doc.get("payload_version", LEGACY_PAYLOAD_VERSION)
+    return LEGACY_PAYLOAD_VERSION
+
+
+def get_data_watermark(path, device_id):
+    """ Returns `watermark` of data of :param device_id received by last `get_device_data` (None if data were never fetched). """
+    doc = search_tinydb_doc(path, "data_sync", Query().device_id == str(device_id))
+    if doc:
+        return doc["watermark"]
+
+
+def set_data_watermark(path, device_id, watermark):
+    table = get_tinydb_table(path, "data_sync")
+    table.upsert({"device_id": str(device_id), "watermark": watermark}, Query().device_id == str(device_id))
+
+
 def is_number(s):
     try:
         int(s)
@@ -23,6 +23,7 @@ setup(
     install_requires=[
         'Click',
         'requests',
+        'msgpack',
         'cryptography',
         'tinydb',
         'paho-mqtt',
@@ -4,10 +4,13 @@ from unittest import mock
 from unittest.mock import Mock
 
 import pytest
+from flask import g
 from passlib.hash import bcrypt
 
+from app.auth.token_cache import token_cache
 from app.auth.utils import parse_email, validate_token, save_user, require_api_token, INVALID_ACCESS_TOKEN_ERROR_MSG, generate_auth_token
 from app.models.models import User, AttrAuthUser, Device
+from app.utils import token_serializer
 from .conftest import db, assert_got_data_from_post
 
 
@@ -46,6 +49,29 @@ def test_validate_token(app_and_ctx, access_token):
         assert validate_token(None, "5c36ab84439c45a37196dftgd9bd7b31929afd9f") is False  # Not in generated schema
 
 
+def test_validate_token_uses_verified_token_cache(app_and_ctx, access_token):
+    app, ctx = app_and_ctx
+    token_cache.clear()
+    with app.app_context():
+        with mock.patch('app.auth.utils.bcrypt.verify', wraps=bcrypt.verify) as verify:
+            hits, misses = token_cache.stats["hits"], token_cache.stats["misses"]
+            assert validate_token(None, access_token)
+            assert validate_token(None, access_token)
+            assert verify.call_count == 1
+            assert token_cache.stats["hits"] == hits + 1
+            assert token_cache.stats["misses"] == misses + 1
+
+            user = User.get_using_jwt_token(access_token)
+            user.access_token_update = datetime.now()  # token changed in other worker
+            assert validate_token(None, access_token)
+            assert verify.call_count == 2
+
+            token_cache.invalidate_user(None, user.id)
+            assert validate_token(None, access_token)
+            assert verify.call_count == 3
+            db.session.rollback()
+
+
 def test_save_user_github(app_and_ctx):
     response = Mock()
     remote = Mock()
@@ -118,6 +144,19 @@ def test_require_api_token_in_base_db(application, access_token):
         assert func.call_count == 1
 
 
+def test_require_api_token_sets_current_user(application, access_token):
+    def func():
+        assert g.user.id == 1
+        assert 'mqtt_creds' in g.user.__dict__  # loaded together with user
+        return "OK"
+    decorated_func = require_api_token(load=("mqtt_creds",))(func)
+    with application.test_request_context("/", headers={"Authorization": access_token}):
+        with mock.patch('app.models.mixins.token_serializer', wraps=token_serializer) as serializer:
+            assert decorated_func() == "OK"
+            assert serializer.call_count == 0  # decoded only once by decorator
+    assert token_serializer(application.config['SECRET_KEY']) is token_serializer(application.config['SECRET_KEY'])
+
+
 def test_require_api_token_in_attr_auth_db(application):
     remote = Mock()
     remote.name = "stackoverflow"
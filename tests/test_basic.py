@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 import base64
+import gzip
 import json
+import time
 from unittest import mock
 from unittest.mock import call
 from uuid import UUID
 
+import msgpack
 from passlib.hash import bcrypt
 
-from app.consts import DEVICE_TYPE_ID_MISSING_ERROR_MSG, DEVICE_TYPE_ID_INCORRECT_ERROR_MSG, \
+from app.invalidation import invalidation_bus
+
+from app.consts import DATA_LIMIT_INVALID_ERROR_MSG, DATA_CURSOR_INVALID_ERROR_MSG, DATA_LAYOUT_INVALID_ERROR_MSG, DATA_ORDER_BY_INVALID_ERROR_MSG, \
+    DATA_DIRECTION_INVALID_ERROR_MSG, DATA_COLUMN_INVALID_ERROR_MSG, DATA_BUCKETS_INVALID_ERROR_MSG, DATA_EXTREMES_INVALID_ERROR_MSG, \
+    DATA_SINCE_INVALID_ERROR_MSG, \
+    DEVICE_TYPE_ID_MISSING_ERROR_MSG, DEVICE_TYPE_ID_INCORRECT_ERROR_MSG, \
     DEVICE_NAME_BI_MISSING_ERROR_MSG, DEVICE_NAME_MISSING_ERROR_MSG, \
     DATA_RANGE_MISSING_ERROR_MSG, DATA_OUT_OF_OUTPUT_RANGE_ERROR_MSG, CORRECTNESS_HASH_MISSING_ERROR_MSG, \
     SOMETHING_WENT_WRONG_MSG, DEVICE_ID_MISSING_ERROR_MSG, \
@@ -21,7 +29,7 @@ from app.consts import DEVICE_TYPE_ID_MISSING_ERROR_MSG, DEVICE_TYPE_ID_INCORREC
     INVALID_SCENE_BI_ERROR_MSG, AUTH_USER_ID_INVALID_ERROR_MSG, AUTH_USER_ID_MISSING_ERROR_MSG, \
     AUTH_USER_ALREADY_AUTHORIZED_ERROR_MSG, REVOKE_USER_ID_MISSING_ERROR_MSG, REVOKE_USER_ID_INVALID_ERROR_MSG, \
     REVOKE_USER_NOT_AUTHORIZED_ERROR_MSG, DEVICE_NAME_BI_INVALID_ERROR_MSG, ADDITIONAL_DATA_MISSING_ERROR_MSG
-from app.models.models import DeviceType, Device, User, Action, Scene, UserDevice
+from app.models.models import DeviceType, Device, DeviceData, User, Action, Scene, UserDevice
 from app.app_setup import client as mqtt_client
 from app.utils import is_valid_uuid, bytes_to_json, format_topic, validate_broker_password
 from client.crypto_utils import encrypt, correctness_hash, generate, \
@@ -35,6 +43,31 @@ def test_mqtt_client(app_and_ctx):
     assert mqtt_client._ssl is True
 
 
+def test_mqtt_client_network_loop(app_and_ctx):
+    app, ctx = app_and_ctx
+    assert mqtt_client._thread is not None and mqtt_client._thread.is_alive()
+    assert mqtt_client._max_inflight_messages == app.config["MQTT_MAX_INFLIGHT"]
+
+
+def test_invalidation_bus(app_and_ctx):
+    app, ctx = app_and_ctx
+    evicted = []
+    invalidation_bus.register("test", evicted.append)
+    with app.app_context():
+        sent = invalidation_bus.stats["sent"]
+        invalidation_bus.notify("test", 5)
+        assert evicted == [5]  # evicted locally right away
+        db.session.commit()
+        assert invalidation_bus.stats["sent"] == sent + 1
+
+    for _ in range(50):  # ... and once more by listener, after transaction commits
+        if len(evicted) == 2:
+            break
+        time.sleep(0.1)
+    assert evicted == [5, 5]
+    del invalidation_bus.handlers["test"]
+
+
 def test_index(client):
     response = client.get('/')
     assert "This is IoT Cloud Framework" in str(response.data)
@@ -421,6 +454,54 @@ def test_api_get_device_data_by_range_out_of_range(client, app_and_ctx, access_t
     assert_got_error_from_get(client, '/api/data/get_by_num_range', data, 400, DATA_OUT_OF_OUTPUT_RANGE_ERROR_MSG)
 
 
+def test_api_get_device_data_by_time_range(client, app_and_ctx, access_token):
+    device_name_bi = "a36758aa531feb3ef0ce632b7a5b993af3d8d59b8f2f8df8de854dce915d20df"
+    data = {"num_lower": "466000", "access_token": access_token, "device_name_bi": device_name_bi}
+    assert_got_error_from_get(client, '/api/data/get_by_time_range', data, 400, DATA_RANGE_MISSING_ERROR_MSG)
+
+    data = {"lower": "2900000000", "upper": "2200000000", "access_token": access_token, "device_name_bi": device_name_bi}
+    assert_got_error_from_get(client, '/api/data/get_by_time_range', data, 400, DATA_OUT_OF_OUTPUT_RANGE_ERROR_MSG)
+
+    data = {"lower": "2200000000", "upper": "2900000000", "access_token": access_token, "device_name_bi": device_name_bi}
+    status_code, data_out = get_data_from_get(client, '/api/data/get_by_time_range', data)
+
+    assert status_code == 200
+    assert len(data_out["device_data"]) == 3
+
+    data["num_upper"] = "467297"
+    status_code, data_out = get_data_from_get(client, '/api/data/get_by_time_range', data)
+
+    assert status_code == 200
+    assert [row["id"] for row in data_out["device_data"]] == [8]
+
+
+def test_api_get_device_data_uses_hot_tier(client, app_and_ctx, access_token):
+    from app.models.hot_tier import hot_tier
+    from app.models.range_cache import range_cache
+    range_cache.clear()
+    hot_tier.clear()
+    max_rows, hot_tier.max_rows = hot_tier.max_rows, 2  # window holds rows 12 and 4, older rows have `added` <= 2244039737
+    try:
+        data = {"lower": "2300000000", "upper": "2900000000", "access_token": access_token,
+                "device_name_bi": "a36758aa531feb3ef0ce632b7a5b993af3d8d59b8f2f8df8de854dce915d20df"}
+        status_code, data_out = get_data_from_get(client, '/api/data/get_by_time_range', data)
+        assert [row["id"] for row in data_out["device_data"]] == [4, 12]
+        assert hot_tier.stats["loads"] == 1
+
+        hits = hot_tier.stats["hits"]
+        data.update(lower="2200000000", order_by="added", direction="desc", limit="1")
+        status_code, data_out = get_data_from_get(client, '/api/data/get_by_time_range', data)
+        assert [row["id"] for row in data_out["device_data"]] == [12]
+        assert hot_tier.stats["hits"] == hits + 1
+
+        del data["limit"]
+        status_code, data_out = get_data_from_get(client, '/api/data/get_by_time_range', data)  # row 8 is outside of window, answered by DB
+        assert [row["id"] for row in data_out["device_data"]] == [12, 4, 8]
+    finally:
+        hot_tier.max_rows = max_rows
+        hot_tier.clear()
+
+
 def test_api_get_device_data(client, app_and_ctx, access_token_two):
     data = {"not-device_name_bi": "non-empty", "access_token": access_token_two}
     assert_got_error_from_get(client, '/api/data/get_device_data', data, 400, DEVICE_NAME_BI_MISSING_ERROR_MSG)
@@ -436,6 +517,264 @@ def test_api_get_device_data(client, app_and_ctx, access_token_two):
     assert len(data_out["device_data"]) == 2
 
 
+def test_api_get_device_data_paginated(client, app_and_ctx, access_token_two):
+    device_name_bi = "6c0d409f3d4d630303ca1fea9d1d0b2aa9aef33e0480266e23eb24c6b26a3fde"
+    data = {"device_name_bi": device_name_bi, "limit": "1", "access_token": access_token_two}
+    status_code, first_page = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert len(first_page["device_data"]) == 1
+    assert first_page["next"] is not None
+
+    data["after"] = first_page["next"]
+    status_code, second_page = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert len(second_page["device_data"]) == 1
+    assert second_page["device_data"][0]["id"] > first_page["device_data"][0]["id"]
+    assert second_page["next"] is None
+
+    data = {"device_name_bi": device_name_bi, "limit": "0", "access_token": access_token_two}
+    assert_got_error_from_get(client, '/api/data/get_device_data', data, 400, DATA_LIMIT_INVALID_ERROR_MSG)
+
+    data = {"device_name_bi": device_name_bi, "limit": "1", "after": "invalid", "access_token": access_token_two}
+    assert_got_error_from_get(client, '/api/data/get_device_data', data, 400, DATA_CURSOR_INVALID_ERROR_MSG)
+
+
+def test_api_get_device_data_uses_row_cache(client, app_and_ctx, access_token_two):
+    from app.models.row_cache import row_cache
+    app, ctx = app_and_ctx
+    row_cache.clear()
+    data = {"device_name_bi": "6c0d409f3d4d630303ca1fea9d1d0b2aa9aef33e0480266e23eb24c6b26a3fde", "access_token": access_token_two}
+    status_code, unpaginated = get_data_from_get(client, '/api/data/get_device_data', data)
+    assert len(row_cache) == 0  # unpaginated rows are read by single query
+
+    data["limit"] = "10"
+    status_code, first = get_data_from_get(client, '/api/data/get_device_data', data)
+    assert first["device_data"] == unpaginated["device_data"]
+    hits = row_cache.stats["hits"]
+    status_code, second = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert second["device_data"] == first["device_data"]
+    assert row_cache.stats["hits"] == hits + 2
+
+    response = client.get('/api/data/get_device_data', query_string=data, headers={"Authorization": access_token_two, "Accept": "application/msgpack"})
+    assert msgpack.unpackb(response.data, raw=False)["device_data"] == first["device_data"]
+
+    with app.app_context():
+        DeviceData.insert_sequenced([{"tid": b"tid", "tid_bi": "row_cache_test", "data": b"data", "device_id": 45, "correctness_hash": "hash",
+                                      "num_data": 1, "added": 1}])
+        db.session.commit()
+    status_code, data_out = get_data_from_get(client, '/api/data/get_device_data', data)
+    row_id = data_out["device_data"][-1]["id"]
+    assert row_cache.get_many("application/json", [row_id])
+
+    with app.app_context():
+        DeviceData.delete_by_device_tid_bi_pairs([(45, "row_cache_test")])
+        db.session.commit()
+    assert row_cache.get_many("application/json", [row_id]) == {}
+    status_code, data_out = get_data_from_get(client, '/api/data/get_device_data', data)
+    assert data_out["device_data"] == first["device_data"]
+
+
+def test_api_get_data_by_num_range_uses_range_cache(client, app_and_ctx, access_token_two):
+    from app.models.range_cache import range_cache
+    app, ctx = app_and_ctx
+    range_cache.clear()
+    data = {"device_name_bi": "6c0d409f3d4d630303ca1fea9d1d0b2aa9aef33e0480266e23eb24c6b26a3fde", "access_token": access_token_two,
+            "lower": "-1000", "upper": "214748364700"}
+    status_code, first = get_data_from_get(client, '/api/data/get_by_num_range', data)
+    hits = range_cache.stats["hits"]
+    status_code, second = get_data_from_get(client, '/api/data/get_by_num_range', data)
+
+    assert status_code == 200
+    assert second == first
+    assert range_cache.stats["hits"] == hits + 1
+
+    with app.app_context():
+        DeviceData.insert_sequenced([{"tid": b"tid", "tid_bi": "range_cache_test", "data": b"data", "device_id": 45, "correctness_hash": "hash",
+                                      "num_data": 1, "added": 1}])
+        db.session.commit()
+    status_code, data_out = get_data_from_get(client, '/api/data/get_by_num_range', data)
+    assert range_cache.stats["hits"] == hits + 1
+    assert len(data_out["device_data"]) == len(first["device_data"]) + 1
+
+    with app.app_context():
+        DeviceData.delete_by_device_tid_bi_pairs([(45, "range_cache_test")])
+        db.session.commit()
+    status_code, data_out = get_data_from_get(client, '/api/data/get_by_num_range', data)
+    assert data_out == first
+
+
+def test_api_get_device_data_since(client, app_and_ctx, access_token_two):
+    app, ctx = app_and_ctx
+    data = {"device_name_bi": "6c0d409f3d4d630303ca1fea9d1d0b2aa9aef33e0480266e23eb24c6b26a3fde", "access_token": access_token_two}
+    status_code, data_out = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert len(data_out["device_data"]) == 2
+    watermark = data_out["watermark"]
+
+    data["since"] = str(watermark)
+    status_code, data_out = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert data_out["device_data"] == []
+    assert data_out["watermark"] == watermark
+
+    tid_bis = [f'delta_sync_test_{i}' for i in range(2)]
+    with app.app_context():
+        DeviceData.insert_sequenced([{
+            "tid": b"tid",
+            "tid_bi": tid_bi,
+            "data": b"data",
+            "device_id": 45,
+            "correctness_hash": "$2b$12$9hxKg4pjXbm0kpbItQTd2uMICAGn2ntRw1qQskHIL/7tLa3ISIlmO",
+            "num_data": 31164,
+            "added": 6987
+        } for tid_bi in tid_bis])
+        db.session.commit()
+
+    status_code, data_out = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert [row["tid_bi"] for row in data_out["device_data"]] == tid_bis
+    assert "seq" not in data_out["device_data"][0]
+    assert data_out["watermark"] == watermark + 2
+
+    data["since"] = str(data_out["watermark"])
+    status_code, data_out = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert data_out["device_data"] == []
+
+    with app.app_context():
+        DeviceData.delete_by_device_tid_bi_pairs([(45, tid_bi) for tid_bi in tid_bis])
+        db.session.commit()
+
+    data["since"] = "-1"
+    assert_got_error_from_get(client, '/api/data/get_device_data', data, 400, DATA_SINCE_INVALID_ERROR_MSG)
+
+
+def test_api_get_device_data_ordered(client, app_and_ctx, access_token):
+    device_name_bi = "a36758aa531feb3ef0ce632b7a5b993af3d8d59b8f2f8df8de854dce915d20df"
+    data = {"device_name_bi": device_name_bi, "order_by": "added", "direction": "desc", "limit": "2", "access_token": access_token}
+    status_code, latest = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert [row["id"] for row in latest["device_data"]] == [12, 4]
+
+    data["after"] = latest["next"]
+    status_code, older = get_data_from_get(client, '/api/data/get_device_data', data)
+
+    assert status_code == 200
+    assert [row["id"] for row in older["device_data"]] == [8, 6]
+    assert older["next"] is None
+
+    data = {"device_name_bi": device_name_bi, "order_by": "num_data", "direction": "desc", "limit": "1", "lower": "465000", "access_token": access_token}
+    status_code, top = get_data_from_get(client, '/api/data/get_by_num_range', data)
+
+    assert status_code == 200
+    assert [row["id"] for row in top["device_data"]] == [4]
+
+    data = {"device_name_bi": device_name_bi, "limit": "1", "after": latest["next"], "access_token": access_token}
+    assert_got_error_from_get(client, '/api/data/get_device_data', data, 400, DATA_CURSOR_INVALID_ERROR_MSG)
+
+    data = {"device_name_bi": device_name_bi, "order_by": "data", "access_token": access_token}
+    assert_got_error_from_get(client, '/api/data/get_device_data', data, 400, DATA_ORDER_BY_INVALID_ERROR_MSG)
+
+    data = {"device_name_bi": device_name_bi, "direction": "up", "access_token": access_token}
+    assert_got_error_from_get(client, '/api/data/get_device_data', data, 400, DATA_DIRECTION_INVALID_ERROR_MSG)
+
+
+def test_api_get_data_aggregate(client, app_and_ctx, access_token):
+    device_name_bi = "a36758aa531feb3ef0ce632b7a5b993af3d8d59b8f2f8df8de854dce915d20df"
+    data = {"device_name_bi": device_name_bi, "buckets": "464000,467000,472000", "extremes": "2", "access_token": access_token}
+    status_code, data_out = get_data_from_get(client, '/api/data/aggregate', data)
+
+    assert status_code == 200
+    assert data_out["count"] == 4
+    assert data_out["buckets"] == [2, 2]
+    assert [row["id"] for row in data_out["lowest"]] == [6, 8]
+    assert [row["id"] for row in data_out["highest"]] == [4, 12]
+
+    data = {"device_name_bi": device_name_bi, "column": "added", "access_token": access_token}
+    status_code, data_out = get_data_from_get(client, '/api/data/aggregate', data)
+
+    assert status_code == 200
+    assert data_out["buckets"] == []
+    assert [row["id"] for row in data_out["lowest"]] == [6]
+    assert [row["id"] for row in data_out["highest"]] == [12]
+
+    data = {"device_name_bi": device_name_bi, "column": "data", "access_token": access_token}
+    assert_got_error_from_get(client, '/api/data/aggregate', data, 400, DATA_COLUMN_INVALID_ERROR_MSG)
+
+    data = {"device_name_bi": device_name_bi, "buckets": "467000,464000", "access_token": access_token}
+    assert_got_error_from_get(client, '/api/data/aggregate', data, 400, DATA_BUCKETS_INVALID_ERROR_MSG)
+
+    data = {"device_name_bi": device_name_bi, "extremes": "0", "access_token": access_token}
+    assert_got_error_from_get(client, '/api/data/aggregate', data, 400, DATA_EXTREMES_INVALID_ERROR_MSG)
+
+
+def test_api_get_data_aggregate_hot_tier_row_removed(client, app_and_ctx, access_token):
+    from app.models.hot_tier import HotTier, hot_tier
+    data = {"device_name_bi": "a36758aa531feb3ef0ce632b7a5b993af3d8d59b8f2f8df8de854dce915d20df", "buckets": "464000,467000,472000",
+            "extremes": "2", "access_token": access_token}
+    with mock.patch.object(HotTier, "enabled", new_callable=mock.PropertyMock, return_value=True), \
+            mock.patch.object(hot_tier, "window", return_value=object()), \
+            mock.patch.object(hot_tier, "aggregate", return_value=(5, [3, 2], [6, 8], [4, 999999])):  # row 999999 was removed meanwhile
+        status_code, data_out = get_data_from_get(client, '/api/data/aggregate', data)
+
+    assert status_code == 200
+    assert data_out["count"] == 4  # answered by DB
+    assert [row["id"] for row in data_out["highest"]] == [4, 12]
+
+
+def test_api_get_device_data_streamed(client, app_and_ctx, access_token, access_token_two):
+    data = {"device_name_bi": "6c0d409f3d4d630303ca1fea9d1d0b2aa9aef33e0480266e23eb24c6b26a3fde"}
+    response = client.get('/api/data/get_device_data', query_string=data,
+                          headers={"Authorization": access_token_two, "Accept": "application/x-ndjson"})
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.data.decode("utf-8").splitlines()]
+    assert len(rows) == 2
+    assert rows[0]["id"] < rows[1]["id"]
+
+    data = {"lower": "467297", "device_name_bi": "a36758aa531feb3ef0ce632b7a5b993af3d8d59b8f2f8df8de854dce915d20df"}
+    response = client.get('/api/data/get_by_num_range', query_string=data,
+                          headers={"Authorization": access_token, "Accept": "application/x-ndjson"})
+
+    assert response.status_code == 200
+    assert len(response.data.decode("utf-8").splitlines()) == 2
+
+
+def test_api_get_device_data_compact(client, app_and_ctx, access_token_two):
+    data = {"device_name_bi": "6c0d409f3d4d630303ca1fea9d1d0b2aa9aef33e0480266e23eb24c6b26a3fde", "layout": "columns"}
+    status_code, data_out = get_data_from_get(client, '/api/data/get_device_data', dict(data, access_token=access_token_two))
+
+    assert status_code == 200
+    assert len(data_out["device_data"]["id"]) == 2
+    assert len(data_out["device_data"]["data"]) == 2
+
+    response = client.get('/api/data/get_device_data', query_string=dict(data, limit="1"),
+                          headers={"Authorization": access_token_two, "Accept": "application/msgpack", "Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/msgpack"
+    body = gzip.decompress(response.data) if response.headers.get("Content-Encoding") == "gzip" else response.data
+    page = msgpack.unpackb(body, raw=False)
+    assert page["success"] is True
+    assert page["next"] is not None
+    assert set(page["device_data"]) == set(DeviceData.SERIALIZED_COLUMNS)
+    assert len(page["device_data"]["id"]) == 1
+    assert isinstance(page["device_data"]["data"][0], str)
+
+    data["layout"] = "invalid"
+    assert_got_error_from_get(client, '/api/data/get_device_data', dict(data, access_token=access_token_two), 400, DATA_LAYOUT_INVALID_ERROR_MSG)
+
+
 def test_api_trigger_action(client, app_and_ctx, access_token):
     device_name_bi = "a36758aa531feb3ef0ce632b7a5b993af3d8d59b8f2f8df8de854dce915d20df"
     data = {
@@ -5,7 +5,7 @@ import re
 import subprocess
 import tempfile
 import warnings
-from contextlib import redirect_stdout
+from contextlib import redirect_stdout, closing
 from datetime import datetime
 from unittest import mock
 from unittest.mock import Mock, call
@@ -27,9 +27,11 @@ import client.user.commands as cmd
 import client.device.commands as device_cmd
 from app.models.models import MQTTUser, User, Action, Device, DeviceType, Scene
 from client.crypto_utils import check_correctness_hash, hex_to_fernet, hex_to_ope, decrypt_using_fernet_hex, \
-    decrypt_using_ope_hex, decrypt_using_abe_serialized_key, blind_index, hex_to_key, encrypt_using_abe_serialized_key, pad_payload_attr, unpad_payload_attr, \
+    decrypt_using_ope_hex, encrypt_using_ope_hex, encrypt_using_fernet_hex, decrypt_using_abe_serialized_key, blind_index, hex_to_key, encrypt_using_abe_serialized_key, pad_payload_attr, unpad_payload_attr, \
     unpad_row
-from client.utils import json_string_with_bytes_to_dict, get_tinydb_table, search_tinydb_doc, insert_into_tinydb
+from client.utils import json_string_with_bytes_to_dict, get_tinydb_table, search_tinydb_doc, insert_into_tinydb, get_data_watermark, \
+    create_payload, decode_payload, encode_payload
+from client.mirror import open_mirror, get_mirror_watermark, store_rows, query_rows
 
 cmd.path = '/tmp/keystore.json'
 
@@ -944,6 +946,144 @@ def test_get_device_data_by_num_range(runner, client, access_token, reset_tiny_d
     cmd.fake_tuple_data = None
 
 
+@pytest.mark.parametrize('reset_tiny_db', [cmd.path], indirect=True)
+def test_get_device_data_by_time_range(runner, reset_tiny_db, col_keys):
+    device_id = "23"
+    user_id = "1"
+    device_name = "my_raspberry"
+    insert_into_tinydb(cmd.path, 'device_keys', col_keys)
+
+    result = runner.invoke(cmd.get_device_data_by_time_range, [user_id, device_id, device_name, "--num-lower", 10])
+    assert "Lower or upper bound is required." in result.output
+
+    with mock.patch('client.user.commands._get_verified_range_data', return_value=[]) as _get_verified_range_data:
+        runner.invoke(cmd.get_device_data_by_time_range, [user_id, device_id, device_name, "--lower", 1546300800, "--num-upper", 50])
+        args = _get_verified_range_data.call_args[0]
+        assert args[2] == cmd.URL_GET_DEVICE_DATA_BY_TIME_RANGE
+        assert set(args[3]) == {"device_name_bi", "lower", "num_upper"}
+        assert args[3]["lower"] == encrypt_using_ope_hex(col_keys["device_data:added"], 1546300800)
+        assert args[3]["num_upper"] == encrypt_using_ope_hex(col_keys["device_data:num_data"], 50)
+        assert args[5] == {"device_data:added": ("1546300800", 100000000000), "device_data:num_data": (-100000000000, "50")}
+
+
+@pytest.mark.parametrize('reset_tiny_db', [cmd.path], indirect=True)
+def test_get_device_data_since_last_sync(runner, reset_tiny_db, col_keys):
+    device_id = "23"
+    user_id = "1"
+    device_name = "my_raspberry"
+    insert_into_tinydb(cmd.path, 'device_keys', col_keys)
+    r = Mock()
+    r.content = b'{"device_data": [], "watermark": 5, "success": true}'
+
+    with mock.patch('requests.get', return_value=r) as get:
+        runner.invoke(cmd.get_device_data, [user_id, device_id, device_name, "--no-owner", "--since-last-sync"])
+        assert "since" not in get.call_args[1]["params"]
+        assert get_data_watermark(cmd.path, device_id) == 5
+
+        r.content = b'{"device_data": [], "watermark": 7, "success": true}'
+        runner.invoke(cmd.get_device_data, [user_id, device_id, device_name, "--no-owner", "--since-last-sync"])
+        assert get.call_args[1]["params"]["since"] == 5
+        assert get_data_watermark(cmd.path, device_id) == 7
+
+        runner.invoke(cmd.get_device_data, [user_id, device_id, device_name, "--no-owner"])
+        assert "since" not in get.call_args[1]["params"]
+
+
+def test_local_mirror():
+    with tempfile.TemporaryDirectory() as directory:
+        with closing(open_mirror(f"{directory}/mirror.sqlite")) as conn:
+            assert get_mirror_watermark(conn, 23) is None
+            rows = [{"tid": "-1", "added": 10, "num_data": 5, "data": "a"}, {"tid": "-2", "added": 20, "num_data": 7, "data": "b"}]
+            store_rows(conn, 23, rows, 2)
+            store_rows(conn, 23, [{"tid": "-3", "added": 15, "num_data": 9, "data": "c"}], 3)
+
+            assert get_mirror_watermark(conn, "23") == 3
+            assert [row["tid"] for row in query_rows(conn, 23)] == [-1, -3, -2]
+            assert query_rows(conn, 23, added=(10, 20)) == [{"added": 15, "num_data": 9, "data": "c", "tid": -3}]
+            assert [row["tid"] for row in query_rows(conn, 23, added=(None, 20), num_data=(None, 9))] == [-1]
+            assert query_rows(conn, 45) == []
+
+            store_rows(conn, 23, rows[1:], 4, replace=True)
+            assert [row["tid"] for row in query_rows(conn, 23)] == [-2]
+            assert get_mirror_watermark(conn, 23) == 4
+
+
+@pytest.mark.parametrize('reset_tiny_db', [cmd.path], indirect=True)
+def test_sync_device_data(runner, reset_tiny_db, col_keys):
+    device_id = "23"
+    user_id = "1"
+    device_name = "my_raspberry"
+    insert_into_tinydb(cmd.path, 'device_keys', col_keys)
+    rows = [{"tid": "-1", "added": 10, "num_data": 5, "data": "a"}, {"tid": "-2", "added": 20, "num_data": 7, "data": "b"}]
+    mirror_path = cmd.mirror_path
+
+    with tempfile.TemporaryDirectory() as directory:
+        cmd.mirror_path = f"{directory}/mirror.sqlite"
+        with mock.patch('client.user.commands._get_all_device_data', return_value={"device_data": [], "watermark": 2, "success": True}) as get_data, \
+                mock.patch('client.user.commands._verify_device_data', return_value=rows) as verify:
+            result = runner.invoke(cmd.sync_device_data, [user_id, device_id, device_name])
+            assert "watermark: 2" in result.output
+            assert "since" not in get_data.call_args[0][1]
+            assert verify.call_args[1] == {"partial": False, "only_valid": True}
+
+            get_data.return_value = {"device_data": [], "watermark": 3, "success": True}
+            verify.return_value = []
+            result = runner.invoke(cmd.get_device_data_by_time_range, [user_id, device_id, device_name, "--lower", 10, "--local"])
+            assert get_data.call_args[0][1]["since"] == 2
+            assert verify.call_args[1]["partial"] is True
+            assert '"tid": -2' in result.output
+            assert '"tid": -1' not in result.output
+
+            result = runner.invoke(cmd.get_device_data, [user_id, device_id, device_name, "--no-owner", "--local"])
+            assert "Local mirror is available only for owned devices." in result.output
+    cmd.mirror_path = mirror_path
+
+
+@pytest.mark.parametrize('reset_tiny_db', [cmd.path], indirect=True)
+def test_get_device_data_aggregate(runner, reset_tiny_db, col_keys):
+    device_id = "23"
+    user_id = "1"
+    device_name = "my_raspberry"
+    fake_tuple_info = {
+        'shared_key': 'aefe715635c3f35f7c58da3eb410453712aaf1f8fd635571aa5180236bb21acc',
+        'integrity': {
+            'device_data': {
+                'added': {'seed': 1, 'lower_bound': 0, 'upper_bound': 1, "type": "OPE"},
+                'num_data': {'seed': 2, 'lower_bound': 0, 'upper_bound': 1, "type": "OPE"},
+                'data': {'seed': 3, 'lower_bound': 0, 'upper_bound': 1, "type": "ABE"},
+                'tid': {'lower_bound': 0, 'upper_bound': 1, "type": "Fernet"}
+            }
+        }
+    }
+    runner.invoke(device_cmd.init, [device_id, "test_password", user_id, "name_1", "name_2", "name_3", "name_4"])
+    cmd.fake_tuple_data = json.loads(device_cmd.encrypt_fake_tuple_info(fake_tuple_info, user_id))
+    insert_into_tinydb(cmd.path, 'device_keys', col_keys)
+    fake_value = cmd.generate_fake_tuples_in_range(fake_tuple_info["integrity"]["device_data"])[0]["num_data"]
+
+    def row(tid, value):
+        return {"tid": encrypt_using_fernet_hex(col_keys["device_data:tid"], str(tid)).decode(),
+                "num_data": encrypt_using_ope_hex(col_keys["device_data:num_data"], value)}
+
+    r = Mock()
+    r.content = json.dumps({"success": True, "count": 5, "buckets": [3, 1],
+                            "lowest": [row(0, fake_value), row(-1, fake_value - 4)],
+                            "highest": [row(-4, fake_value + 50), row(0, fake_value)]}).encode()
+    with mock.patch('client.user.commands._get_fake_tuple_data'), mock.patch('requests.get', return_value=r) as get:
+        result = runner.invoke(cmd.get_device_data_aggregate, [user_id, device_id, device_name, "--bucket", fake_value - 5,
+                                                               "--bucket", fake_value + 5, "--bucket", fake_value + 100])
+        params = get.call_args[1]["params"]
+        assert params["buckets"].split(",")[0] == str(encrypt_using_ope_hex(col_keys["device_data:num_data"], fake_value - 5))
+        assert params["extremes"] == 2
+
+        json_output = json.loads(result.output)
+        assert json_output["count"] == 4
+        assert json_output["min"] == fake_value - 4
+        assert json_output["max"] == fake_value + 50
+        assert [bucket["count"] for bucket in json_output["buckets"]] == [2, 1]
+
+    cmd.fake_tuple_data = None
+
+
 @pytest.mark.parametrize('reset_tiny_db', [cmd.path], indirect=True)
 def test_slice_by_range(reset_tiny_db, col_keys):
     insert_into_tinydb(cmd.path, 'device_keys', col_keys)
@@ -953,6 +1093,11 @@ def test_slice_by_range(reset_tiny_db, col_keys):
     assert result == [{'added': -959, 'num_data': -980, 'data': '1000', 'tid': '2'}]
 
 
+def test_columns_to_rows():
+    assert cmd.columns_to_rows({"id": [1, 2], "data": ["a", None]}) == [{"id": 1, "data": "a"}, {"id": 2, "data": None}]
+    assert cmd.columns_to_rows({"id": [], "data": []}) == []
+
+
 @pytest.mark.parametrize('reset_tiny_db', [cmd.path], indirect=True)
 def test_send_key_to_device(runner, access_token_two, reset_tiny_db):
     device_id = '45'
@@ -1179,6 +1324,18 @@ def test_dict_to_payload():
     assert result == '{"key1": "value", "key2": 1, "another": false}'
 
 
+def test_create_payload():
+    assert create_payload({"ciphertext": "text"}, 1) == '"{"\\"ciphertext\\"": "\\"text\\"", "\\"user_id\\"": 1}"'
+
+    payload = create_payload({"ciphertext": "text"}, 1, version=1)
+    assert payload == encode_payload({"ciphertext": "text", "user_id": 1})
+    assert decode_payload(payload) == {"ciphertext": "text", "user_id": 1}
+    assert decode_payload(b'"{\'device_data\': \'data\'}"') == {"device_data": "data"}
+
+    with pytest.raises(ValueError):
+        decode_payload(encode_payload({"ciphertext": "text"}, version=2))
+
+
 def test_increment_upper_bounds():
     table = {
         "device_data": {
@@ -1373,6 +1530,20 @@ def test_get_fake_tuple_info(runner, reset_tiny_db):
     assert fake_tuple_info_dict == data["integrity"]["device_data"]
 
 
+@pytest.mark.parametrize('reset_tiny_db', [device_cmd.path], indirect=True)
+def test_get_fake_tuple_info_binary(runner, reset_tiny_db, integrity_data):
+    data = {"id": 1, "shared_key": "aefe715635c3f35f7c58da3eb410453712aaf1f8fd635571aa5180236bb21acc", "integrity": integrity_data}
+    insert_into_tinydb(device_cmd.path, 'users', data)
+    insert_into_tinydb(device_cmd.path, "device", {"id": "23", "payload_version": 1})
+
+    result = runner.invoke(device_cmd.get_fake_tuple_info, [device_cmd.STDIN_DATA], input=encode_payload({"user_id": 1, "request": "fake_tuple_info"}))
+    payload = decode_payload(result.stdout_bytes)
+
+    assert payload["topic"] == "d:23/u:1/"
+    decrypted = decrypt_using_fernet_hex(data["shared_key"], payload["device_data"])
+    assert json_string_with_bytes_to_dict(decrypted.decode()) == integrity_data["device_data"]
+
+
 @pytest.mark.parametrize('reset_tiny_db', [device_cmd.path], indirect=True)
 def test_process_action(runner, reset_tiny_db, col_keys):
     payload = '{"user_id": "u:1", "action": "gAAAAABcXcF9yNe9emKXALJImsb7v4meic8cR6YnEulQSi8xOxF8d33scDotxPKQBTC80r-QolW2mRroUZOfLuqAqr20Z5333A==", "additional_data": "gAAAAABcikpQSsh7iACV6pAFMaldncaSrA9rj3iUh-7ejFnvXw1Uzcodf5Gf7FtZTU39R3L65nd1RzExvF9kMU1t_YwG2FpdMA=="}'
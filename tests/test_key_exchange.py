@@ -13,7 +13,8 @@ from sqlalchemy import and_
 
 from app.app_setup import db
 from app.consts import DEVICE_ID_MISSING_ERROR_MSG, PUBLIC_KEY_MISSING_ERROR_MSG, UNAUTHORIZED_USER_ERROR_MSG, NO_PUBLIC_KEY_ERROR_MSG
-from app.models.models import UserDevice
+from app.models.models import UserDevice, Device
+from app.utils import encode_payload
 from client.crypto_utils import derive_key
 from tests.conftest import assert_got_error_from_post, assert_got_data_from_post, assert_got_error_from_get, \
     get_data_from_post
@@ -150,6 +151,23 @@ def test_exchange_session_keys_success(client, access_token_two):
         publish.assert_called_once()
 
 
+def test_exchange_session_keys_binary_device(client, app_and_ctx, access_token_two):
+    data = {
+        "access_token": access_token_two,
+        "public_key": "key",
+        "device_id": 34
+    }
+    app, ctx = app_and_ctx
+    with app.app_context():
+        Device.set_payload_version(34, 1)
+        db.session.commit()
+        with mock.patch('app.app_setup.client.publish') as publish:
+            assert_got_data_from_post(client, '/api/exchange_session_keys', data)
+            publish.assert_called_once_with('server/d:34/', encode_payload({"user_public_key": "key", "user_id": 2}))
+        Device.set_payload_version(34, 0)
+        db.session.commit()
+
+
 def test_retrieve_public_key_no_such_key(client, access_token):
     data = {
         "device_id": 23,
@@ -178,6 +196,7 @@ def test_retrieve_public_key_success(client, app_and_ctx, access_token, setup_us
 
     assert status_code == 200
     assert (json_data["device_public_key"]).startswith("-----BEGIN PUBLIC KEY----")
+    assert json_data["payload_version"] == 0
     app, ctx = app_and_ctx
     with app.app_context():
         user_device = db.session.query(UserDevice) \
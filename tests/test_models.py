@@ -1,4 +1,11 @@
-from app.models.models import DeviceType, User, Device, MQTTUser, Scene, UserDevice
+from collections import namedtuple
+
+from app.models.acl_cache import acl_cache
+from app.models.device_registry import DeviceRegistry
+from app.models.hot_tier import HotTier
+from app.models.range_cache import RangeResultCache
+from app.models.row_cache import SerializedRowCache
+from app.models.models import DeviceType, User, Device, MQTTUser, Scene, UserDevice, DeviceData
 from app.utils import is_valid_uuid
 from client.crypto_utils import correctness_hash
 
@@ -33,6 +40,60 @@ def test_can_use_device(app_and_ctx, access_token, access_token_two):
         assert not User.can_use_device(user_2, device_id)
 
 
+def test_get_authorized_by_name_bi(app_and_ctx):
+    app, ctx = app_and_ctx
+    name_bi = 'a36758aa531feb3ef0ce632b7a5b993af3d8d59b8f2f8df8de854dce915d20df'  # device 23
+
+    with app.app_context():
+        user = User.get_by_id(1)
+        user_2 = User.get_by_id(2)
+        assert Device.get_authorized_by_name_bi(user, name_bi).id == 23
+        assert Device.get_authorized_by_name_bi(user_2, name_bi) is None
+        assert Device.get_authorized_by_name_bi(user, "non-existent") is None
+
+        hits = acl_cache.stats["hits"]
+        assert User.can_use_device(user, 23)
+        assert acl_cache.stats["hits"] == hits + 1
+
+        version = user_2.devices_version
+        ud = UserDevice()
+        ud.device = Device.get_by_id(23)
+        with db.session.no_autoflush:
+            ud.user = user_2
+        db.session.add(ud)
+        db.session.commit()
+        assert user_2.devices_version == version + 1
+        assert Device.get_authorized_by_name_bi(user_2, name_bi).id == 23
+
+        ud = UserDevice.get_by_ids(23, user_2.id)  # Clean-up
+        db.session.delete(ud)
+        db.session.commit()
+        assert Device.get_authorized_by_name_bi(user_2, name_bi) is None
+
+
+def test_device_data_in_range(app_and_ctx):
+    app, ctx = app_and_ctx
+
+    with app.app_context():
+        assert sorted(dd.id for dd in DeviceData.in_range(23, num_data=(466000, 470000))) == [8, 12]
+        assert sorted(dd.id for dd in DeviceData.in_range(23, num_data=(468360, None))) == [4]
+        assert sorted(dd.id for dd in DeviceData.in_range(23, num_data=(None, 466263))) == [6]
+        assert DeviceData.in_range(45, num_data=(466000, 470000)).count() == 0
+        assert sorted(dd.id for dd in DeviceData.in_range(23, added=(2200000000, 2900000000))) == [4, 8, 12]
+        assert sorted(dd.id for dd in DeviceData.in_range(23, num_data=(466000, 470000), added=(2200000000, 2800000000))) == [8]
+
+
+def test_row_serializer():
+    serializer = DeviceData.row_serializer()
+    assert serializer is DeviceData.row_serializer()
+    assert [c.key for c in serializer.columns] == list(DeviceData.SERIALIZED_COLUMNS)
+
+    row = DeviceData(id=1, tid=b"tid", added=2, num_data=3, data=None, device_id=23, tid_bi="bi", correctness_hash="hash")
+    values = tuple(getattr(row, c.key) for c in serializer.columns)
+    assert serializer(values) == {"id": 1, "tid": "tid", "added": 2, "num_data": 3, "data": None, "device_id": 23,
+                                  "tid_bi": "bi", "correctness_hash": "hash"}
+
+
 def test_device_type_uuid(app_and_ctx):
     app, ctx = app_and_ctx
 
@@ -76,3 +137,94 @@ def test_scene_owner(app_and_ctx, access_token_two):
 
     sc_no_owner = Scene()
     assert sc_no_owner.owner is None
+
+
+def test_serialized_row_cache():
+    cache = SerializedRowCache()
+    cache.max_size = 2
+    cache.add("application/json", 1, b'{"id": 1}')
+    cache.add("application/msgpack", 1, b'\x81\xa2id\x01')
+    cache.add("application/json", 2, b'{"id": 2}')
+
+    assert cache.get_many("application/json", [1, 2, 3]) == {1: b'{"id": 1}', 2: b'{"id": 2}'}
+    assert cache.stats["hits"] == 2
+    assert cache.stats["misses"] == 1
+
+    cache.add("application/json", 3, b'{"id": 3}')  # 1 was used last, so 2 is evicted
+    assert set(cache.get_many("application/json", [1, 2, 3])) == {1, 3}
+    assert len(cache) == 2
+
+    cache.evict([1])
+    assert cache.get_many("application/msgpack", [1]) == {}
+    assert len(cache) == 1
+
+
+def test_range_result_cache():
+    cache = RangeResultCache()
+    cache.max_size = 2
+    cache.max_body_size = 10
+    cache.add("a", 1, b'{"a": 1}', "application/json")
+    cache.add("b", 1, b'{"b": 1}' * 2, "application/json")  # too large
+
+    assert cache.get("a", 1) == (b'{"a": 1}', "application/json")
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 2) is None  # data of device changed, entry is dropped
+    assert len(cache) == 0
+    assert cache.stats == {"hits": 1, "misses": 2}
+
+
+def test_device_registry():
+    registry = DeviceRegistry()
+    registry.max_size = 2
+    calls = []
+
+    def loader(device_ids, limit):
+        calls.append((device_ids, limit))
+        devices = {1: frozenset({1}), 2: frozenset(), 3: frozenset({1, 2})}
+        return {device_id: devices[device_id] for device_id in (device_ids or list(devices)[:limit]) if device_id in devices}
+
+    registry.load(loader)
+    assert registry.users([1, 2], loader) == {1: frozenset({1}), 2: frozenset()}
+    assert calls == [(None, 2)]
+
+    assert registry.users([3, 9], loader) == {3: frozenset({1, 2})}  # unknown device is checked in DB every time
+    assert registry.users([9], loader) == {}
+    assert calls[1:] == [([3, 9], None), ([9], None)]
+    assert len(registry) == 2
+
+    registry.invalidate(3)
+    assert registry.users([3], loader) == {3: frozenset({1, 2})}
+    assert registry.stats == {"hits": 2, "misses": 4, "invalidations": 1}
+
+
+def test_hot_tier():
+    hot_tier = HotTier()
+    hot_tier.max_devices, hot_tier.max_rows = 1, 3
+    device = namedtuple("Device", ["id", "data_version", "data_removals", "data_seq"])
+    rows = [(1, 10, 5, 1), (2, 20, 3, 2), (3, 30, 4, 3), (4, 40, 1, 4)]  # (id, added, num_data, seq)
+
+    def load(device_id, since_seq, limit):
+        return sorted((row for row in rows if since_seq is None or row[3] > since_seq), key=lambda row: (-row[1], -row[0]))[:limit]
+
+    window = hot_tier.window(device(1, 1, 0, 4), load)
+    assert window.ids.tolist() == [2, 3, 4]
+    assert window.boundary == 10
+    assert hot_tier.page(window, added=(15, None), order_by="num_data") == ([4, 2, 3], None)
+    assert hot_tier.page(window, added=(15, None), limit=2, order_by="num_data", descending=True) == ([3, 2], (2, 3))
+    assert hot_tier.page(window, num_data=(2, None), limit=1, order_by="added", descending=True) == ([3], (3, 30))
+    assert hot_tier.page(window, num_data=(2, None)) is None  # row 1 is not in window
+    assert hot_tier.aggregate(window, "num_data") is None
+
+    rows.append((5, 50, 2, 5))
+    window = hot_tier.window(device(1, 2, 0, 5), load)
+    assert window.ids.tolist() == [3, 4, 5]
+    assert hot_tier.stats == {"hits": 0, "refreshes": 1, "loads": 1, "applied": 0}
+
+    hot_tier.apply([(1, 2, [(6, 60, 6, 6)])])
+    assert hot_tier.window(device(1, 3, 0, 6), load).ids.tolist() == [4, 5, 6]
+    assert hot_tier.stats["hits"] == 1
+
+    hot_tier.max_rows = 10
+    window = hot_tier.window(device(1, 4, 1, 6), load)  # data were removed, window is reloaded
+    assert window.boundary is None
+    assert hot_tier.aggregate(window, "added", [0, 25, 100], 2) == (5, [2, 3], [1, 2], [5, 4])
@@ -1,11 +1,14 @@
 from datetime import date, datetime
 
+import pytest
 from paho.mqtt.client import MQTTMessage
 from sqlalchemy import and_
 
 from app.app_setup import db
-from app.models.models import UserDevice, DeviceData
+from app.models.models import Device, UserDevice, DeviceData
+from app.mqtt.parser import parse_payload, route_topic
 from app.mqtt.utils import Payload
+from app.utils import encode_payload, payload_version
 
 
 def test_payload_init():
@@ -42,6 +45,50 @@ def test_payload_string():
     assert str(p) == '{\n    "added": "2001-03-28",\n    "data": "\\\\001"\n}'
 
 
+def test_payload_encode():
+    p = Payload(user_public_key='key', user_id=1)
+    assert p.encode() == b"\"{'user_public_key': 'key', 'user_id': '1'}\""
+    assert p.encode(1) == encode_payload({"user_public_key": "key", "user_id": 1})
+    assert payload_version(p.encode()) == 0
+    assert payload_version(p.encode(1)) == 1
+    assert len(p.encode(1)) < len(p.encode())
+
+
+def test_parse_payload():
+    expected = {"user_id": 1, "device_public_key": "-----BEGIN PUBLIC KEY-----\nMHYw\n-----END PUBLIC KEY-----\n"}
+    assert parse_payload(b"{'user_id': 1, 'device_public_key': '-----BEGIN PUBLIC KEY-----\\nMHYw\\n-----END PUBLIC KEY-----\\n'}") == expected
+    assert parse_payload(b"\"{'user_id': 1, 'device_public_key': '-----BEGIN PUBLIC KEY-----\nMHYw\n-----END PUBLIC KEY-----\n'}\"") == expected
+    assert parse_payload(memoryview(b'{"user_id": 1, "device_public_key": "-----BEGIN PUBLIC KEY-----\\nMHYw\\n-----END PUBLIC KEY-----\\n"}')) == expected
+    assert parse_payload(b"{}") == {}
+
+    for payload in [b"invalid", b"[1, 2]", b"{'a': 1.5}", b"{'a': true}", b"{'a': {'b': 1}}", b"{'a': 'it\"s'}", b"{'a': 1} {", b"\"{'a': 1}",
+                    b"{'a': '\xff'}", b"{'a': '" + b"x" * 64 * 1024 + b"'}"]:
+        assert parse_payload(payload) is None
+
+
+def test_parse_payload_binary():
+    expected = {"user_id": 1, "device_public_key": "-----BEGIN PUBLIC KEY-----\nMHYw\n-----END PUBLIC KEY-----\n"}
+    assert parse_payload(encode_payload(expected)) == expected
+    assert parse_payload(memoryview(encode_payload(expected))) == expected
+    assert parse_payload(encode_payload({})) == {}
+
+    for payload in [encode_payload({"a": 1}, 2), encode_payload([1, 2]), encode_payload({"a": 1.5}), encode_payload({"a": True}),
+                    encode_payload({"a": {"b": 1}}), encode_payload({"a": b"bytes"}), encode_payload({1: 1}), encode_payload({"a": 1}) + b"\x01",
+                    encode_payload({"a": 1})[:-1], b"\xc1\x01", encode_payload({"a": "x" * 64 * 1024})]:
+        assert parse_payload(payload) is None
+
+
+def test_route_topic():
+    assert route_topic("d:23/server") == ((23, None), None)
+    assert route_topic("d:23/server/") == ((23, None), None)
+    assert route_topic("d:23/server/save_data") == ((23, "save_data"), None)
+    assert route_topic("d:23/server/unknown/") == ((23, "unknown"), None)
+    assert route_topic("d:invalid/server/") == (None, "Invalid Device type or ID")
+    assert route_topic("u:1/server") == (None, "Invalid Device type or ID")
+    assert route_topic("d:23/u:1/") == (None, None)
+    assert route_topic("anything") == (None, None)
+
+
 def test_mqtt_handle_on_message_invalid_message(app_and_ctx, capsys):
     msg = MQTTMessage(topic=b"anything")
     msg.payload = b"invalid"
@@ -78,6 +125,48 @@ def test_mqtt_handle_on_message_receive_pk(app_and_ctx):
         assert isinstance(user_device.added, datetime)
 
 
+def test_mqtt_handle_on_message_receive_pk_uses_device_registry(app_and_ctx):
+    from app.models.device_registry import device_registry
+    from app.mqtt.mqtt import handle_on_message
+    app, ctx = app_and_ctx
+    msg = MQTTMessage(topic=b"d:23/server/")
+    msg.payload = b"{'user_id': 1, 'device_public_key': 'key'}"
+    with app.app_context():
+        key = UserDevice.get_by_ids(23, 1).device_public_session_key
+        device_registry.users([23], Device.get_user_ids)
+        db.session.rollback()
+        hits, misses = device_registry.stats["hits"], device_registry.stats["misses"]
+        handle_on_message(None, None, msg, app, db)
+
+        assert device_registry.stats["hits"] == hits + 1  # no lookup query
+        assert device_registry.stats["misses"] == misses
+        assert UserDevice.get_by_ids(23, 1).device_public_session_key == "key"
+
+        UserDevice.set_public_session_key(23, 1, key)
+        db.session.commit()
+
+
+def test_mqtt_handle_on_message_receive_pk_binary(app_and_ctx):
+    from app.mqtt.mqtt import handle_on_message
+    app, ctx = app_and_ctx
+    msg = MQTTMessage(topic=b"d:23/server/")
+    msg.payload = encode_payload({"user_id": 1, "device_public_key": "key"})
+    with app.app_context():
+        key = UserDevice.get_by_ids(23, 1).device_public_session_key
+        assert Device.get_payload_version(23) == 0
+        handle_on_message(None, None, msg, app, db)
+
+        assert UserDevice.get_by_ids(23, 1).device_public_session_key == "key"
+        assert Device.get_payload_version(23) == 1
+
+        msg.payload = b"{'user_id': 1, 'device_public_key': 'key'}"
+        handle_on_message(None, None, msg, app, db)
+        assert Device.get_payload_version(23) == 0
+
+        UserDevice.set_public_session_key(23, 1, key)
+        db.session.commit()
+
+
 def test_mqtt_handle_on_message_receive_pk_invalid_device_id(app_and_ctx, capsys):
     pk = b'-----BEGIN PUBLIC KEY-----\\nMHYwEAYHKoZIzj0CAQYFK4EEACIDYgAE2rD6Bhju8WSEFogdBxZt/N+n7ziUPi5C\\nQU1gSQQDNm57fdDuYNDOR7Wwb1fq5tSl2TC1D6WRTIt1gzzCsApGpZ3PIs7Wdbil\\neJL/ETGa2Sqwav7JDH4r0V30sF4NqDok\\n-----END PUBLIC KEY-----\\n'
     user_id = 1
@@ -175,3 +264,211 @@ def test_mqtt_handle_on_message_delete_device_data(app_and_ctx, capsys):
             DeviceData.device_id == device_id,
         )).first()
         assert device_data is None, "Data was not removed."
+
+
+def test_ingest_buffer_flushes_batches(app_and_ctx, capsys):
+    from app.mqtt.ingest import IngestBuffer
+    app, ctx = app_and_ctx
+    device_id = 23
+    tid_bis = [f'ingest_buffer_test_{i}' for i in range(3)]
+    payloads = [{'added': 6987 + i, 'num_data': 31164 + i, 'data': 'gAAAAABcTFAz9Wr5ZsnMcVYbQiXlnZCvT36MfDatZNyLwDpm_ixbzkZhM1NA4w7MN2p3CW3gyTA8gYtuKtDTomhulszvLTFfPA==',
+                 'tid': f'encrypted_tid({i})', 'tid_bi': tid_bi, 'correctness_hash': '$2b$12$9hxKg4pjXbm0kpbItQTd2uMICAGn2ntRw1qQskHIL/7tLa3ISIlmO'}
+                for i, tid_bi in enumerate(tid_bis)]
+
+    def count_rows():
+        return db.session.query(DeviceData).filter(DeviceData.tid_bi.in_(tid_bis)).count()
+
+    buffer = IngestBuffer()
+    buffer.init_app(app, db)
+    buffer.batch_size = 4
+    with app.app_context():
+        buffer.add(device_id, "save_data", payloads[0])
+        buffer.add(9999, "save_data", payloads[1])  # device not present
+        buffer.add(device_id, "save_data", payloads[2])
+        assert count_rows() == 0
+        assert buffer.pending() == 3
+
+        buffer.add(device_id, "remove_data", payloads[0])  # batch is full and gets flushed in original order
+        captured = capsys.readouterr()
+        assert "Device with id: 9999 doesn't exist." in captured.out
+        assert buffer.pending() == 0
+        assert count_rows() == 1
+        assert buffer.stats["commits"] == 1
+        assert buffer.stats["inserted"] == 2
+        assert buffer.stats["removed"] == 1
+        assert buffer.stats["rejected"] == 1
+
+        buffer.add(device_id, "save_data", payloads[2])  # duplicate must not discard rest of the batch
+        buffer.add(device_id, "save_data", payloads[1])
+        buffer.add(device_id, "save_data", payloads[1])  # redelivered within the same batch
+        buffer.add(device_id, "remove_data", payloads[2])  # batch is full again
+        assert buffer.pending() == 0
+        assert count_rows() == 1
+        assert buffer.stats["commits"] == 2  # duplicates are skipped by the batch INSERT
+        assert buffer.stats["inserted"] == 3
+        assert buffer.stats["duplicates"] == 2
+        assert buffer.stats["rejected"] == 1
+
+        buffer.add(device_id, "remove_data", payloads[1])
+        assert buffer.flush() == 1
+        assert count_rows() == 0
+        assert buffer.flush() == 0
+
+
+def test_spool(tmp_path):
+    from app.mqtt.spool import Spool
+    spool = Spool(str(tmp_path), segment_size=100, max_size=1000)
+    for i in range(5):
+        assert spool.append([23, "save_data", {"tid_bi": f"spool_{i}"}])
+    assert len(spool) == 5
+    assert len(list(tmp_path.glob("*.seg"))) > 1
+    with pytest.raises(RuntimeError):
+        Spool(str(tmp_path))  # directory is locked
+
+    ops, position = spool.read(3)
+    assert [op[2]["tid_bi"] for op in ops] == ["spool_0", "spool_1", "spool_2"]
+    assert spool.read(3)[0] == ops  # read doesn't move checkpoint
+    spool.commit(position, len(ops))
+    assert len(spool) == 2
+    spool.close()
+
+    segment = sorted(tmp_path.glob("*.seg"))[-1]
+    with open(segment, "ab") as f:
+        f.write(b"\x10\x00")  # torn record left by crash
+    spool = Spool(str(tmp_path), max_size=1)
+    assert len(spool) == 2
+    ops, position = spool.read(10)
+    assert [op[2]["tid_bi"] for op in ops] == ["spool_3", "spool_4"]
+    assert not spool.append([23, "save_data", {}])  # spool is full
+    spool.commit(position, len(ops))
+    assert len(spool) == 0
+    spool.close()
+
+
+def test_ingest_buffer_spool(app_and_ctx, tmp_path):
+    from app.mqtt.ingest import IngestBuffer
+    app, ctx = app_and_ctx
+    device_id = 23
+    tid_bis = [f'ingest_spool_test_{i}' for i in range(3)]
+    payloads = [{'added': 6987 + i, 'num_data': 31164 + i, 'data': 'gAAAAABcTFAz9Wr5ZsnMcVYbQiXlnZCvT36MfDatZNyLwDpm_ixbzkZhM1NA4w7MN2p3CW3gyTA8gYtuKtDTomhulszvLTFfPA==',
+                 'tid': f'encrypted_tid({i})', 'tid_bi': tid_bi, 'correctness_hash': '$2b$12$9hxKg4pjXbm0kpbItQTd2uMICAGn2ntRw1qQskHIL/7tLa3ISIlmO'}
+                for i, tid_bi in enumerate(tid_bis)]
+
+    def count_rows():
+        return db.session.query(DeviceData).filter(DeviceData.tid_bi.in_(tid_bis)).count()
+
+    old_config = {key: app.config[key] for key in ("INGEST_SPOOL_DIR", "INGEST_BATCH_SIZE", "INGEST_SPOOL_REPLAY_BATCHES")}
+    app.config.update(INGEST_SPOOL_DIR=str(tmp_path), INGEST_BATCH_SIZE=2, INGEST_SPOOL_REPLAY_BATCHES=1)
+    try:
+        buffer = IngestBuffer()
+        buffer.init_app(app, db)
+        with app.app_context():
+            for payload in payloads:
+                buffer.add(device_id, "save_data", payload)
+            assert buffer.pending() == 3
+            assert count_rows() == 0  # messages are only spooled until flush
+            buffer.close()
+
+            buffer = IngestBuffer()  # restart replays spooled messages
+            buffer.init_app(app, db)
+            assert buffer.pending() == 3
+            assert buffer.flush() == 2  # one batch per flush
+            assert buffer.pending() == 1
+            assert buffer.flush() == 1
+            assert buffer.pending() == 0
+            assert count_rows() == 3
+
+            for payload in payloads:
+                buffer.add(device_id, "remove_data", payload)
+            buffer.flush()
+            buffer.flush()
+            assert count_rows() == 0
+            buffer.close()
+    finally:
+        app.config.update(old_config)
+
+
+def test_ingest_buffer_rejects_data_of_removed_device(app_and_ctx, capsys):
+    from app.mqtt.ingest import IngestBuffer
+    app, ctx = app_and_ctx
+    removed_device_id = 2000
+    tid_bis = ['removed_device_test_0', 'removed_device_test_1']
+    payloads = [{'added': 6987, 'num_data': 31164, 'data': 'gAAAAABcTFAz9Wr5ZsnMcVYbQiXlnZCvT36MfDatZNyLwDpm_ixbzkZhM1NA4w7MN2p3CW3gyTA8gYtuKtDTomhulszvLTFfPA==',
+                 'tid': 'encrypted_tid', 'tid_bi': tid_bi, 'correctness_hash': '$2b$12$9hxKg4pjXbm0kpbItQTd2uMICAGn2ntRw1qQskHIL/7tLa3ISIlmO'}
+                for tid_bi in tid_bis]
+    with app.app_context():
+        db.session.add(Device(id=removed_device_id, name=b"removed_device", correctness_hash=""))
+        db.session.commit()
+
+    buffer = IngestBuffer()
+    buffer.init_app(app, db)
+    filter_existing = buffer._filter_existing
+
+    def filter_existing_then_remove_device(batch):  # device is removed after it was checked
+        valid = filter_existing(batch)
+        db.session.query(Device).filter(Device.id == removed_device_id).delete()
+        return valid
+
+    buffer._filter_existing = filter_existing_then_remove_device
+    with app.app_context():
+        buffer.add(removed_device_id, "save_data", payloads[0])
+        buffer.add(23, "save_data", payloads[1])
+        assert buffer.flush() == 2
+        assert buffer.pending() == 0
+        assert "Rejected 1 messages of removed devices." in capsys.readouterr().out
+        assert buffer.stats["rejected"] == 1
+        assert buffer.stats["inserted"] == 1
+        assert db.session.query(DeviceData).filter(DeviceData.tid_bi.in_(tid_bis)).count() == 1
+
+        DeviceData.delete_by_device_tid_bi_pairs([(23, tid_bis[1])])
+        db.session.commit()
+
+
+def test_ingest_buffer_rejects_malformed_payload(app_and_ctx):
+    from app.mqtt.ingest import IngestBuffer
+    app, ctx = app_and_ctx
+    buffer = IngestBuffer()
+    buffer.init_app(app, db)
+    with pytest.raises(KeyError):
+        buffer.add(23, "save_data", {'added': 1})
+    with pytest.raises(ValueError):
+        buffer.add(23, "save_data", {'added': 'x', 'num_data': 1, 'data': '', 'tid': '', 'tid_bi': '', 'correctness_hash': ''})
+    with pytest.raises(ValueError):
+        buffer.add(23, "invalid", {})
+    assert buffer.pending() == 0
+
+
+def test_ingest_topics():
+    from app.mqtt import ingest_topics
+    assert ingest_topics() == ["+/server", "+/server/+"]
+
+
+def test_ingest_worker_partitions():
+    from app.mqtt.worker import PartitionedDispatcher, parse_partition, worker_partition_of
+    assert parse_partition("1/3") == (1, 3)
+    for value in ["3/3", "-1/3", "1", "a/3"]:
+        with pytest.raises(ValueError):
+            parse_partition(value)
+
+    senders = [f"d:{device_id}".encode() for device_id in range(100)]
+    assert {worker_partition_of(sender, 3) for sender in senders} == {0, 1, 2}
+    dispatcher = PartitionedDispatcher(2, None)
+    assert {dispatcher.partition_of(sender) for sender in senders if worker_partition_of(sender, 2) == 0} == {0, 1}  # all threads are used
+    dispatcher.stop()
+
+
+def test_partitioned_dispatcher_preserves_order_per_device():
+    from app.mqtt.worker import PartitionedDispatcher, sender_of
+    processed = []
+    dispatcher = PartitionedDispatcher(3, lambda msg: processed.append((msg.topic, msg.payload)))
+    for i in range(20):
+        for device_id in range(5):
+            msg = MQTTMessage(topic=f"d:{device_id}/server/save_data".encode())
+            msg.payload = i
+            dispatcher.dispatch(sender_of(msg.topic), msg)
+    dispatcher.stop()
+
+    assert len(processed) == 100
+    for device_id in range(5):
+        assert [payload for topic, payload in processed if topic == f"d:{device_id}/server/save_data"] == list(range(20))
+    assert dispatcher.partition_of(b"d:23") == dispatcher.partition_of(sender_of("d:23/server/remove_data"))